@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# benchmarks/answer_matcher.py
+# Copyright (C) 2021 github.com/googlehosts Group:Z
+#
+# This module is part of googlehosts/telegram-repeater and is released under
+# the AGPL v3 License: https://www.gnu.org/licenses/agpl-3.0.txt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+from __future__ import annotations
+import argparse
+import asyncio
+import random
+import sys
+import time
+from typing import Dict, List, Tuple
+
+import customservice
+import utils
+
+# The answers of regular expression problems are stripped as well, so no regex syntax in here
+PUNCTUATIONS = list(',.!?;:\'"，。！？；：、')
+PROBLEM_SET = {
+    'version': 1,
+    'configs': {'ignore_punctuations': {'enable': True, 'items': PUNCTUATIONS}},
+    'problems': {
+        'problem_set': [
+            {'Q': 'literal', 'A': 'telegram repeater'},
+            {'Q': 'regex', 'A': r'(?i)tele(gram)? ?repeater$', 'use_regular_expression': True},
+            # Backtracks exponentially when the input ends with anything but "a"
+            {'Q': 'hostile', 'A': r'(a+)+$', 'use_regular_expression': True},
+        ],
+    },
+}
+
+
+def build_answers(size: int, seed: int) -> List[Tuple[int, str]]:
+    rand = random.Random(seed)
+    answers = []
+    for _ in range(size):
+        text = rand.choice(('telegram repeater', 'Tele Repeater!', 'repeater', 'tele, gram. repeater'))
+        text += ''.join(rand.choices(PUNCTUATIONS + [' '], k=rand.randint(0, 8)))
+        answers.append((rand.randint(0, 1), text))
+    return answers
+
+
+def measure_normalize(remove_punctuations: customservice.RemovePunctuations,
+                      answers: List[Tuple[int, str]]) -> Dict[str, float]:
+    items = remove_punctuations.items
+    result = {}
+    for name, func in (('char_loop', lambda text: ''.join(x for x in text if x not in items)),
+                       ('translate', remove_punctuations.replace)):
+        start = time.perf_counter()
+        for _key, text in answers:
+            func(text)
+        result[name] = round(len(answers) / (time.perf_counter() - start), 1)
+    return result
+
+
+async def run(size: int, seed: int, timeout: float) -> Dict[str, Dict[str, float]]:
+    problems = customservice.ProblemSet(PROBLEM_SET, customservice.RemovePunctuations(
+        **PROBLEM_SET['configs']['ignore_punctuations']))
+    regex_worker = utils.RegexWorker(timeout)
+    answers = build_answers(size, seed)
+    try:
+        # The first batch pays for starting the worker
+        await problems.check_answers(answers[:10], regex_worker)
+        start = time.perf_counter()
+        matched = await problems.check_answers(answers, regex_worker)
+        batch = time.perf_counter() - start
+        start = time.perf_counter()
+        for key, text in answers[:200]:
+            await problems.check_answer(key, text, regex_worker)
+        single = time.perf_counter() - start
+        start = time.perf_counter()
+
+        async def other_user() -> float:
+            # Another user answering at the same time goes to another worker process
+            await problems.check_answer(1, 'telegram repeater', regex_worker)
+            return time.perf_counter() - start
+
+        hostile, other_user_time = await asyncio.gather(
+            problems.check_answers([(2, 'a' * 40 + 'b'), (0, 'telegram repeater')], regex_worker), other_user())
+        hostile_time = time.perf_counter() - start
+    finally:
+        regex_worker.close()
+    return {
+        'normalize_per_sec': measure_normalize(problems.remove_punctuations, answers),
+        'check': {'batch_per_sec': round(len(answers) / batch, 1), 'single_per_sec': round(200 / single, 1),
+                  'matched_ratio': round(sum(matched) / len(matched), 3)},
+        'hostile': {'seconds': round(hostile_time, 3), 'other_user_seconds': round(other_user_time, 3),
+                    'results': hostile, **regex_worker.stats},
+    }
+
+
+def main(args: List[str]) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark the join verification answer matching')
+    parser.add_argument('--size', type=int, default=5000, help='answers to check')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--timeout', type=float, default=0.5, help='time budget of a regular expression match')
+    options = parser.parse_args(args)
+
+    result = asyncio.run(run(options.size, options.seed, options.timeout))
+    for section, values in result.items():
+        print(f'{section:<20}', '  '.join(f'{key}={value}' for key, value in values.items()))
+    # A hostile answer has to be cut off at the time budget and must not take the literal answer after it along, nor
+    # hold up the answer of another user
+    hostile = result['hostile']
+    return 0 if hostile['results'] == [False, True] and hostile['other_user_seconds'] < options.timeout else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
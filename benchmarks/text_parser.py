@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# benchmarks/text_parser.py
+# Copyright (C) 2021 github.com/googlehosts Group:Z
+#
+# This module is part of googlehosts/telegram-repeater and is released under
+# the AGPL v3 License: https://www.gnu.org/licenses/agpl-3.0.txt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+from __future__ import annotations
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Coroutine, Dict, List, Optional, Tuple
+
+from pyrogram.parser.html import HTML
+from pyrogram.types import Chat, Message, MessageEntity, User
+
+import customservice
+import repeater
+import utils
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'text_parser_baseline.json')
+CHAT_ID = -1001000000001
+TARGET_ID = -1001000000002
+
+_WORDS = ('repeater', 'group', 'message', 'hello', 'world', 'telegram', 'bot', 'reply', 'forward', 'media', '<tag>',
+          'a&b', '@repeater_bot', 'https://example.com/path?query=1')
+_EMOJI = ('\U0001f600', '\U0001f44d', '\U0001f525', '❤️', '\U0001f1fa\U0001f1f8', '\U0001f468‍\U0001f4bb',
+          '中文', 'é')
+_FORMAT_TYPES = ('bold', 'italic', 'code', 'strikethrough', 'underline', 'text_link', 'text_mention')
+
+
+def _utf16_len(s: str) -> int:
+    return len(s.encode('utf-16-le')) // 2
+
+
+class CorpusBuilder:
+    def __init__(self, seed: int = 0):
+        self.random: random.Random = random.Random(seed)
+        self.message_id: int = 0
+        self.sender: User = User(id=10001, first_name='Bench', last_name='User')
+
+    def _words(self, count: int, emoji_ratio: float = 0.0) -> List[str]:
+        return [self.random.choice(_EMOJI) if self.random.random() < emoji_ratio else self.random.choice(_WORDS)
+                for _ in range(count)]
+
+    def _entity(self, offset: int, length: int) -> MessageEntity:
+        _type = self.random.choice(_FORMAT_TYPES)
+        return MessageEntity(type=_type, offset=offset, length=length,
+                             url='https://example.com/' + str(offset) if _type == 'text_link' else None,
+                             user=self.sender if _type == 'text_mention' else None)
+
+    def _flat_entities(self, words: List[str], ratio: float) -> List[MessageEntity]:
+        entities = []
+        offset = 0
+        for word in words:
+            if self.random.random() < ratio:
+                entities.append(self._entity(offset, _utf16_len(word)))
+            offset += _utf16_len(word) + 1
+        return entities
+
+    def _nested_entities(self, words: List[str], depth: int) -> List[MessageEntity]:
+        # Telegram sends entities sorted by offset, outer ones first
+        entities = []
+        offsets = []
+        offset = 0
+        for word in words:
+            offsets.append((offset, offset + _utf16_len(word)))
+            offset += _utf16_len(word) + 1
+        span = depth * 2 + 1
+        for start in range(0, len(words) - span + 1, span + 1):
+            for level in range(depth):
+                first, last = start + level, start + span - 1 - level
+                entities.append(self._entity(offsets[first][0], offsets[last][1] - offsets[first][0]))
+        entities.sort(key=lambda x: x.offset)
+        return entities
+
+    def message(self, text: str, entities: Optional[List[MessageEntity]], caption: bool = False,
+                forward_from: Optional[User] = None, forward_from_chat: Optional[Chat] = None) -> Message:
+        self.message_id += 1
+        kwargs = {'caption': text, 'caption_entities': entities} if caption else {'text': text, 'entities': entities}
+        return Message(message_id=self.message_id, chat=Chat(id=CHAT_ID, type='supergroup', title='Bench'),
+                       from_user=self.sender, forward_from=forward_from, forward_from_chat=forward_from_chat, **kwargs)
+
+    def plain(self) -> Message:
+        return self.message(' '.join(self._words(self.random.randint(3, 40))), None)
+
+    def emoji(self) -> Message:
+        words = self._words(self.random.randint(10, 80), 0.5)
+        return self.message(' '.join(words), self._flat_entities(words, 0.3))
+
+    def nested(self) -> Message:
+        words = self._words(self.random.randint(40, 120), 0.1)
+        return self.message(' '.join(words), self._nested_entities(words, self.random.randint(2, 4)))
+
+    def long_caption(self) -> Message:
+        words = self._words(200, 0.1)
+        text = ' '.join(words)[:1024]
+        entities = [x for x in self._flat_entities(words, 0.2) if x.offset + x.length <= _utf16_len(text)]
+        return self.message(text, entities, caption=True)
+
+    def forwarded(self) -> Message:
+        words = self._words(self.random.randint(5, 60), 0.2)
+        if self.random.random() < 0.5:
+            return self.message(' '.join(words), self._flat_entities(words, 0.2),
+                                forward_from=User(id=10002, first_name='Forward', last_name='Source'))
+        return self.message(' '.join(words), self._flat_entities(words, 0.2),
+                            forward_from_chat=Chat(id=-1001000000003, type='channel', title='Forward channel'))
+
+    def build(self, kind: str, size: int) -> List[Message]:
+        return [getattr(self, kind)() for _ in range(size)]
+
+
+def _run_sync(coro: Coroutine) -> Any:
+    # Without a client the HTML parser never suspends, so skip the event loop
+    try:
+        coro.send(None)
+    except StopIteration as e:
+        return e.value
+    raise RuntimeError('Coroutine suspended')
+
+
+_html = HTML(None)
+
+CORPORA = ('plain', 'emoji', 'nested', 'long_caption', 'forwarded')
+
+PIPELINES: Dict[str, Callable[[Message], Any]] = {
+    'customservice': lambda msg: customservice.TextParser(msg).parsed_msg,
+    'repeater': lambda msg: repeater.TextParser(msg).get_full_message(),
+    # What each render mode costs until pyrogram has the text and entities it sends
+    'render_html': lambda msg: _run_sync(_html.parse(repeater.TextParser(msg).get_full_message())),
+    'render_entities': lambda msg: repeater.TextParser(msg).get_full_message_entities(),
+}
+
+
+def measure(func: Callable[[Message], str], messages: List[Message], rounds: int) -> Dict[str, float]:
+    for msg in messages[:50]:
+        func(msg)
+    samples = []
+    perf_counter = time.perf_counter
+    for _ in range(rounds):
+        for msg in messages:
+            start = perf_counter()
+            func(msg)
+            samples.append(perf_counter() - start)
+    samples.sort()
+    total = sum(samples)
+    # Separate pass, tracing slows every allocation down
+    tracemalloc.start()
+    allocated = 0
+    for msg in messages:
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        func(msg)
+        allocated += tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    return {
+        'msgs_per_sec': round(len(samples) / total, 1),
+        'mean_us': round(total / len(samples) * 1e6, 2),
+        'p99_us': round(samples[int(len(samples) * 0.99)] * 1e6, 2),
+        'peak_bytes_per_msg': round(allocated / len(messages), 1),
+    }
+
+
+def run(size: int, rounds: int, seed: int, parse_cache: bool = False) -> Dict[str, Dict[str, float]]:
+    repeater.config.read_dict({'fuduji': {'fudu_group': str(CHAT_ID), 'target_group': str(TARGET_ID),
+                                          'replace_to_id': 'bench'}})
+    repeater.TextParser.bot_username = 'repeater_bot'
+    # Nested entities leave tags unclosed in HTML mode, pyrogram warns about every one of them
+    logging.getLogger('pyrogram.parser.html').setLevel(logging.ERROR)
+    if not parse_cache:
+        # Every round would be served from the cache otherwise
+        repeater.TextParser._parse_cache = customservice.TextParser._parse_cache = utils.ParseCache(0)
+    result = {}
+    for kind in CORPORA:
+        messages = CorpusBuilder(seed).build(kind, size)
+        for name, func in PIPELINES.items():
+            result[f'{name}/{kind}'] = measure(func, messages, rounds)
+    return result
+
+
+def compare(current: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]],
+            tolerance: float) -> List[Tuple[str, str, float]]:
+    regressions = []
+    for key, value in current.items():
+        if key not in baseline:
+            continue
+        for metric in ('mean_us', 'p99_us', 'peak_bytes_per_msg'):
+            ratio = value[metric] / max(baseline[key][metric], 1e-9)
+            if ratio > 1 + tolerance:
+                regressions.append((key, metric, ratio))
+    return regressions
+
+
+def main(args: List[str]) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark the TextParser rendering pipeline')
+    parser.add_argument('--size', type=int, default=500, help='messages per corpus')
+    parser.add_argument('--rounds', type=int, default=5, help='timed passes over each corpus')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', action='store_true', help='store the result as the new baseline')
+    parser.add_argument('--parse-cache', action='store_true', help='keep the per-message parse cache enabled')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed slowdown against the baseline before failing (0.25 means 25%%)')
+    options = parser.parse_args(args)
+
+    result = run(options.size, options.rounds, options.seed, options.parse_cache)
+    baseline = {}
+    if os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE, encoding='utf8') as fin:
+            baseline = json.load(fin)['results']
+
+    print(f'{"pipeline/corpus":<30}{"msgs/s":>12}{"mean us":>10}{"p99 us":>10}{"bytes/msg":>12}{"vs base":>10}')
+    for key, value in result.items():
+        speedup = '' if key not in baseline else '{:.2f}x'.format(baseline[key]['mean_us'] / value['mean_us'])
+        print(f'{key:<30}{value["msgs_per_sec"]:>12}{value["mean_us"]:>10}{value["p99_us"]:>10}'
+              f'{value["peak_bytes_per_msg"]:>12}{speedup:>10}')
+
+    if options.save:
+        with open(BASELINE_FILE, 'w', encoding='utf8') as fout:
+            json.dump({'python': platform.python_version(), 'machine': platform.machine(),
+                       'size': options.size, 'rounds': options.rounds, 'seed': options.seed, 'results': result},
+                      fout, indent=2)
+            fout.write('\n')
+        print('Baseline saved to', BASELINE_FILE)
+        return 0
+
+    regressions = compare(result, baseline, options.tolerance)
+    for key, metric, ratio in regressions:
+        print(f'REGRESSION {key} {metric}: {ratio:.2f}x of baseline')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -21,6 +21,7 @@
 from __future__ import annotations
 import asyncio
 import base64
+import functools
 import gettext
 import hashlib
 import logging
@@ -28,10 +29,12 @@ import random
 import re
 import time
 import traceback
+from collections import OrderedDict
 from configparser import ConfigParser
+from dataclasses import dataclass
 from datetime import datetime
 from typing import (Awaitable, Callable, Dict, List, Mapping, Optional,
-                    Sequence, Tuple, TypeVar, Union)
+                    Sequence, Set, Tuple, TypeVar, Union)
 
 import aioredis
 import asyncpg
@@ -57,10 +60,11 @@ _anyT = TypeVar('_anyT')
 
 
 class TextParser(utils.TextParser):
+    _parse_cache = utils.ParseCache()
+
     def __init__(self, msg: Message):
         super().__init__()
-        self._msg = self.BuildMessage(msg)
-        self.parsed_msg = self.parse_main()
+        self.parse_message(msg)
 
     def __str__(self) -> str:
         return self.parsed_msg
@@ -73,12 +77,15 @@ class Ticket:
         self.section = section
         self.status = status
         self.sql = (
-            '''INSERT INTO "tickets" ("user_id", "hash", "timestamp", "origin_msg", "section", "status") 
-            VALUES ($1, $2, CURRENT_TIMESTAMP, $3, $4, $5)''',
+            CustomServiceBot._INSERT_TICKET,
             msg.chat.id, self.hash_value, base64.b64encode(self._origin_msg.encode()).decode(), self.section,
             self.status
         )
 
+    @property
+    def origin_msg(self) -> str:
+        return self._origin_msg
+
     def __str__(self) -> Tuple[str, int, str, str, str, str]:
         return self.sql
 
@@ -87,78 +94,115 @@ class RemovePunctuations:
     def __init__(self, enable: bool, items: List[str]):
         self.enable = enable
         self.items = items
+        # Items longer than a character never matched a single character before, so they are still skipped
+        self._table: Dict[int, None] = {ord(x): None for x in items if len(x) == 1}
 
     def replace(self, text: str) -> str:
         if not self.enable:
             return text
-        return ''.join(x for x in text if x not in self.items)
+        return text.translate(self._table)
 
 
 class ProblemSet:
+    # Never changed after it is built, a reload builds a new instance and swaps it in
     _self = None
 
-    def __init__(self, redis_conn: aioredis.Redis, problem_set: Mapping[str, _anyT],
-                 remove_punctuations: RemovePunctuations):
-        self._redis: aioredis.Redis = redis_conn
+    @dataclass(frozen=True)
+    class Problem:
+        question: str
+        # With punctuations removed
+        answer: str
+        origin_answer: str
+        pattern: Optional[re.Pattern] = None
+
+    def __init__(self, problem_set: Mapping[str, _anyT], remove_punctuations: RemovePunctuations,
+                 redis_conn: Optional[aioredis.Redis] = None):
+        self._redis: Optional[aioredis.Redis] = redis_conn
         self._prefix: str = utils.get_random_string()
+        self._published: List[str] = []
         self.version: int = problem_set['version']
-        self.problem_length: int = len(problem_set['problems']['problem_set'])
-        self.sample_problem: Dict[str, str] = problem_set['problems'].get('sample_problem')
-        self._has_sample: bool = bool(self.sample_problem)
         self.remove_punctuations: RemovePunctuations = remove_punctuations
-
-    async def init(self, problem_set: Mapping[str, _anyT]):
+        self.problems: Tuple[ProblemSet.Problem, ...] = tuple(
+            self._build_problem(problem) for problem in problem_set['problems']['problem_set'])
+        if not self.problems:
+            raise ValueError('Problem set has no problem')
+        sample_problem = problem_set['problems'].get('sample_problem')
+        self.sample_problem: Optional[Dict[str, str]] = \
+            {'Q': sample_problem['Q'], 'A': sample_problem['A']} if sample_problem else None
+
+    def _build_problem(self, problem: Mapping[str, _anyT]) -> ProblemSet.Problem:
+        answer = self.remove_punctuations.replace(problem['A'])
+        return ProblemSet.Problem(problem['Q'], answer, problem['A'],
+                                  re.compile(answer) if problem.get('use_regular_expression') else None)
+
+    async def publish(self) -> None:
+        # Redis only shares the problems with other processes, nothing in here reads them back
+        if self._redis is None:
+            return
+        values = {}
         if self.sample_problem:
-            await self._redis.mset({f'{self._prefix}_{key}_sample': item for key, item in self.sample_problem.items()})
-        for x in range(self.problem_length):
-            problems = problem_set['problems']['problem_set']
-            if problems[x].get('use_regular_expression'):
-                await self._redis.set(f'{self._prefix}_re_{x}', 1)
-            await self._redis.set(f'{self._prefix}_Q_{x}', problems[x]['Q'])
-            await self._redis.set(f'{self._prefix}_A_{x}', self.remove_punctuations.replace(problems[x]['A']))
-            await self._redis.set(f'{self._prefix}_OA_{x}', problems[x]['A'])
+            values.update({f'{self._prefix}_{key}_sample': item for key, item in self.sample_problem.items()})
+        for x, problem in enumerate(self.problems):
+            if problem.pattern is not None:
+                values[f'{self._prefix}_re_{x}'] = 1
+            values[f'{self._prefix}_Q_{x}'] = problem.question
+            values[f'{self._prefix}_A_{x}'] = problem.answer
+            values[f'{self._prefix}_OA_{x}'] = problem.origin_answer
+        if values:
+            await self._redis.mset(values)
+            self._published = list(values)
 
     @classmethod
-    async def create(cls, redis_conn: aioredis.Redis, problem_set: Dict[str, _anyT],
+    async def create(cls, redis_conn: Optional[aioredis.Redis], problem_set: Dict[str, _anyT],
                      remove_punctuations: RemovePunctuations) -> 'ProblemSet':
-        self = ProblemSet(redis_conn, problem_set, remove_punctuations)
-        await self.init(problem_set)
+        self = ProblemSet(problem_set, remove_punctuations, redis_conn)
+        await self.publish()
         return self
 
     async def destroy(self) -> None:
-        for x in range(self.problem_length):
-            await self._redis.delete(f'{self._prefix}_re_{x}')
-            await self._redis.delete(f'{self._prefix}_Q_{x}')
-            await self._redis.delete(f'{self._prefix}_A_{x}')
-            await self._redis.delete(f'{self._prefix}_OA_{x}')
-        if self._has_sample:
-            await self._redis.delete(f'{self._prefix}_Q_sample')
-            await self._redis.delete(f'{self._prefix}_A_sample')
+        if self._published:
+            await self._redis.delete(*self._published)
+            self._published = []
 
     def get_random_number(self) -> int:
-        return random.randint(0, self.problem_length - 1)
-
-    async def get(self, key: int) -> Dict[str, str]:
-        return {'use_regular_expression': await self._redis.get(f'{self._prefix}_re_{key}'),
-                'Q': (await self._redis.get(f'{self._prefix}_Q_{key}')).decode(),
-                'A': (await self._redis.get(f'{self._prefix}_A_{key}')).decode()}
+        return random.randint(0, len(self.problems) - 1)
+
+    def get(self, key: int) -> ProblemSet.Problem:
+        return self.problems[key]
+
+    def get_origin(self, key: int) -> str:
+        return self.problems[key].origin_answer
+
+    async def check_answers(self, answers: Sequence[Tuple[int, str]], regex_worker: utils.RegexWorker) -> List[bool]:
+        results = []
+        # Only the answers to regular expression problems leave the process
+        regex_answers = []
+        for key, text in answers:
+            problem, text = self.problems[key], self.remove_punctuations.replace(text)
+            if problem.pattern is None:
+                results.append(text == problem.answer)
+            else:
+                results.append(None)
+                regex_answers.append((len(results) - 1, problem.pattern, text))
+        if regex_answers:
+            matched = await regex_worker.match_many([(pattern, text) for _index, pattern, text in regex_answers])
+            for (index, _pattern, _text), r in zip(regex_answers, matched):
+                results[index] = r
+        return results
 
-    async def get_origin(self, key: int) -> str:
-        return (await self._redis.get(f'{self._prefix}_OA_{key}')).decode()
+    async def check_answer(self, key: int, text: str, regex_worker: utils.RegexWorker) -> bool:
+        return (await self.check_answers([(key, text)], regex_worker))[0]
 
     @property
     def length(self) -> int:
-        return self.problem_length
+        return len(self.problems)
 
     @property
     def has_sample(self) -> bool:
-        return self._has_sample
+        return self.sample_problem is not None
 
-    async def get_sample(self) -> Optional[Mapping[str, str]]:
-        if not self._has_sample:
-            return None
-        return {'Q': (await self._redis.get(f'{self._prefix}_Q_sample')).decode(),
-                'A': (await self._redis.get(f'{self._prefix}_A_sample')).decode()}
+    def get_sample(self) -> Optional[Mapping[str, str]]:
+        return self.sample_problem
 
     @staticmethod
     def get_instance() -> ProblemSet:
@@ -167,20 +211,69 @@ class ProblemSet:
         return ProblemSet._self
 
     @staticmethod
-    async def init_instance(redis_conn: aioredis.Redis, problem_set: Dict[str, _problemT],
+    async def init_instance(redis_conn: Optional[aioredis.Redis], problem_set: Dict[str, _problemT],
                             remove_punctuations: RemovePunctuations) -> 'ProblemSet':
         ProblemSet._self = await ProblemSet.create(redis_conn, problem_set, remove_punctuations)
         return ProblemSet._self
 
 
 class JoinGroupVerify:
+    _LOAD_PASSED = utils.Statement(
+        'exam_user_session.load_passed', '''SELECT "user_id" FROM "exam_user_session" WHERE "passed" OR "bypass"''')
+    _QUERY_SESSION = utils.Statement(
+        'exam_user_session.query',
+        '''SELECT "problem_id", "problem_version", "baned", "bypass", "retries", "passed", "unlimited"
+        FROM "exam_user_session" WHERE "user_id" = $1''')
+    # The no-op update locks and returns the session of a concurrent /start, "xmax" is 0 only for a new row
+    _START_SESSION = utils.Statement(
+        'exam_user_session.start',
+        '''INSERT INTO "exam_user_session" ("user_id", "problem_version", "problem_id", "timestamp")
+        VALUES ($1, $3, $2, CURRENT_TIMESTAMP)
+        ON CONFLICT ("user_id") DO UPDATE SET "timestamp" = "exam_user_session"."timestamp"
+        RETURNING "problem_id", "problem_version", "baned", "bypass", "passed", "xmax" = 0 AS "created"''')
+    _SET_PASSED = utils.Statement(
+        'exam_user_session.set_passed', '''UPDATE "exam_user_session" SET "passed" = true WHERE "user_id" = $1''')
+    # $2 is whether the answer is right, $5 is max_retry. "bypass", "unlimited" and an accepted answer's "retries"
+    # are left as they were, so "accepted" tested on the updated row is the same as the test on the old one
+    _SUBMIT_ANSWER = utils.Statement(
+        'exam_user_session.submit_answer',
+        '''WITH "session" AS (
+            UPDATE "exam_user_session" SET
+                "passed" = "passed" OR (($2 OR "bypass") AND ("unlimited" OR "retries" <= $5)),
+                "retries" = CASE WHEN ($2 OR "bypass") AND ("unlimited" OR "retries" <= $5) THEN "retries"
+                            ELSE "retries" + 2 END
+            WHERE "user_id" = $1 AND "problem_id" = $3 AND "problem_version" = $4
+            RETURNING "retries", ($2 OR "bypass") AND ("unlimited" OR "retries" <= $5) AS "accepted",
+                NOT "unlimited" AND "retries" > $5 AS "exhausted"
+        ), "history" AS (
+            INSERT INTO "answer_history" ("user_id", "body")
+            SELECT $1, $6 FROM "session" WHERE NOT "accepted" AND "retries" <= $5 + 1
+        )
+        SELECT "retries", "accepted", "exhausted" FROM "session"''')
+    _COUNT_SESSION = utils.Statement('exam_user_session.count', '''SELECT COUNT(*) FROM "exam_user_session"''')
+    _COUNT_BY_PROBLEM = utils.Statement(
+        'exam_user_session.count_by_problem', '''SELECT COUNT(*) FROM "exam_user_session" WHERE "problem_id" = $1''')
+    _COUNT_PASSED_BY_PROBLEM = utils.Statement(
+        'exam_user_session.count_passed_by_problem',
+        '''SELECT COUNT(*) FROM "exam_user_session" WHERE "problem_id" = $1 and "passed" = true''')
 
     class ProblemVersionException(Exception):
         pass
 
-    def __init__(self, conn: utils.PgSQLdb, botapp: Client, target_group: int, working_group: int):
+    def __init__(self, conn: utils.PgSQLdb, botapp: Client, target_group: int, working_group: int,
+                 callbacks: utils.CallbackRouter, regex_timeout: float = 0.5, regex_workers: int = 2):
         self.conn: utils.PgSQLdb = conn
         self.botapp: Client = botapp
+        self.callbacks: utils.CallbackRouter = callbacks
+        self.regex_worker: utils.RegexWorker = utils.RegexWorker(regex_timeout, processes=regex_workers)
+        # Users that passed the exam or may bypass it, kept current by every write of those two columns
+        self.passed_users: Set[int] = set()
+        # user_id => (problem_id, problem_version) of sessions started or answered through this process, lets an
+        # answer go straight to _SUBMIT_ANSWER, which matches both columns again and misses if the session changed.
+        # Sessions out of retries are not kept, their answers are checked against the database before matching
+        self.sessions: OrderedDict[int, Tuple[int, int]] = OrderedDict()
+        self.max_sessions: int = 8192
+        self.member_status: utils.MemberStatusCache = utils.MemberStatusCache()
         self.target_group: int = target_group
         self.working_group: int = working_group
         self._revoke_tracker_coro: utils.InviteLinkTracker = None  # type: ignore
@@ -188,6 +281,7 @@ class JoinGroupVerify:
         self._welcome_msg: Optional[str] = None  # type: ignore
         self.remove_punctuations: Optional[RemovePunctuations] = None
         self.problems: Optional[ProblemSet] = None
+        self._redis: Optional[aioredis.Redis] = None
         self.max_retry: Optional[int] = None  # type: ignore
         self.max_retry_error: Optional[str] = None  # type: ignore
         self.max_retry_error_detail: Optional[str] = None  # type: ignore
@@ -196,8 +290,10 @@ class JoinGroupVerify:
         self._confirm_message: Optional[str] = None  # type: ignore
         self._confirm_button_text: Optional[str] = None  # type: ignore
 
-    def init(self) -> None:
-        self.botapp.add_handler(MessageHandler(self.handle_bot_private, filters.private & filters.text))
+    def init(self, dispatch: Callable[..., Callable[[Client, Message], Awaitable[None]]]) -> None:
+        # Through the dispatcher like the other bot handlers, the bot client has a single worker
+        self.botapp.add_handler(MessageHandler(dispatch(self.handle_bot_private), filters.private & filters.text))
+        self.callbacks.add(64, 'iamready', self.click_to_join)
 
     def init_other_object(self, problem_set: Dict[str, _anyT]):
         self._revoke_tracker_coro: utils.InviteLinkTracker = utils.InviteLinkTracker(
@@ -227,12 +323,17 @@ class JoinGroupVerify:
 
     @classmethod
     async def create(cls, conn: utils.PgSQLdb, botapp: Client, target_group: int, working_group: int,
-                     load_problem_set: Callable[[], Dict[str, _problemT]], redis_conn: aioredis.Redis):
-        self = JoinGroupVerify(conn, botapp, target_group, working_group)
+                     load_problem_set: Callable[[], Dict[str, _problemT]], redis_conn: aioredis.Redis,
+                     callbacks: utils.CallbackRouter, regex_timeout: float = 0.5, regex_workers: int = 2):
+        self = JoinGroupVerify(conn, botapp, target_group, working_group, callbacks, regex_timeout, regex_workers)
+        self._redis = redis_conn
         problem_set = load_problem_set()
         self.remove_punctuations = RemovePunctuations(
             **problem_set['configs'].get('ignore_punctuations', {'enable': False, 'items': []}))
         self.problems = await ProblemSet.init_instance(redis_conn, problem_set, self.remove_punctuations)
+        self.passed_users = {row['user_id'] for row in await self.conn.query(self._LOAD_PASSED)}
+        if any(problem.pattern is not None for problem in self.problems.problems):
+            self.regex_worker.start()
         self.init_other_object(problem_set)
         return self
 
@@ -242,38 +343,77 @@ class JoinGroupVerify:
             raise RuntimeError()
         return self.problems
 
+    async def reload_problem_set(self, problem_set: Dict[str, _problemT]) -> bool:
+        try:
+            remove_punctuations = RemovePunctuations(
+                **problem_set['configs'].get('ignore_punctuations', {'enable': False, 'items': []}))
+            problems = ProblemSet(problem_set, remove_punctuations, self._redis)
+        except (KeyError, TypeError, ValueError, re.error):
+            logger.exception('Invalid problem set, keep version %d', self.problems.version)
+            return False
+        if problems.version == self.problems.version and (problems.problems != self.problems.problems or
+                                                          problems.sample_problem != self.problems.sample_problem):
+            # Open sessions only remember the problem index and version, they would be checked against other answers
+            logger.error('Problems changed without a new version, keep version %d', self.problems.version)
+            return False
+        try:
+            await problems.publish()
+        except:
+            logger.exception('Publish problem set to redis failure')
+        # Handlers read self.problems once and keep using that instance, so they never mix two versions
+        old_problems, self.problems, self.remove_punctuations = self.problems, problems, remove_punctuations
+        ProblemSet._self = problems
+        await old_problems.destroy()
+        logger.info('Problem set reloaded, version %d -> %d, %d problem(s)', old_problems.version, problems.version,
+                    problems.length)
+        return True
+
     @property
     def revoke_tracker_coro(self) -> utils.InviteLinkTracker:
         return self._revoke_tracker_coro
 
-    async def query_user_passed(self, user_id: int) -> bool:
-        sql_obj = await self.conn.query1('''SELECT "passed", "bypass" FROM "exam_user_session" WHERE "user_id" = $1''',
-                                         user_id)
-        return sql_obj is not None and (sql_obj['passed'] or sql_obj['bypass'])
+    def is_passed(self, user_id: int) -> bool:
+        return user_id in self.passed_users
+
+    def remember_session(self, user_id: int, problem_id: int, problem_version: int) -> None:
+        self.sessions.pop(user_id, None)
+        self.sessions[user_id] = (problem_id, problem_version)
+        while len(self.sessions) > self.max_sessions:
+            self.sessions.popitem(last=False)
+
+    def update_passed(self, user_id: int, passed: bool) -> None:
+        if passed:
+            self.passed_users.add(user_id)
+        else:
+            self.passed_users.discard(user_id)
+
+    async def get_member_status(self, user_id: int) -> str:
+        # Leave messages are not always delivered, so a cached 'member' may be stale and only a cached 'left' is
+        # trusted; that one only lets the user through, anything else is asked from Telegram
+        if self.member_status.get(user_id) == 'left':
+            return 'left'
+        try:
+            status = (await self.botapp.get_chat_member(self.target_group, user_id)).status
+        except pyrogram.errors.exceptions.bad_request_400.UserNotParticipant:
+            status = 'left'
+        self.member_status.put(user_id, status)
+        return status
 
     async def handle_bot_private(self, client: Client, msg: Message) -> None:
         if msg.text.startswith('/') and msg.text != '/start newbie':
             return
-        user_obj = await self.conn.query1(
-            '''SELECT "problem_id", "problem_version", "baned", "bypass", "retries", "passed", "unlimited" 
-            FROM "exam_user_session" WHERE "user_id" = $1''',
-            msg.chat.id)
+        problems = self.problems
         if msg.text == '/start newbie':
             try:
                 try:
-                    # raise Exception
-                    user = await self.botapp.get_chat_member(self.target_group, msg.chat.id)
-                    # print(user.status)
-                    # if user.status in ('member', 'administrator', 'creator', 'restricted'):
-                    if user.status == 'left':
-                        raise ValueError('left')
-                    await msg.reply(_T('You are already in the group.'))
-                    return
-                except pyrogram.errors.exceptions.bad_request_400.UserNotParticipant:
-                    pass
+                    if await self.get_member_status(msg.chat.id) != 'left':
+                        await msg.reply(_T('You are already in the group.'))
+                        return
                 except:
                     logger.exception('Exception occurred while checking user status')
-                if user_obj is not None:
+                random_id = problems.get_random_number()
+                user_obj = await self.conn.query1(self._START_SESSION, msg.chat.id, random_id, problems.version)
+                if not user_obj['created']:
                     if user_obj['bypass']:
                         await self._revoke_tracker_coro.send_link(msg.chat.id, True)
                     elif user_obj['passed']:
@@ -283,13 +423,7 @@ class JoinGroupVerify:
                     else:
                         await msg.reply(_T('An existing session is currently active.'), True)
                 else:
-                    random_id = self.problems.get_random_number()
-
-                    # Query user status
-                    await self.conn.execute(
-                        '''INSERT INTO "exam_user_session" ("user_id", "problem_version", "problem_id", "timestamp")
-                        VALUES ($1, $3, $2, CURRENT_TIMESTAMP)''',
-                        msg.chat.id, random_id, self.problems.version)
+                    self.remember_session(msg.chat.id, random_id, problems.version)
                     await msg.reply(
                         self._welcome_msg,
                         parse_mode='html',
@@ -298,10 +432,10 @@ class JoinGroupVerify:
                     )
 
                     # Send sample problem
-                    if self.problems.has_sample:
+                    if problems.has_sample:
                         await msg.reply(
                             _T('For example:\n</b> <code>{Q}</code>\n<b>A:</b> <code>{A}</code>').format(
-                                **await self.problems.get_sample()
+                                **problems.get_sample()
                             ),
                             parse_mode='html',
                             disable_web_page_preview=True
@@ -309,7 +443,7 @@ class JoinGroupVerify:
 
                     # Send problem body
                     await msg.reply(
-                        (await self.problems.get(random_id))['Q'],
+                        problems.get(random_id).question,
                         # self.problem_set['problems']['problem_set'][random_id]['Q'],
                         parse_mode='html',
                         disable_web_page_preview=True
@@ -325,70 +459,81 @@ class JoinGroupVerify:
             except:
                 logger.exception('Unexpect exception occurred in check newbie function')
         else:
+            await self.handle_answer(msg, problems)
+
+    async def handle_answer(self, msg: Message, problems: ProblemSet) -> None:
+        session = self.sessions.get(msg.chat.id)
+        if session is None or session[1] != problems.version:
+            user_obj = await self.conn.query1(self._QUERY_SESSION, msg.chat.id)
             if user_obj is None:
                 return
-            if user_obj['problem_version'] != self.problems.version:
+            if user_obj['problem_version'] != problems.version:
                 await msg.reply(_T('Problem version updated, please request new problem by submitting a ticket.'))
                 return
-            if user_obj['unlimited'] or user_obj['retries'] <= self.max_retry:
-                if self.valid_answer(msg, await self.problems.get(user_obj['problem_id'])):
-                    await self.conn.execute('''UPDATE "exam_user_session" SET "passed" = true WHERE "user_id" = $1''',
-                                            msg.chat.id)
-                    await self.send_link(msg)
-                    return
-                elif user_obj['bypass']:  # and user_obj['passed']:
-                    await self.conn.execute('''UPDATE "exam_user_session" SET "passed" = true WHERE "user_id" = $1''',
-                                            msg.chat.id)
-                    await self.send_link(msg)
-                    return
-            retries = user_obj['retries'] + 2
-            if retries > self.max_retry:
-                if retries == self.max_retry + 1:
-                    await msg.reply(
-                        '\n\n'.join((self.max_retry_error, self.max_retry_error_detail)),
-                        parse_mode='html', disable_web_page_preview=True
-                    )
-                    logger.debug('%d %s', msg.chat.id, repr(msg.text))
-                    await self._insert_answer_history(msg)
-                else:
-                    await msg.reply(self.max_retry_error_detail, parse_mode='html',
-                                    disable_web_page_preview=True)
-            else:
-                await msg.reply(self.try_again, parse_mode='html', disable_web_page_preview=True)
+            session = (user_obj['problem_id'], user_obj['problem_version'])
+            # Nothing can be accepted any more, so a hostile answer is not even matched
+            exhausted = not user_obj['unlimited'] and user_obj['retries'] > self.max_retry
+            if not exhausted:
+                self.remember_session(msg.chat.id, *session)
+            cached = False
+        else:
+            exhausted = False
+            cached = True
+        r = await self.conn.query1(self._SUBMIT_ANSWER, msg.chat.id,
+                                   not exhausted and await self.valid_answer(msg, problems, session[0]), session[0],
+                                   session[1], self.max_retry, msg.text[:200])
+        if r is None:
+            # Deleted or renewed since it was remembered
+            self.sessions.pop(msg.chat.id, None)
+            if cached:
+                await self.handle_answer(msg, problems)
+            return
+        if r['accepted']:
+            self.sessions.pop(msg.chat.id, None)
+            self.update_passed(msg.chat.id, True)
+            await self.send_link(msg)
+            return
+        if r['exhausted']:
+            self.sessions.pop(msg.chat.id, None)
+        retries = r['retries']
+        if retries > self.max_retry:
+            if retries == self.max_retry + 1:
+                await msg.reply(
+                    '\n\n'.join((self.max_retry_error, self.max_retry_error_detail)),
+                    parse_mode='html', disable_web_page_preview=True
+                )
                 logger.debug('%d %s', msg.chat.id, repr(msg.text))
-                await self._insert_answer_history(msg)
-            await self.conn.execute('''UPDATE "exam_user_session" SET "retries" = $1 WHERE "user_id" = $2''',
-                                    retries, msg.chat.id)
-
-    async def _insert_answer_history(self, msg: Message) -> None:
-        await self.conn.execute('''INSERT INTO "answer_history" ("user_id", "body") VALUES ($1, $2)''',
-                                msg.chat.id, msg.text[:200])
+            else:
+                await msg.reply(self.max_retry_error_detail, parse_mode='html',
+                                disable_web_page_preview=True)
+        else:
+            await msg.reply(self.try_again, parse_mode='html', disable_web_page_preview=True)
+            logger.debug('%d %s', msg.chat.id, repr(msg.text))
 
     async def check_joined_group(self, user_id: int) -> None:
         logger.debug('Track %d status', user_id)
         await asyncio.sleep(30)  # Wait up to 30 second
+        # Always asked from Telegram, a user who joined and left again may still be cached as a member
         try:
-            await self.botapp.get_chat_member(self.target_group, user_id)
+            self.member_status.put(user_id, (await self.botapp.get_chat_member(self.target_group, user_id)).status)
         except pyrogram.errors.exceptions.bad_request_400.UserNotParticipant:
+            self.member_status.put(user_id, 'left')
             await self.conn.insert_user_to_banlist(user_id)
             await self.botapp.send_message(self.working_group, 'Baned not joined group user {}'.format(
                 TextParser.parse_user_markdown(user_id)), 'markdown')
             logger.info('Baned not joined group user %d', user_id)
 
-    async def click_to_join(self, client: Client, msg: CallbackQuery) -> bool:
-        if msg.data == 'iamready':
-            if not await self.query_user_passed(msg.message.chat.id):
-                await msg.answer(_T('Function is not ready, please try again later.'), True)
-                logger.warning('User clicked but function is not ready during request link')
-            else:
-                try:
-                    await client.edit_message_reply_markup(msg.message.chat.id, msg.message.message_id)
-                    await self._revoke_tracker_coro.send_link(msg.message.chat.id, True)
-                    await msg.answer()
-                except:
-                    logger.exception('Exception occurred on process click function')
-            return True
-        return False
+    async def click_to_join(self, client: Client, msg: CallbackQuery) -> None:
+        if not self.is_passed(msg.message.chat.id):
+            await msg.answer(_T('Function is not ready, please try again later.'), True)
+            logger.warning('User clicked but function is not ready during request link')
+        else:
+            try:
+                await client.edit_message_reply_markup(msg.message.chat.id, msg.message.message_id)
+                await self._revoke_tracker_coro.send_link(msg.message.chat.id, True)
+                await msg.answer()
+            except:
+                logger.exception('Exception occurred on process click function')
 
     async def send_link(self, msg: Message, from_ticket: bool = False) -> None:
         if self._send_link_confirm:
@@ -396,7 +541,8 @@ class JoinGroupVerify:
                 text=self._confirm_message,
                 parse_mode='html',
                 reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text=self._confirm_button_text, callback_data='iamready')]
+                    [InlineKeyboardButton(text=self._confirm_button_text,
+                                          callback_data=self.callbacks.encode('iamready'))]
                 ])
             )
             if isinstance(msg, int):
@@ -407,13 +553,9 @@ class JoinGroupVerify:
         else:
             await self._revoke_tracker_coro.send_link(msg.chat.id, from_ticket)
 
-    def valid_answer(self, msg: Message, problem_body: Dict[str, str]) -> bool:
-        text = self.remove_punctuations.replace(msg.text)
-        if problem_body.get('use_regular_expression', False):
-            b = bool(re.match(problem_body['A'], text))
-        else:
-            b = text == problem_body['A']
-        logger.debug('verify %s %s == %s', b, text, problem_body['A'])
+    async def valid_answer(self, msg: Message, problems: ProblemSet, problem_id: int) -> bool:
+        b = await problems.check_answer(problem_id, msg.text, self.regex_worker)
+        logger.debug('verify %s %s == %s', b, msg.text, problems.get(problem_id).answer)
         return b
 
 
@@ -424,8 +566,80 @@ class CustomServiceBot:
     SEND_FINISH = 3
     RE_TICKET_ID = re.compile(r'[a-f\d]{32}')
 
+    _INSERT_TICKET = utils.Statement(
+        'tickets.insert',
+        '''INSERT INTO "tickets" ("user_id", "hash", "timestamp", "origin_msg", "section", "status")
+        VALUES ($1, $2, CURRENT_TIMESTAMP, $3, $4, $5)''')
+    _LIST_TICKETS = utils.Statement(
+        'tickets.list',
+        '''SELECT "hash", "status" FROM "tickets" WHERE "user_id" = $1 ORDER BY "timestamp" DESC LIMIT 3''')
+    _QUERY_TICKET = utils.Statement('tickets.by_hash', '''SELECT * FROM "tickets" WHERE "hash" = $1''')
+    _QUERY_TICKET_SECTION = utils.Statement(
+        'tickets.section_by_hash', '''SELECT "user_id", "section" FROM "tickets" WHERE "hash" = $1''')
+    _QUERY_TICKET_STATUS = utils.Statement(
+        'tickets.status_by_hash', '''SELECT "user_id", "status" FROM "tickets" WHERE "hash" = $1''')
+    _QUERY_TICKET_BY_USER = utils.Statement(
+        'tickets.by_hash_user',
+        '''SELECT "status", "section" FROM "tickets" WHERE "hash" = $1 AND "user_id" = $2''')
+    _QUERY_UNCLOSED_TICKET = utils.Statement(
+        'tickets.unclosed_by_hash', '''SELECT "user_id" FROM "tickets" WHERE "hash" = $1 AND "status" != 'closed' ''')
+    _QUERY_OPEN_TICKET = utils.Statement(
+        'tickets.open_by_user',
+        '''SELECT "hash" FROM "tickets" WHERE "user_id" = $1 AND "status" = 'open' LIMIT 1''')
+    _CLOSE_TICKET = utils.Statement(
+        'tickets.close', '''UPDATE "tickets" SET "status" = 'closed' WHERE "hash" = $1''')
+    _CLOSE_USER_TICKET = utils.Statement(
+        'tickets.close_by_user', '''UPDATE "tickets" SET "status" = 'closed' WHERE "user_id" = $1 AND "hash" = $2''')
+    _INSERT_TICKET_USER = utils.Statement(
+        'tickets_user.insert',
+        '''INSERT INTO "tickets_user" ("user_id", "create_time", "step") VALUES ($1, CURRENT_TIMESTAMP, $2)''')
+    _QUERY_TICKET_USER = utils.Statement(
+        'tickets_user.exists', '''SELECT "user_id" FROM "tickets_user" WHERE "user_id" = $1''')
+    _QUERY_STATUS = utils.Statement(
+        'tickets_user.query', '''SELECT "step", "section" FROM "tickets_user" WHERE "user_id" = $1''')
+    _QUERY_SECTION = utils.Statement(
+        'tickets_user.section', '''SELECT "section" FROM "tickets_user" WHERE "user_id" = $1''')
+    _QUERY_LAST_MSG_SENT = utils.Statement(
+        'tickets_user.last_msg_sent', '''SELECT "last_msg_sent" FROM "tickets_user" WHERE "user_id" = $1''')
+    _QUERY_BANNED = utils.Statement(
+        'tickets_user.banned', '''SELECT "banned" FROM "tickets_user" WHERE "user_id" = $1''')
+    _SET_STEP = utils.Statement(
+        'tickets_user.set_step', '''UPDATE "tickets_user" SET "step" = $1 WHERE "user_id" = $2''')
+    _SET_STEP_SECTION = utils.Statement(
+        'tickets_user.set_step_section',
+        '''UPDATE "tickets_user" SET "step" = $1, "section" = $2 WHERE "user_id" = $3''')
+    _SET_SECTION = utils.Statement(
+        'tickets_user.set_section', '''UPDATE "tickets_user" SET "section" = $1 WHERE "user_id" = $2''')
+    _BAN_TICKET_USER = utils.Statement(
+        'tickets_user.ban', '''UPDATE "tickets_user" SET "banned" = true WHERE "user_id" = $1''')
+    _UNBAN_TICKET_USER = utils.Statement(
+        'tickets_user.unban', '''UPDATE "tickets_user" SET "banned" = false WHERE "user_id" = $1''')
+    _QUERY_EXAM_STATUS = utils.Statement(
+        'exam_user_session.status',
+        '''SELECT "problem_id", "baned", "bypass", "passed", "unlimited", "retries"
+        FROM "exam_user_session" WHERE "user_id" = $1''')
+    _RESET_RETRIES = utils.Statement(
+        'exam_user_session.reset_retries', '''UPDATE "exam_user_session" SET "retries" = 0 WHERE "user_id" = $1''')
+    _SET_BYPASS = utils.Statement(
+        'exam_user_session.set_bypass', '''UPDATE "exam_user_session" SET "bypass" = true WHERE "user_id" = $1''')
+    _SET_UNLIMITED = utils.Statement(
+        'exam_user_session.set_unlimited',
+        '''UPDATE "exam_user_session" SET "unlimited" = true WHERE "user_id" = $1''')
+    _DELETE_SESSION = utils.Statement(
+        'exam_user_session.delete', '''DELETE FROM "exam_user_session" WHERE "user_id" = $1''')
+    _INSERT_BYPASS_SESSION = utils.Statement(
+        'exam_user_session.insert_bypass',
+        '''INSERT INTO "exam_user_session" ("user_id", "problem_id") VALUES ($1, 2)''')
+    _RECENT_ANSWER_HISTORY = utils.Statement(
+        'answer_history.recent',
+        '''SELECT "body", "timestamp" FROM "answer_history" WHERE "user_id" = $1 ORDER BY "id" DESC LIMIT 3''')
+    _COUNT_ANSWER_HISTORY = utils.Statement(
+        'answer_history.count', '''SELECT COUNT(*) FROM "answer_history" WHERE "user_id" = $1''')
+
     def __init__(self, config_file: Union[str, ConfigParser], pgsql_handle: utils.PgSQLdb,
-                 send_link_callback: Optional[Callable[[Message, bool], Awaitable]], redis_conn: aioredis.Redis):
+                 send_link_callback: Optional[Callable[[Message, bool], Awaitable]], redis_conn: aioredis.Redis,
+                 send_scheduler: Optional[utils.SendScheduler] = None,
+                 join_group_verify: Optional[JoinGroupVerify] = None):
 
         if isinstance(config_file, ConfigParser):
             config = config_file
@@ -436,21 +650,25 @@ class CustomServiceBot:
         self.pgsqldb: utils.PgSQLdb = pgsql_handle
         self._redis: aioredis.Redis = redis_conn
         self.bot_id: int = int(config['custom_service']['custom_api_key'].split(':')[0])
-        self.bot: Client = Client(
+        self.bot: Client = utils.ScheduledClient(
             session_name=str(self.bot_id),
             bot_token=config['custom_service']['custom_api_key'],
             api_id=config['account']['api_id'],
-            api_hash=config['account']['api_hash']
+            api_hash=config['account']['api_hash'],
+            scheduler=send_scheduler
         )
 
         self.help_group: int = config.getint('custom_service', 'help_group')
         self.send_link_callback: Optional[Callable[[Message, bool], Awaitable]] = send_link_callback
+        self.join_group_verify: Optional[JoinGroupVerify] = join_group_verify
 
         self.SECTION: List[str] = [
             _T("VERIFICATION"),
             _T("OTHER")
         ]
 
+        self.callbacks: utils.CallbackRouter = utils.CallbackRouter()
+        self.init_callbacks()
         self.init_handle()
 
     def init_handle(self) -> None:
@@ -505,13 +723,12 @@ class CustomServiceBot:
             [KeyboardButton(text=x)] for x in self.SECTION
         ], resize_keyboard=True, one_time_keyboard=True)
 
-    @staticmethod
-    def generate_ticket_keyboard(ticket_id: str, user_id: int, closed: bool = False,
+    def generate_ticket_keyboard(self, ticket_id: str, user_id: int, closed: bool = False,
                                  other: bool = False) -> InlineKeyboardMarkup:
         kb = [
-            InlineKeyboardButton(text=_T('Close'), callback_data=f'close {ticket_id}'),
-            InlineKeyboardButton(text=_T('Send link'), callback_data=f'send {user_id}'),
-            InlineKeyboardButton(text=_T('Block'), callback_data=f'block {user_id}')
+            InlineKeyboardButton(text=_T('Close'), callback_data=self.callbacks.encode('close', ticket_id)),
+            InlineKeyboardButton(text=_T('Send link'), callback_data=self.callbacks.encode('send', user_id)),
+            InlineKeyboardButton(text=_T('Block'), callback_data=self.callbacks.encode('block', user_id))
         ]
         if closed:
             kb = kb[2:]
@@ -526,9 +743,7 @@ class CustomServiceBot:
         return '\u2705' if i else '\u274c'
 
     async def handle_list(self, _client: Client, msg: Message) -> None:
-        q = [dict(x) for x in (await self.pgsqldb.query(
-            '''SELECT "hash", "status" FROM "tickets" WHERE "user_id" = $1 ORDER BY "timestamp" DESC LIMIT 3''',
-            msg.chat.id))]
+        q = [dict(x) for x in (await self.pgsqldb.query(self._LIST_TICKETS, msg.chat.id))]
         if not q:
             await msg.reply(_T('You have never used this system before.'), True)
             return
@@ -558,8 +773,7 @@ class CustomServiceBot:
             if len(ticket_id) != 32:
                 await msg.reply(_T('ERROR: TICKET NUMBER FORMAT'), True)
                 return
-        q = await self.pgsqldb.query1('''SELECT "user_id" FROM "tickets" WHERE "hash" = $1 AND "status" != 'closed' ''',
-                                      ticket_id)
+        q = await self.pgsqldb.query1(self._QUERY_UNCLOSED_TICKET, ticket_id)
         if q is None:
             await msg.reply(_T('TICKET NUMBER NOT FOUND or TICKET CLOSED'), True)
             return
@@ -569,8 +783,7 @@ class CustomServiceBot:
                 'If this ticket is indeed created by yourself, please report the problem using the same ticket.)'),
                 True)
             return
-        await self.pgsqldb.execute('''UPDATE "tickets" SET "status" = 'closed' WHERE "user_id" = $1 AND "hash" = $2''',
-                                   msg.chat.id, ticket_id)
+        await self.pgsqldb.execute(self._CLOSE_USER_TICKET, msg.chat.id, ticket_id)
         await self._update_last_time(msg)
         await client.send_message(self.help_group,
                                   _T('UPDATE\n[ #{} ]\nThis ticket is already closed by {}').format(
@@ -580,37 +793,28 @@ class CustomServiceBot:
         await msg.reply(_T('Close ticket success.'), True)
 
     async def add_user(self, user_id: int, step: int = 0) -> None:
-        await self.pgsqldb.execute(
-            '''INSERT INTO "tickets_user" ("user_id", "create_time", "step") VALUES ($1, CURRENT_TIMESTAMP, $2)''',
-            user_id, step)
+        await self.pgsqldb.execute(self._INSERT_TICKET_USER, user_id, step)
 
     async def change_step(self, user_id: int, step: int, section: str = '') -> None:
         if section == '':
-            await self.pgsqldb.execute('''UPDATE "tickets_user" SET "step" = $1 WHERE "user_id" = $2''', step, user_id)
+            await self.pgsqldb.execute(self._SET_STEP, step, user_id)
         else:
-            await self.pgsqldb.execute('''UPDATE "tickets_user" SET "step" = $1, "section" = $2 WHERE "user_id" = $3''',
-                                       step, section, user_id)
+            await self.pgsqldb.execute(self._SET_STEP_SECTION, step, section, user_id)
 
     async def query_status(self, user_id: int) -> Optional[asyncpg.Record]:
-        return await self.pgsqldb.query1('''SELECT "step", "section" FROM "tickets_user" WHERE "user_id" = $1''',
-                                         user_id)
+        return await self.pgsqldb.query1(self._QUERY_STATUS, user_id)
 
     async def query_user(self, user_id: int) -> Optional[asyncpg.Record]:
-        return await self.pgsqldb.query1('''SELECT "section" FROM "tickets_user" WHERE "user_id" = $1''', user_id)
+        return await self.pgsqldb.query1(self._QUERY_SECTION, user_id)
 
     async def set_section(self, user_id: int, section: str) -> None:
-        await self.pgsqldb.execute('''UPDATE "tickets_user" SET "section" = $1 WHERE "user_id" = $2''', section,
-                                   user_id)
+        await self.pgsqldb.execute(self._SET_SECTION, section, user_id)
 
     async def query_user_exam_status(self, user_id: int) -> Optional[asyncpg.Record]:
-        return await self.pgsqldb.query1(
-            '''SELECT "problem_id", "baned", "bypass", "passed", "unlimited", "retries"
-             FROM "exam_user_session" WHERE "user_id" = $1''',
-            user_id)
+        return await self.pgsqldb.query1(self._QUERY_EXAM_STATUS, user_id)
 
     async def handle_start(self, _client: Client, msg: Message) -> None:
-        q = await self.pgsqldb.query1('''SELECT "last_msg_sent" FROM "tickets_user" WHERE "user_id" = $1''',
-                                      msg.chat.id)
+        q = await self.pgsqldb.query1(self._QUERY_LAST_MSG_SENT, msg.chat.id)
         await msg.reply(_T(
             'Welcome to Google Hosts Telegram Ticket System\n\n'
             'ATTENTION:PLEASE DO NOT ABUSE THIS SYSTEM. Otherwise there is a possibility of getting blocked.\n\n'
@@ -625,14 +829,11 @@ class CustomServiceBot:
     async def handle_create(self, client: Client, msg: Message) -> None:
         if await self.flood_check(client, msg):
             return
-        q = await self.pgsqldb.query1(
-            '''SELECT "hash" FROM "tickets" WHERE "user_id" = $1 AND "status" = 'open' LIMIT 1''',
-            msg.chat.id)
+        q = await self.pgsqldb.query1(self._QUERY_OPEN_TICKET, msg.chat.id)
         if q:
             await msg.reply(_T('UNABLE TO CREATE A NEW TICKET: An existing ticket is currently open.'), True)
             return
-        sql_obj = await self.pgsqldb.query1('''SELECT "user_id" FROM "tickets_user" WHERE "user_id" = $1''',
-                                            msg.chat.id)
+        sql_obj = await self.pgsqldb.query1(self._QUERY_TICKET_USER, msg.chat.id)
         await (self.add_user if sql_obj is None else self.change_step)(msg.chat.id, CustomServiceBot.SELECT_SECTION)
         await msg.reply(_T('You are creating a new ticket.\n\nPlease choose the correct department.'), True,
                         reply_markup=self.generate_section_pad())
@@ -649,9 +850,7 @@ class CustomServiceBot:
         except ValueError:
             return
         # print(self.get_hash_from_reply_msg(msg))
-        sql_obj = await self.pgsqldb.query1(
-            '''SELECT "status", "section" FROM "tickets" WHERE "hash" = $1 AND "user_id" = $2''',
-            ticket_hash, msg.chat.id)
+        sql_obj = await self.pgsqldb.query1(self._QUERY_TICKET_BY_USER, ticket_hash, msg.chat.id)
         if sql_obj is None or sql_obj['status'] == 'closed':
             await msg.reply(_T('TICKET NUMBER NOT FOUND or TICKET CLOSED. REPLY FUNCTION NO LONGER AVAILABLE.'), True)
             return
@@ -689,14 +888,15 @@ class CustomServiceBot:
                                 True)
                 return
             ticket_hash = self.hash_msg(msg)
-            await self.pgsqldb.execute(*Ticket(msg, sql_obj['section'], 'open').sql)
+            ticket = Ticket(msg, sql_obj['section'], 'open')
+            await self.pgsqldb.execute(*ticket.sql)
             await self.change_step(msg.chat.id, CustomServiceBot.INIT_STATUS)
             await msg.reply(
                 _T(
                     'The ticket is created successfully!\n[ #{ticket_id} ]\nDepartment: {section}\n'
                     'Message: \n{text}\n\nReply to this message to add a new reply to the ticket.').format(
                     ticket_id=ticket_hash,
-                    text=TextParser(msg).parsed_msg,
+                    text=ticket.origin_msg,
                     section=sql_obj['section']
                 ),
                 parse_mode='html'
@@ -707,7 +907,7 @@ class CustomServiceBot:
                     ticket_hash,
                     TextParser.parse_user_html(msg.chat.id, _T('Here')),
                     sql_obj['section'],
-                    TextParser(msg).parsed_msg
+                    ticket.origin_msg
                 ),
                 'html',
                 reply_markup=self.generate_ticket_keyboard(
@@ -728,18 +928,16 @@ class CustomServiceBot:
 
     @staticmethod
     async def generate_question_and_answer(user_session: asyncpg.Record) -> str:
-        _text = 'Question: <code>{Q}</code>\n{question_type} Answer: <code>{A}</code>'.format(
-            **await ProblemSet.get_instance().get(user_session['problem_id']),
-            question_type='Except' if ProblemSet.get_instance().remove_punctuations.enable else 'Standard')
-        if ProblemSet.get_instance().remove_punctuations.enable:
-            _text += f'\nStandard Answer: <code>' \
-                     f'{await ProblemSet.get_instance().get_origin(user_session["problem_id"])}</code>'
+        problems = ProblemSet.get_instance()
+        problem = problems.get(user_session['problem_id'])
+        _text = 'Question: <code>{}</code>\n{} Answer: <code>{}</code>'.format(
+            problem.question, 'Except' if problems.remove_punctuations.enable else 'Standard', problem.answer)
+        if problems.remove_punctuations.enable:
+            _text += f'\nStandard Answer: <code>{problem.origin_answer}</code>'
         return _text
 
     async def __generate_answer_history(self, user_id: int) -> str:
-        sql_obj = await self.pgsqldb.query(
-            '''SELECT "body", "timestamp" FROM "answer_history" WHERE "user_id" = $1 ORDER BY "id" DESC LIMIT 3''',
-            user_id)
+        sql_obj = await self.pgsqldb.query(self._RECENT_ANSWER_HISTORY, user_id)
         if sql_obj is None:
             return 'QUERY ERROR (user_id => %d)' % user_id
         if ProblemSet.get_instance().remove_punctuations.enable:
@@ -749,8 +947,7 @@ class CustomServiceBot:
         return '\n\n'.join(f'<code>{x["timestamp"]}</code> <pre>{x["body"]}</pre>' for x in sql_obj)
 
     async def _generate_answer_history(self, user_id: int, retries: int) -> str:
-        sql_obj = await self.pgsqldb.query1('''SELECT COUNT(*) FROM "answer_history" WHERE "user_id" = $1''',
-                                            user_id)
+        sql_obj = await self.pgsqldb.query1(self._COUNT_ANSWER_HISTORY, user_id)
         if retries > 0 or sql_obj['count'] > 0:
             return '\n\nAnswer History:\n{}'.format(await self.__generate_answer_history(user_id))
         return ''
@@ -758,11 +955,8 @@ class CustomServiceBot:
     async def generate_question_rate(self, user_session: Mapping[str, int]) -> str:
         problem_id = user_session['problem_id']
         total_count = (
-            await self.pgsqldb.query1('''SELECT COUNT(*) FROM "exam_user_session" WHERE "problem_id" = $1''',
-                                      problem_id))['count']
-        correct_count = (await self.pgsqldb.query1(
-            '''SELECT COUNT(*) FROM "exam_user_session" WHERE "problem_id" = $1 and "passed" = true''',
-            problem_id))['count']
+            await self.pgsqldb.query1(JoinGroupVerify._COUNT_BY_PROBLEM, problem_id))['count']
+        correct_count = (await self.pgsqldb.query1(JoinGroupVerify._COUNT_PASSED_BY_PROBLEM, problem_id))['count']
         rate = (correct_count / total_count) * 100
         return '\n\nProblem {} correct rate: {:.2f}%'.format(problem_id, rate)
 
@@ -794,7 +988,7 @@ class CustomServiceBot:
             ticket_hash = self.get_hash_from_reply_msg(msg)
         except ValueError:
             return
-        sql_obj = await self.pgsqldb.query1('''SELECT * FROM "tickets" WHERE "hash" = $1''', ticket_hash)
+        sql_obj = await self.pgsqldb.query1(self._QUERY_TICKET, ticket_hash)
         if sql_obj is None:
             await msg.reply(_T('ERROR: TICKET NOT FOUND'))
             return
@@ -812,8 +1006,8 @@ class CustomServiceBot:
                             reply_markup=InlineKeyboardMarkup(inline_keyboard=[
                                 [
                                     InlineKeyboardButton(text=_T('recall'),
-                                                         callback_data=f'del '
-                                                                       f'{msg_reply.chat.id} {msg_reply.message_id}')
+                                                         callback_data=self.callbacks.encode(
+                                                             'del', msg_reply.chat.id, msg_reply.message_id))
                                 ]
                             ]))
             r = await self._query_last_time(msg)
@@ -828,16 +1022,11 @@ class CustomServiceBot:
                                                                                   -1]))
             raise
 
-    @staticmethod
-    def generate_confirm_keyboard(first: str, last: Union[str, Sequence[str]]) -> InlineKeyboardMarkup:
-        if isinstance(last, list) or isinstance(last, tuple):
-            lastg = last
-        else:
-            lastg = (str(last),)
+    def generate_confirm_keyboard(self, action: str, *args: Union[int, str]) -> InlineKeyboardMarkup:
         return InlineKeyboardMarkup(inline_keyboard=[
             [
-                InlineKeyboardButton(text='Yes', callback_data=' '.join((first, 'confirm', *lastg))),
-                InlineKeyboardButton(text='No', callback_data='cancel')
+                InlineKeyboardButton(text='Yes', callback_data=self.callbacks.encode(action, *args)),
+                InlineKeyboardButton(text='No', callback_data=self.callbacks.encode('cancel'))
             ]
         ])
 
@@ -847,27 +1036,29 @@ class CustomServiceBot:
              ' '.join((_T('Last refresh:'), str(datetime.now().replace(microsecond=0))))))
 
     async def generate_superuser_detail(self, user_id: Union[str, int]) -> Dict[str, _anyT]:
+        encode = self.callbacks.encode
+        user_id = int(user_id)
         return {
             'text': await self.generate_superuser_text(user_id),
             'reply_markup': InlineKeyboardMarkup(
                 inline_keyboard=[
                     [
-                        InlineKeyboardButton(text=_T('BYPASS'), callback_data=f'bypass {user_id}'),
-                        InlineKeyboardButton(text=_T('UNLIMITED RETRIES'), callback_data=f'unlimited {user_id}'),
-                        InlineKeyboardButton(text=_T('REFRESH'), callback_data=f'refresh {user_id}')
+                        InlineKeyboardButton(text=_T('BYPASS'), callback_data=encode('bypass', user_id)),
+                        InlineKeyboardButton(text=_T('UNLIMITED RETRIES'), callback_data=encode('unlimited', user_id)),
+                        InlineKeyboardButton(text=_T('REFRESH'), callback_data=encode('refresh', user_id))
                     ],
                     [
-                        InlineKeyboardButton(text=_T('PASS'), callback_data=f'setpass {user_id}'),
-                        InlineKeyboardButton(text=_T('RESET TIMES'), callback_data=f'reset {user_id}')
+                        InlineKeyboardButton(text=_T('PASS'), callback_data=encode('setpass', user_id)),
+                        InlineKeyboardButton(text=_T('RESET TIMES'), callback_data=encode('reset', user_id))
                     ],
                     [
-                        InlineKeyboardButton(text=_T('RESET USER STATUS'), callback_data=f'renew {user_id}')
+                        InlineKeyboardButton(text=_T('RESET USER STATUS'), callback_data=encode('renew', user_id))
                     ],
                     [
-                        InlineKeyboardButton(text='INSERT USER PROFILE', callback_data=f'insert {user_id}')
+                        InlineKeyboardButton(text='INSERT USER PROFILE', callback_data=encode('insert', user_id))
                     ],
                     [
-                        InlineKeyboardButton(text=_T('Cancel'), callback_data='cancel')
+                        InlineKeyboardButton(text=_T('Cancel'), callback_data=encode('cancel'))
                     ]
                 ]
             )
@@ -888,178 +1079,171 @@ class CustomServiceBot:
         )
 
     async def call_superuser_function(self, _client: Client, msg: Message) -> None:
-        sql_obj = await self.pgsqldb.query1('''SELECT "user_id", "section" FROM "tickets" WHERE "hash" = $1''',
-                                            self.get_hash_from_reply_msg(msg))
+        sql_obj = await self.pgsqldb.query1(self._QUERY_TICKET_SECTION, self.get_hash_from_reply_msg(msg))
         if sql_obj['section'] != self.SECTION[0]:
             await msg.reply(_T("This ticket doesn't support admin menus for now."), True)
             return
         user_id = sql_obj['user_id']
         await self.get_user_status(user_id, msg.reply_to_message.message_id)
 
-    async def confirm_dialog(self, msg: CallbackQuery, additional_msg: str, callback_prefix: str,
-                             id_: Union[str]) -> None:
+    def init_callbacks(self) -> None:
+        # Action ids are part of callback_data, never reuse or renumber them
+        add = self.callbacks.add
+
+        def add_confirm(action_id: int, name: str, additional_msg: str, handler: Callable[..., Awaitable[None]],
+                        arg_type: type) -> None:
+            add(action_id, name, functools.partial(self.confirm_dialog, additional_msg, f'{name}_confirm'), arg_type)
+            add(action_id + 1, f'{name}_confirm', self.confirmed(handler), arg_type, timeout=15)
+
+        add(1, 'cancel', self.callback_cancel)
+        add(2, 'unban', self.callback_unban, int)
+        add(3, 'refresh', self.callback_refresh, int)
+        add(4, 'del', self.callback_del, int, int)
+        add(5, 'del_confirm', self.confirmed(self.confirm_del), int, int, timeout=15)
+        add_confirm(6, 'close', _T('close this ticket'), self.confirm_close, str)
+        add_confirm(8, 'block', _T('block this user'), self.confirm_block, int)
+        add_confirm(10, 'send', _T('send the link to'), self.confirm_send, int)
+        add_confirm(12, 'reset', _T('reset retry times for'),
+                    self.confirm_execute(self._RESET_RETRIES, 'Retry times has been reset'), int)
+        add_confirm(14, 'bypass', _T('set bypass for'),
+                    self.confirm_execute(self._SET_BYPASS, _T('DONE!'), passed=True), int)
+        add_confirm(16, 'renew', _T('reset user status'),
+                    self.confirm_execute(self._DELETE_SESSION, _T('DONE!'), passed=False), int)
+        add_confirm(18, 'setpass', _T('set pass'),
+                    self.confirm_execute(JoinGroupVerify._SET_PASSED, _T('DONE!'), passed=True), int)
+        add_confirm(20, 'unlimited', _T('set unlimited retries for'),
+                    self.confirm_execute(self._SET_UNLIMITED, _T('DONE!')), int)
+        add_confirm(22, 'insert', 'insert new profile', self.confirm_execute(self._INSERT_BYPASS_SESSION, _T('DONE!')),
+                    int)
+
+    async def confirm_dialog(self, additional_msg: str, action: str, _client: Client, msg: CallbackQuery,
+                             id_: Union[str, int]) -> None:
         asyncio.run_coroutine_threadsafe(msg.answer(), asyncio.get_event_loop())
-        if len(id_) < 32:
+        if isinstance(id_, int):
             await self.bot.send_message(
                 self.help_group,
                 _T('Do you really want to {} {}?').format(additional_msg, TextParser.parse_user_markdown(id_)),
                 'markdown',
-                reply_markup=self.generate_confirm_keyboard(callback_prefix, id_)
+                reply_markup=self.generate_confirm_keyboard(action, id_)
             )
         else:
             await self.bot.send_message(
                 self.help_group,
                 _T('Do you really want to {} #{}?').format(additional_msg, id_),
-                reply_markup=self.generate_confirm_keyboard(callback_prefix, id_)
+                reply_markup=self.generate_confirm_keyboard(action, id_)
             )
 
-    async def confirm(self, client: Client, msg: CallbackQuery) -> None:
-        if time.time() - msg.message.date > 15:
-            raise TimeoutError()
-        if msg.data.startswith('close'):
-            ticket_id = msg.data.split()[-1]
-            q = await self.pgsqldb.query1('''SELECT "user_id", "status" FROM "tickets" WHERE "hash" = $1''', ticket_id)
-            if q is None:
-                return await msg.answer(_T('TICKET NOT FOUND'), True)
-            if q['status'] == 'closed':
-                return await msg.answer(_T('This ticket is already closed.'))
-            await self.pgsqldb.execute('''UPDATE "tickets" SET "status" = 'closed' WHERE "hash" = $1''', ticket_id)
-            await msg.answer(_T('This ticket is already closed.'))
-            await client.send_message(
-                self.help_group,
-                _T('UPDATE\n[ #{} ]\nThis ticket is closed by {}.').format(
-                    ticket_id,
-                    utils.TextParser.parse_user_markdown(
-                        msg.from_user.id,
-                        utils.TextParser.UserName(msg.from_user).full_name
-                    )
-                ),
-                'markdown',
-                reply_markup=self.generate_ticket_keyboard(ticket_id, q['user_id'], True)
-            )
-            await client.send_message(q['user_id'], _T('Your ticket [ #{} ] is closed').format(ticket_id))
-        elif msg.data.startswith('block'):
-            await self.pgsqldb.execute('''UPDATE "tickets_user" SET "banned" = true WHERE "user_id" = $1''',
-                                       int(msg.data.split()[-1]))
-            await msg.answer(_T('DONE!'))
-            await self.bot.send_message(
-                self.help_group,
-                _T('blocked {}').format(TextParser.parse_user_markdown(msg.data.split()[-1], msg.data.split()[-1])),
-                parse_mode='markdown',
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text=_T('UNBAN'), callback_data='unban {}'.format(msg.data.split()[-1]))]
-                ])
-            )
-        elif msg.data.startswith('send'):
-            try:
-                await self.send_link_callback(int(msg.data.split()[-1]), True)
-                await msg.answer(_T('The invitation link is sent successfully.'))
-            except:
-                await client.send_message(self.help_group, traceback.format_exc(), disable_web_page_preview=True)
-                await msg.answer(_T('Failed to send the invitation link. Please check the console.\n{}').format(
-                    traceback.format_exc().splitlines()[-1]), True)
-        elif msg.data.startswith('reset'):
-            await self.pgsqldb.execute('''UPDATE "exam_user_session" SET "retries" = 0 WHERE "user_id" = $1''',
-                                       int(msg.data.split()[-1]))
-            await msg.answer('Retry times has been reset')
-        elif msg.data.startswith('del'):
-            try:
-                await client.delete_messages(int(msg.data.split()[-2]), int(msg.data.split()[-1]))
-                await msg.answer('message has been deleted')
-            except:
-                await client.send_message(self.help_group, traceback.format_exc(), disable_web_page_preview=True)
-                await msg.answer(_T('Failed to delete the message. Please check the console.\n{}').format(
-                    traceback.format_exc().splitlines()[-1]), True)
-        elif msg.data.startswith('renew'):
-            await self.pgsqldb.execute('''DELETE FROM "exam_user_session" WHERE "user_id" = $1''',
-                                       int(msg.data.split()[-1]))
-            await msg.answer(_T('DONE!'))
-        elif msg.data.startswith('bypass'):
-            await self.pgsqldb.execute('''UPDATE "exam_user_session" SET "bypass" = true WHERE "user_id" = $1''',
-                                       int(msg.data.split()[-1]))
-            await msg.answer(_T('DONE!'))
-        elif msg.data.startswith('setpass'):
-            await self.pgsqldb.execute('''UPDATE "exam_user_session" SET "passed" = true WHERE "user_id" = $1''',
-                                       int(msg.data.split()[-1]))
-            await msg.answer(_T('DONE!'))
-        elif msg.data.startswith('unlimited'):
-            await self.pgsqldb.execute('''UPDATE "exam_user_session" SET "unlimited" = true WHERE "user_id" = $1''',
-                                       int(msg.data.split()[-1]))
-            await msg.answer(_T('DONE!'))
-        elif msg.data.startswith('insert'):
-            await self.pgsqldb.execute('''INSERT INTO "exam_user_session" ("user_id", "problem_id") VALUES ($1, 2)''',
-                                       int(msg.data.split()[-1]))
-            await msg.answer(_T('DONE!'))
-        await client.delete_messages(msg.message.chat.id, msg.message.message_id)
-
-    async def send_confirm(self, _client: Client, msg: CallbackQuery) -> None:
-
-        def make_msg_handle(additional_msg: str, callback_prefix: str):
-            async def wrapper():
-                await self.confirm_dialog(msg, additional_msg, callback_prefix, msg.data.split()[-1])
-
-            return wrapper
-
-        if msg.data.startswith('del'):
-            await msg.answer('Please press again to make sure. If you really want to delete this reply', True)
-            await self.bot.send_message(
-                self.help_group,
-                'Do you want to delete reply message to {}?'.format(
-                    TextParser.parse_user_markdown(msg.data.split()[-2])),
-                'markdown',
-                reply_markup=self.generate_confirm_keyboard('del', msg.data[4:])
+    @staticmethod
+    def confirmed(handler: Callable[..., Awaitable[None]]) -> Callable[..., Awaitable[None]]:
+        async def wrapper(client: Client, msg: CallbackQuery, *args: Union[int, str]) -> None:
+            await handler(client, msg, *args)
+            await client.delete_messages(msg.message.chat.id, msg.message.message_id)
+
+        return wrapper
+
+    def confirm_execute(self, statement: utils.Statement, text: str,
+                        passed: Optional[bool] = None) -> Callable[..., Awaitable[None]]:
+        async def wrapper(_client: Client, msg: CallbackQuery, user_id: int) -> None:
+            await self.pgsqldb.execute(statement, user_id)
+            if passed is not None and self.join_group_verify is not None:
+                self.join_group_verify.update_passed(user_id, passed)
+            await msg.answer(text)
+
+        return wrapper
+
+    async def confirm_close(self, client: Client, msg: CallbackQuery, ticket_id: str) -> None:
+        q = await self.pgsqldb.query1(self._QUERY_TICKET_STATUS, ticket_id)
+        if q is None:
+            return await msg.answer(_T('TICKET NOT FOUND'), True)
+        if q['status'] == 'closed':
+            return await msg.answer(_T('This ticket is already closed.'))
+        await self.pgsqldb.execute(self._CLOSE_TICKET, ticket_id)
+        await msg.answer(_T('This ticket is already closed.'))
+        await client.send_message(
+            self.help_group,
+            _T('UPDATE\n[ #{} ]\nThis ticket is closed by {}.').format(
+                ticket_id,
+                utils.TextParser.parse_user_markdown(
+                    msg.from_user.id,
+                    utils.TextParser.UserName(msg.from_user).full_name
+                )
+            ),
+            'markdown',
+            reply_markup=self.generate_ticket_keyboard(ticket_id, q['user_id'], True)
+        )
+        await client.send_message(q['user_id'], _T('Your ticket [ #{} ] is closed').format(ticket_id))
+
+    async def confirm_block(self, _client: Client, msg: CallbackQuery, user_id: int) -> None:
+        await self.pgsqldb.execute(self._BAN_TICKET_USER, user_id)
+        await msg.answer(_T('DONE!'))
+        await self.bot.send_message(
+            self.help_group,
+            _T('blocked {}').format(TextParser.parse_user_markdown(user_id, user_id)),
+            parse_mode='markdown',
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text=_T('UNBAN'), callback_data=self.callbacks.encode('unban', user_id))]
+            ])
+        )
+
+    async def confirm_send(self, client: Client, msg: CallbackQuery, user_id: int) -> None:
+        try:
+            await self.send_link_callback(user_id, True)
+            await msg.answer(_T('The invitation link is sent successfully.'))
+        except:
+            await client.send_message(self.help_group, traceback.format_exc(), disable_web_page_preview=True)
+            await msg.answer(_T('Failed to send the invitation link. Please check the console.\n{}').format(
+                traceback.format_exc().splitlines()[-1]), True)
+
+    async def confirm_del(self, client: Client, msg: CallbackQuery, chat_id: int, message_id: int) -> None:
+        try:
+            await client.delete_messages(chat_id, message_id)
+            await msg.answer('message has been deleted')
+        except:
+            await client.send_message(self.help_group, traceback.format_exc(), disable_web_page_preview=True)
+            await msg.answer(_T('Failed to delete the message. Please check the console.\n{}').format(
+                traceback.format_exc().splitlines()[-1]), True)
+
+    async def callback_del(self, _client: Client, msg: CallbackQuery, chat_id: int, message_id: int) -> None:
+        await msg.answer('Please press again to make sure. If you really want to delete this reply', True)
+        await self.bot.send_message(
+            self.help_group,
+            'Do you want to delete reply message to {}?'.format(
+                TextParser.parse_user_markdown(chat_id)),
+            'markdown',
+            reply_markup=self.generate_confirm_keyboard('del_confirm', chat_id, message_id)
+        )
+
+    @staticmethod
+    async def callback_cancel(client: Client, msg: CallbackQuery) -> None:
+        await client.edit_message_reply_markup(msg.message.chat.id, msg.message.message_id)
+        await msg.answer('Canceled')
+
+    async def callback_unban(self, client: Client, msg: CallbackQuery, user_id: int) -> None:
+        await self.pgsqldb.execute(self._UNBAN_TICKET_USER, user_id)
+        await msg.answer('UNBANED')
+        await client.edit_message_reply_markup(msg.message.chat.id, msg.message.message_id)
+
+    async def callback_refresh(self, client: Client, msg: CallbackQuery, user_id: int) -> None:
+        try:
+            await client.edit_message_text(
+                msg.message.chat.id,
+                msg.message.message_id,
+                await self.generate_superuser_text(user_id),
+                'html',
+                reply_markup=msg.message.reply_markup
             )
-        command_mapping = {
-            'close': make_msg_handle(_T('close this ticket'), 'close'),
-            'block': make_msg_handle(_T('block this user'), 'block'),
-            'send': make_msg_handle(_T('send the link to'), 'send'),
-            'reset': make_msg_handle(_T('reset retry times for'), 'reset'),
-            'bypass': make_msg_handle(_T('set bypass for'), 'bypass'),
-            'renew': make_msg_handle(_T('reset user status'), 'renew'),
-            'setpass': make_msg_handle(_T('set pass'), 'setpass'),
-            'unlimited': make_msg_handle(_T('set unlimited retries for'), 'unlimited'),
-            'insert': make_msg_handle('insert new profile', 'insert')
-        }
-        for name, func in command_mapping.items():
-            if msg.data.startswith(name):
-                await func()
-                break
+        except pyrogram.errors.exceptions.bad_request_400.MessageNotModified:
+            pass
+        await msg.answer()
 
     async def answer(self, client: Client, msg: CallbackQuery) -> None:
-        if msg.data.startswith('cancel'):
-            await client.edit_message_reply_markup(msg.message.chat.id, msg.message.message_id)
-            await msg.answer('Canceled')
-        elif msg.data.startswith('unban'):
-            await self.pgsqldb.execute('''UPDATE "tickets_user" SET "banned" = false WHERE "user_id" = $1''',
-                                       int(msg.data.split()[-1]))
-            await msg.answer('UNBANED')
-            await client.edit_message_reply_markup(msg.message.chat.id, msg.message.message_id)
-        elif msg.data.startswith('refresh'):
-            try:
-                await client.edit_message_text(
-                    msg.message.chat.id,
-                    msg.message.message_id,
-                    await self.generate_superuser_text(int(msg.data.split()[-1])),
-                    'html',
-                    reply_markup=msg.message.reply_markup
-                )
-            except pyrogram.errors.exceptions.bad_request_400.MessageNotModified:
-                pass
-            await msg.answer()
-        elif 'confirm' in msg.data:
-            try:
-                await self.confirm(client, msg)
-            except TimeoutError:
-                await asyncio.gather(msg.answer('Confirmation time out'),
+        try:
+            if not await self.callbacks.dispatch(client, msg):
+                await asyncio.gather(msg.answer('This button is no longer valid'),
                                      client.edit_message_reply_markup(msg.message.chat.id, msg.message.message_id))
-        elif any(msg.data.startswith(x) for x in
-                 ('close', 'block', 'send', 'bypass', 'reset', 'unlimited', 'del', 'renew', 'setpass', 'insert')):
-            await self.send_confirm(client, msg)
-        else:
-            try:
-                raise ValueError(msg.data)
-            except:
-                await client.send_message(self.help_group, traceback.format_exc(), disable_web_page_preview=True)
+        except TimeoutError:
+            await asyncio.gather(msg.answer('Confirmation time out'),
+                                 client.edit_message_reply_markup(msg.message.chat.id, msg.message.message_id))
 
     async def _query_last_time(self, msg: Message) -> int:
         return await self._query_redis_time(f'CSLAST_{msg.chat.id}')
@@ -1086,7 +1270,7 @@ class CustomServiceBot:
             if msg.text:
                 logger.warning('Caught flood %s: %s', msg.chat.id, msg.text)
             await self._update_last_msg_send(msg)
-            sq = await self.pgsqldb.query1('''SELECT "banned" FROM "tickets_user" WHERE "user_id" = $1''', msg.chat.id)
+            sq = await self.pgsqldb.query1(self._QUERY_BANNED, msg.chat.id)
             if sq and sq['baned']:
                 return await msg.reply(
                     _T('Due to privacy settings, you are temporarily unable to operate.')) is not None
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# migrate.py
+# Copyright (C) 2021 github.com/googlehosts Group:Z
+#
+# This module is part of googlehosts/telegram-repeater and is released under
+# the AGPL v3 License: https://www.gnu.org/licenses/agpl-3.0.txt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+from __future__ import annotations
+import asyncio
+import json
+import logging
+import os
+import re
+import sys
+from configparser import ConfigParser
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import asyncpg
+
+logger = logging.getLogger('telegram-repeater').getChild('migrate')
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+_MIGRATION_FILE = re.compile(r'^(\d{4})_(\w+)\.sql$')
+# Any constant works, it only has to be the same for every bot process.
+_ADVISORY_LOCK_ID = 0x7265706561746572
+
+_RECENT = datetime.now() - timedelta(days=1)
+# (statement name, sample arguments, full scan expected), the SQL is taken from utils.Statement.registry so that
+# explain checks exactly what the bot runs
+HOT_QUERIES: List[Tuple[str, Sequence[Any], bool]] = [
+    ('msg_id.get_id', (1,), False),
+    ('msg_id.get_id_reverse', (1, _RECENT), False),
+    ('msg_id.get_user_id', (1, _RECENT), False),
+    ('username.channel_msg_id', (1, _RECENT), False),
+    ('reasons.count_by_user', (1,), False),
+    ('reasons.text_by_id', (1,), False),
+    ('reasons.delete_by_user', (1,), False),
+    ('banlist.load', (), True),
+    ('auth_user.load', (), True),
+    ('auth_user.query', (1,), False),
+    ('exam_user_session.load_passed', (), True),
+    ('exam_user_session.count', (), True),
+    ('exam_user_session.count_by_problem', (1,), False),
+    ('exam_user_session.count_passed_by_problem', (1,), False),
+    ('answer_history.recent', (1,), False),
+    ('answer_history.count', (1,), False),
+    ('tickets.list', (1,), False),
+    ('tickets.open_by_user', (1,), False),
+    ('tickets.by_hash', ('',), False),
+    ('tickets.by_hash_user', ('', 1), False),
+    ('tickets_user.query', (1,), False),
+]
+
+
+def load_statements() -> Dict[str, str]:
+    # Imported here, utils imports this module and the statements are registered when their classes are defined
+    import customservice
+    import utils
+    return {name: statement.sql for name, statement in utils.Statement.registry.items()}
+
+
+@dataclass
+class Migration:
+    version: int
+    name: str
+    path: str
+
+    def read(self) -> str:
+        with open(self.path, encoding='utf8') as fin:
+            return fin.read()
+
+
+def load_migrations(path: str = MIGRATIONS_DIR) -> List[Migration]:
+    migrations = []
+    for file_name in os.listdir(path):
+        r = _MIGRATION_FILE.match(file_name)
+        if r is None:
+            continue
+        migrations.append(Migration(int(r.group(1)), r.group(2), os.path.join(path, file_name)))
+    migrations.sort(key=lambda x: x.version)
+    for previous, current in zip(migrations, migrations[1:]):
+        if previous.version == current.version:
+            raise ValueError(f'Duplicate migration version {current.version}')
+    return migrations
+
+
+class MigrationRunner:
+    def __init__(self, conn: asyncpg.Connection, path: str = MIGRATIONS_DIR):
+        self.conn: asyncpg.Connection = conn
+        self.path: str = path
+
+    async def _ensure_version_table(self) -> None:
+        await self.conn.execute('''CREATE TABLE IF NOT EXISTS "schema_version" (
+            "version" integer NOT NULL PRIMARY KEY,
+            "name" character varying(64) NOT NULL,
+            "applied_at" timestamp without time zone DEFAULT CURRENT_TIMESTAMP NOT NULL
+        )''')
+
+    async def current_version(self) -> int:
+        await self._ensure_version_table()
+        return await self.conn.fetchval('''SELECT COALESCE(MAX("version"), 0) FROM "schema_version"''')
+
+    async def pending(self) -> List[Migration]:
+        current = await self.current_version()
+        return [migration for migration in load_migrations(self.path) if migration.version > current]
+
+    async def upgrade(self, target: Optional[int] = None) -> List[Migration]:
+        applied = []
+        await self.conn.execute('SELECT pg_advisory_lock($1)', _ADVISORY_LOCK_ID)
+        try:
+            for migration in await self.pending():
+                if target is not None and migration.version > target:
+                    break
+                logger.info('Applying migration %04d_%s', migration.version, migration.name)
+                async with self.conn.transaction():
+                    await self.conn.execute(migration.read())
+                    await self.conn.execute('''INSERT INTO "schema_version" ("version", "name") VALUES ($1, $2)''',
+                                            migration.version, migration.name)
+                applied.append(migration)
+        finally:
+            await self.conn.execute('SELECT pg_advisory_unlock($1)', _ADVISORY_LOCK_ID)
+        return applied
+
+
+def _iter_plan_nodes(plan: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    yield plan
+    for child in plan.get('Plans', ()):
+        yield from _iter_plan_nodes(child)
+
+
+async def explain_hot_queries(conn: asyncpg.Connection) -> List[Tuple[str, bool, List[str]]]:
+    # Small tables are always cheaper to scan sequentially, so ask the planner to avoid that whenever an index
+    # can answer the query. A sequential scan left in the plan means there is no usable index.
+    statements = load_statements()
+    missing = [name for name, _args, _full_scan in HOT_QUERIES if name not in statements]
+    if missing:
+        raise KeyError(f'Hot queries not registered as utils.Statement: {", ".join(missing)}')
+    result = []
+    async with conn.transaction():
+        await conn.execute('SET LOCAL enable_seqscan = off')
+        for name, args, full_scan in HOT_QUERIES:
+            sql = statements[name]
+            plan = json.loads(await conn.fetchval(f'EXPLAIN (FORMAT JSON) {sql}', *args))[0]['Plan']
+            nodes = [node['Node Type'] for node in _iter_plan_nodes(plan)]
+            result.append((name, full_scan or 'Seq Scan' not in nodes, nodes))
+    return result
+
+
+async def connect_from_config(config: ConfigParser) -> asyncpg.Connection:
+    return await asyncpg.connect(
+        host=config['pgsql']['host'],
+        port=config.getint('pgsql', 'port'),
+        user=config['pgsql']['user'],
+        password=config['pgsql']['passwd'],
+        database=config['pgsql']['database']
+    )
+
+
+async def main(args: List[str]) -> int:
+    config = ConfigParser()
+    config.read('config.ini')
+    command = args[0] if args else 'upgrade'
+    conn = await connect_from_config(config)
+    try:
+        runner = MigrationRunner(conn)
+        if command == 'upgrade':
+            applied = await runner.upgrade(int(args[1]) if len(args) > 1 else None)
+            print('Applied:', ', '.join(f'{x.version:04d}_{x.name}' for x in applied) if applied else 'nothing')
+            print('Current version:', await runner.current_version())
+        elif command == 'status':
+            print('Current version:', await runner.current_version())
+            for migration in await runner.pending():
+                print(f'Pending: {migration.version:04d}_{migration.name}')
+        elif command == 'explain':
+            failed = 0
+            for name, ok, nodes in await explain_hot_queries(conn):
+                # Partitioned tables repeat the same scan once per partition
+                print('{} {}: {}'.format('OK  ' if ok else 'FAIL', name, ' -> '.join(dict.fromkeys(nodes))))
+                failed += not ok
+            return 1 if failed else 0
+        else:
+            print(f'Usage: {sys.argv[0]} [upgrade [version] | status | explain]')
+            return 2
+    finally:
+        await conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(asyncio.get_event_loop().run_until_complete(main(sys.argv[1:])))
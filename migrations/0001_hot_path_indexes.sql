@@ -0,0 +1,11 @@
+-- Indexes for lookups that run on every mirrored reply, /list and status card.
+
+CREATE INDEX IF NOT EXISTS msg_id_target_id_index ON public.msg_id USING btree (target_id);
+
+CREATE INDEX IF NOT EXISTS tickets_user_id_timestamp_index ON public.tickets USING btree (user_id, "timestamp");
+
+CREATE INDEX IF NOT EXISTS answer_history_user_id_id_index ON public.answer_history USING btree (user_id, id);
+
+CREATE INDEX IF NOT EXISTS reasons_user_id_index ON public.reasons USING btree (user_id);
+
+CREATE INDEX IF NOT EXISTS exam_user_session_problem_id_index ON public.exam_user_session USING btree (problem_id);
@@ -0,0 +1,38 @@
+-- Partition msg_id by month of "timestamp" so that old mappings can be detached instead of deleted row by row.
+-- Future partitions are created and expired ones detached by utils.MsgIdPartitionMaintainer.
+
+ALTER TABLE public.msg_id RENAME TO msg_id_unpartitioned;
+ALTER TABLE public.msg_id_unpartitioned RENAME CONSTRAINT msg_id_pk TO msg_id_unpartitioned_pk;
+ALTER INDEX public.msg_id_target_id_index RENAME TO msg_id_unpartitioned_target_id_index;
+
+CREATE TABLE public.msg_id (
+    msg_id integer NOT NULL,
+    target_id integer DEFAULT 0 NOT NULL,
+    "timestamp" timestamp without time zone DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    user_id bigint,
+    CONSTRAINT msg_id_pk PRIMARY KEY (msg_id, "timestamp")
+) PARTITION BY RANGE ("timestamp");
+
+CREATE INDEX msg_id_target_id_index ON public.msg_id USING btree (target_id);
+
+-- Catches rows if the maintainer did not get to create a partition in time.
+CREATE TABLE public.msg_id_default PARTITION OF public.msg_id DEFAULT;
+
+DO $$
+DECLARE
+    month_start timestamp;
+    month_stop timestamp := date_trunc('month', CURRENT_TIMESTAMP) + interval '2 month';
+BEGIN
+    SELECT date_trunc('month', COALESCE(MIN("timestamp"), CURRENT_TIMESTAMP))
+    INTO month_start FROM public.msg_id_unpartitioned;
+    WHILE month_start <= month_stop LOOP
+        EXECUTE format('CREATE TABLE public.%I PARTITION OF public.msg_id FOR VALUES FROM (%L) TO (%L)',
+                       'msg_id_' || to_char(month_start, 'YYYYMM'), month_start, month_start + interval '1 month');
+        month_start := month_start + interval '1 month';
+    END LOOP;
+END $$;
+
+INSERT INTO public.msg_id ("msg_id", "target_id", "timestamp", "user_id")
+SELECT "msg_id", "target_id", "timestamp", "user_id" FROM public.msg_id_unpartitioned;
+
+DROP TABLE public.msg_id_unpartitioned;
@@ -0,0 +1,26 @@
+-- Publish every change of auth_user on the "auth_user" channel, so that each bot process can apply it to
+-- utils.AuthSystem without reloading. The payload is the new row, {"uid": ..., "deleted": true} or {"reload": true}.
+
+CREATE OR REPLACE FUNCTION public.auth_user_notify() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    IF TG_OP = 'TRUNCATE' THEN
+        PERFORM pg_notify('auth_user', '{"reload": true}');
+        RETURN NULL;
+    END IF;
+    IF TG_OP = 'DELETE' OR (TG_OP = 'UPDATE' AND OLD.uid <> NEW.uid) THEN
+        PERFORM pg_notify('auth_user', json_build_object('uid', OLD.uid, 'deleted', true)::text);
+    END IF;
+    IF TG_OP <> 'DELETE' THEN
+        PERFORM pg_notify('auth_user', json_build_object('uid', NEW.uid, 'authorized', NEW.authorized,
+                                                         'muted', NEW.muted, 'whitelist', NEW.whitelist)::text);
+    END IF;
+    RETURN NULL;
+END $$;
+
+CREATE TRIGGER auth_user_notify AFTER INSERT OR UPDATE OR DELETE ON public.auth_user
+    FOR EACH ROW EXECUTE FUNCTION public.auth_user_notify();
+
+CREATE TRIGGER auth_user_notify_truncate AFTER TRUNCATE ON public.auth_user
+    FOR EACH STATEMENT EXECUTE FUNCTION public.auth_user_notify();
@@ -0,0 +1,18 @@
+-- The partitioned msg_id can only be unique on (msg_id, "timestamp"). msg_id_key keeps msg_id unique across all
+-- partitions and records the "timestamp" of each row, so a lookup by msg_id only opens the partition holding it.
+-- Rows are written together with msg_id by PgSQLdb and removed by utils.MsgIdPartitionMaintainer with their partition.
+
+CREATE TABLE public.msg_id_key (
+    msg_id integer NOT NULL,
+    "timestamp" timestamp without time zone NOT NULL,
+    CONSTRAINT msg_id_key_pk PRIMARY KEY (msg_id)
+);
+
+CREATE INDEX msg_id_key_timestamp_index ON public.msg_id_key USING btree ("timestamp");
+
+-- Keep the oldest mapping of every msg_id written twice since msg_id was partitioned.
+INSERT INTO public.msg_id_key ("msg_id", "timestamp")
+SELECT "msg_id", MIN("timestamp") FROM public.msg_id GROUP BY "msg_id";
+
+DELETE FROM public.msg_id "m" USING public.msg_id_key "k"
+WHERE "m"."msg_id" = "k"."msg_id" AND "m"."timestamp" <> "k"."timestamp";
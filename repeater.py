@@ -20,6 +20,8 @@
 # along with this program. If not, see <https://www.gnu.org/licenses/>.
 from __future__ import annotations
 import asyncio
+import contextlib
+import functools
 import gettext
 import json
 import logging
@@ -28,17 +30,19 @@ import sys
 import time
 import traceback
 from configparser import ConfigParser
-from typing import Callable, Dict, Mapping, Optional, Tuple, TypeVar, Union
+from typing import (Any, Awaitable, Callable, Dict, List, Mapping, Optional,
+                    Tuple, TypeVar, Union)
 
 import aioredis
 import coloredlogs
 import pyrogram
 import pyrogram.errors
-from pyrogram import Client, ContinuePropagation, filters, raw
+from pyrogram import Client, filters
 from pyrogram.handlers import CallbackQueryHandler, MessageHandler
 from pyrogram.types import (CallbackQuery, ChatPermissions,
                             InlineKeyboardButton, InlineKeyboardMarkup,
-                            Message, User)
+                            InputMedia, InputMediaDocument, InputMediaPhoto,
+                            InputMediaVideo, Message, MessageEntity, User)
 
 import utils
 from customservice import CustomServiceBot, JoinGroupVerify
@@ -60,24 +64,38 @@ _cT = TypeVar('_cT')
 
 class TextParser(tp):
     bot_username = ''
+    _parse_cache = utils.ParseCache()
 
     def __init__(self, msg: Message):
-        self._msg = self.BuildMessage(msg)
-        self.parsed_msg = self.parse_main()
-        if msg.chat.id == config.getint('fuduji', 'fudu_group') and \
-                self.parsed_msg and self.parsed_msg.startswith('\\//'):
-            self.parsed_msg = self.parsed_msg[1:]
-        if msg.chat.id == config.getint('fuduji', 'target_group') and self.parsed_msg:
-            self.parsed_msg = self.parsed_msg.replace(
+        super().__init__()
+        self.parse_message(msg)
+
+    def post_process(self, parsed_msg: str) -> str:
+        if self._msg.chat_id == config.getint('fuduji', 'fudu_group') and \
+                parsed_msg and parsed_msg.startswith('\\//'):
+            parsed_msg = parsed_msg[1:]
+        if self._msg.chat_id == config.getint('fuduji', 'target_group') and parsed_msg:
+            parsed_msg = parsed_msg.replace(
                 f'@{TextParser.bot_username}', f"@{config['fuduji']['replace_to_id']}")
+        return parsed_msg
+
+    def post_process_entities(self, text: str, entities: List[MessageEntity]) -> Tuple[str, List[MessageEntity]]:
+        if self._msg.chat_id == config.getint('fuduji', 'fudu_group') and text.startswith('\\//'):
+            text, entities = self.splice(text, entities, ((0, 1),), '')
+        if self._msg.chat_id == config.getint('fuduji', 'target_group') and text:
+            spans = [(x.start(), x.end()) for x in re.finditer(re.escape(f'@{TextParser.bot_username}'), text)]
+            if spans:
+                text, entities = self.splice(text, entities, spans, f"@{config['fuduji']['replace_to_id']}")
+        return text, entities
 
 
 _problemT = TypeVar('_problemT', Dict, str, bool, int)
+PROBLEM_SET_FILE = 'problem_set.json'
 
 
 def external_load_problem_set() -> Dict[str, _problemT]:
     try:
-        with open('problem_set.json', encoding='utf8') as fin:
+        with open(PROBLEM_SET_FILE, encoding='utf8') as fin:
             problem_set = json.load(fin)
         if len(problem_set['problems']['problem_set']) == 0:
             logger.warning('Problem set length is 0')
@@ -87,6 +105,13 @@ def external_load_problem_set() -> Dict[str, _problemT]:
     return problem_set
 
 
+async def _dice_filter(_, __, msg: Message) -> bool:
+    return msg.dice is not None
+
+
+dice_filter = filters.create(_dice_filter, 'DiceFilter')
+
+
 class WaitForDelete:
     def __init__(self, client: Client, chat_id: int, message_ids: Union[int, Tuple[int, ...]]):
         self.client: Client = client
@@ -110,6 +135,13 @@ class OperatorError(Exception):
 
 
 class BotController:
+    EDIT_WAIT_TIMEOUT = 5
+    INPUT_MEDIA_TYPES = {'photo': InputMediaPhoto, 'video': InputMediaVideo, 'document': InputMediaDocument}
+    RENDER_MODES = ('html', 'entities')
+    RENDER_PATHS = ('speak', 'edit', 'sticker', 'dice', 'media', 'incoming')
+    GRANT_PRIVILEGES = {'info': 'can_change_info', 'pin': 'can_pin_messages', 'restrict': 'can_restrict_members',
+                        'delete': 'can_delete_messages'}
+
     class ByPassVerify(UserWarning):
         pass
 
@@ -119,18 +151,43 @@ class BotController:
         self.target_group: int = config.getint('fuduji', 'target_group')
         self.fudu_group: int = config.getint('fuduji', 'fudu_group')
         self.bot_id: int = int(config['account']['api_key'].split(':')[0])
-        self.app: Client = Client(
+        self.send_scheduler: utils.SendScheduler = utils.SendScheduler(
+            config.getfloat('send_scheduler', 'global_rate', fallback=30.0),
+            config.getfloat('send_scheduler', 'global_burst', fallback=30.0),
+            config.getfloat('send_scheduler', 'private_rate', fallback=1.0),
+            config.getfloat('send_scheduler', 'private_burst', fallback=3.0),
+            config.getfloat('send_scheduler', 'group_rate', fallback=20 / 60),
+            config.getfloat('send_scheduler', 'group_burst', fallback=20.0),
+            config.getfloat('send_scheduler', 'max_flood_wait', fallback=300.0),
+            profiles={
+                # The user account is not bound by the Bot API limits, it only waits when Telegram asks to
+                'session': utils.SendScheduler.Profile(*(
+                    config.getfloat('send_scheduler', f'user_{key}', fallback=0.0)
+                    for key in ('global_rate', 'global_burst', 'private_rate', 'private_burst', 'group_rate',
+                                'group_burst')))
+            }
+        )
+        # Handlers only put updates in the dispatcher queues and never wait, a single worker keeps them in arrival order
+        self.app: Client = utils.ScheduledClient(
             session_name='session',
             api_id=config['account']['api_id'],
             api_hash=config['account']['api_hash'],
-            app_version='repeater'
+            app_version='repeater',
+            workers=1,
+            scheduler=self.send_scheduler
         )
-        self.botapp: Client = Client(
+        self.botapp: Client = utils.ScheduledClient(
             session_name='beyondbot',
             api_id=config['account']['api_id'],
             api_hash=config['account']['api_hash'],
             bot_token=config['account']['api_key'],
+            workers=1,
+            scheduler=self.send_scheduler
         )
+        self.dispatcher: utils.OrderedDispatcher = utils.OrderedDispatcher(
+            config.getint('fuduji', 'dispatch_queue_size', fallback=64),
+            concurrency=config.getint('fuduji', 'dispatch_concurrency', fallback=8),
+            high_burst=config.getint('fuduji', 'dispatch_high_burst', fallback=4))
         logger.debug('Loading other configure')
         self.conn: Optional[PgSQLdb] = None
         self._redis: Optional[aioredis.Redis] = None
@@ -142,8 +199,26 @@ class BotController:
 
         self.join_group_verify: Optional[JoinGroupVerify] = None
         self.revoke_tracker_coro: Optional[utils.InviteLinkTracker] = None
+        self.partition_maintainer: Optional[utils.MsgIdPartitionMaintainer] = None
+        self.problem_set_watcher: Optional[utils.FileWatcher] = None
         self.custom_service: Optional[CustomServiceBot] = None
+        self.catch_up_limit: int = config.getint('fuduji', 'catch_up_limit', fallback=3000)
+        self.catch_up_task: Optional[asyncio.Task] = None
+        self.media_group_collector: utils.MediaGroupCollector = utils.MediaGroupCollector(
+            config.getfloat('fuduji', 'media_group_window', fallback=1.0))
+        self.read_acknowledger: utils.ReadAcknowledger = utils.ReadAcknowledger(
+            self.app, config.getfloat('fuduji', 'read_ack_window', fallback=2.0))
+        render_mode = config.get('fuduji', 'render_mode', fallback='html')
+        self.render_mode: Dict[str, str] = {
+            path: config.get('fuduji', f'render_mode_{path}', fallback=render_mode) for path in self.RENDER_PATHS}
+        for path, mode in self.render_mode.items():
+            if mode not in self.RENDER_MODES:
+                raise ValueError(f'Unknown render mode {mode!r} for {path}, should be one of {self.RENDER_MODES}')
         self.problem_set: Optional[Mapping[str, _problemT]] = None
+        self.commands: utils.CommandRouter = utils.CommandRouter()
+        self.callbacks: utils.CallbackRouter = utils.CallbackRouter()
+        self.init_commands()
+        self.init_callbacks()
         self.init_handle()
         logger.debug('Service status: join group verify: %s, custom service: %s',
                      self.join_group_verify_enable, self.custom_service_enable)
@@ -156,17 +231,43 @@ class BotController:
             config.getint('pgsql', 'port'),
             config['pgsql']['user'],
             config['pgsql']['passwd'],
-            config['pgsql']['database']
+            config['pgsql']['database'],
+            cache_size=config.getint('pgsql', 'cache_size', fallback=4096),
+            cache_ttl=config.getfloat('pgsql', 'cache_ttl', fallback=3600.0),
+            write_buffer_size=config.getint('pgsql', 'write_buffer_size', fallback=64),
+            write_flush_interval=config.getfloat('pgsql', 'write_flush_interval', fallback=1.0),
+            auto_migrate=config.getboolean('pgsql', 'auto_migrate', fallback=True),
+            pool_min_size=config.getint('pgsql', 'pool_min_size', fallback=10),
+            pool_max_size=config.getint('pgsql', 'pool_max_size', fallback=10),
+            acquire_timeout=config.getfloat('pgsql', 'acquire_timeout', fallback=10.0),
+            statement_cache_size=config.getint('pgsql', 'statement_cache_size', fallback=100),
+            max_inactive_connection_lifetime=config.getfloat('pgsql', 'max_inactive_connection_lifetime',
+                                                             fallback=300.0),
+            max_queries=config.getint('pgsql', 'max_queries', fallback=50000)
+        )
+        self.partition_maintainer = utils.MsgIdPartitionMaintainer(
+            self.conn,
+            config.getint('pgsql', 'msg_id_retention_days', fallback=365),
+            config.getboolean('pgsql', 'msg_id_archive', fallback=True)
         )
         self.auth_system = await AuthSystem.initialize_instance(self.conn, config.getint('account', 'owner'))
+        self.auth_system.start()
         if self.join_group_verify_enable:
-            self.join_group_verify = await JoinGroupVerify.create(self.conn, self.botapp, self.target_group,
-                                                                  self.fudu_group, external_load_problem_set,
-                                                                  self._redis)
-            self.join_group_verify.init()
+            self.join_group_verify = await JoinGroupVerify.create(
+                self.conn, self.botapp, self.target_group, self.fudu_group, external_load_problem_set, self._redis,
+                self.callbacks, config.getfloat('join_group_verify', 'regex_timeout', fallback=0.5),
+                config.getint('join_group_verify', 'regex_workers', fallback=2))
+            self.join_group_verify.init(self.dispatcher.wrap)
             self.revoke_tracker_coro = self.join_group_verify.revoke_tracker_coro
+            self.problem_set_watcher = utils.FileWatcher(
+                PROBLEM_SET_FILE, self.reload_problem_set,
+                config.getfloat('join_group_verify', 'problem_set_reload_interval', fallback=5.0))
             if self.custom_service_enable:
-                self.custom_service = CustomServiceBot(config, self.conn, self.join_group_verify.send_link, self._redis)
+                self.custom_service = CustomServiceBot(config, self.conn, self.join_group_verify.send_link, self._redis,
+                                                       self.send_scheduler, self.join_group_verify)
+
+    async def reload_problem_set(self) -> None:
+        await self.join_group_verify.reload_problem_set(external_load_problem_set())
 
     @classmethod
     async def create(cls) -> BotController:
@@ -175,30 +276,38 @@ class BotController:
         return self
 
     def init_handle(self) -> None:
+        dispatch = self.dispatcher.wrap
         self.app.add_handler(
-            MessageHandler(self.handle_edit, filters.chat(self.target_group) & ~filters.user(
+            MessageHandler(dispatch(self.handle_edit), filters.chat(self.target_group) & ~filters.user(
                 self.bot_id) & filters.edited))
         self.app.add_handler(
-            MessageHandler(self.handle_new_member, filters.chat(self.target_group) & filters.new_chat_members))
+            MessageHandler(dispatch(self.handle_new_member),
+                           filters.chat(self.target_group) & filters.new_chat_members))
         self.app.add_handler(
-            MessageHandler(self.handle_service_messages, filters.chat(self.target_group) & filters.service))
+            MessageHandler(dispatch(self.handle_service_messages), filters.chat(self.target_group) & filters.service))
         self.app.add_handler(
             MessageHandler(
-                self.handle_all_media,
+                dispatch(self.handle_all_media),
                 filters.chat(self.target_group) & ~filters.user(self.bot_id) & (
                     filters.photo | filters.video | filters.document | filters.animation | filters.voice)
             )
         )
-        self.app.add_handler(MessageHandler(self.handle_dice, filters.chat(self.target_group) & ~filters.user(
-            self.bot_id) & filters.media))
-        self.app.add_handler(MessageHandler(self.handle_sticker, filters.chat(self.target_group) & ~filters.user(
-            self.bot_id) & filters.sticker))
-        self.app.add_handler(MessageHandler(self.handle_speak, filters.chat(self.target_group) & ~filters.user(
-            self.bot_id) & filters.text))
-        self.app.add_handler(MessageHandler(self.handle_incoming, filters.incoming & filters.chat(self.fudu_group)))
-        self.botapp.add_handler(
-            MessageHandler(self.handle_bot_send_media, filters.chat(self.fudu_group) & filters.command('SendMedia')))
-        self.botapp.add_handler(CallbackQueryHandler(self.handle_callback))
+        self.app.add_handler(MessageHandler(dispatch(self.handle_dice), filters.chat(self.target_group) & ~filters.user(
+            self.bot_id) & dice_filter))
+        self.app.add_handler(MessageHandler(dispatch(self.handle_sticker), filters.chat(
+            self.target_group) & ~filters.user(self.bot_id) & filters.sticker))
+        self.app.add_handler(MessageHandler(dispatch(self.handle_speak), filters.chat(
+            self.target_group) & ~filters.user(self.bot_id) & filters.text))
+        self.app.add_handler(
+            MessageHandler(dispatch(self.handle_incoming, self.is_command),
+                           filters.incoming & filters.chat(self.fudu_group)))
+        self.botapp.add_handler(CallbackQueryHandler(dispatch(self.handle_callback, True)))
+
+    def is_command(self, msg: Message) -> bool:
+        if not msg.text or not msg.text.startswith('/'):
+            return False
+        command = self.commands.match(msg.text)
+        return command is None or command[0].priority
 
     async def init(self) -> None:
         while not self.botapp.is_connected:
@@ -210,14 +319,85 @@ class BotController:
         await pyrogram.idle()
 
     async def start(self) -> None:
+        if self.catch_up_limit > 0:
+            # Live target group messages wait until catch_up has queued the missed ones ahead of them
+            self.dispatcher.hold(self.target_group)
         await asyncio.gather(self.app.start(), self.botapp.start())
+        self.partition_maintainer.start()
+        if self.problem_set_watcher is not None:
+            self.problem_set_watcher.start()
         if self.custom_service_enable:
             asyncio.run_coroutine_threadsafe(self.custom_service.start(), asyncio.get_event_loop())
         await self.init()
+        if self.catch_up_limit > 0:
+            self.catch_up_task = asyncio.create_task(self.catch_up())
+
+    def route_target_message(self, msg: Message) -> Optional[Callable[[Client, Message], Awaitable[None]]]:
+        # Same order as the target group handlers in init_handle. A history message edited since it was sent still
+        # has never been forwarded, so it is routed as a new one and not to handle_edit, which only suits live edits
+        if msg.empty or msg.service or (msg.from_user and msg.from_user.id == self.bot_id):
+            return None
+        if msg.photo or msg.video or msg.document or msg.animation or msg.voice:
+            return self.handle_all_media
+        if msg.dice:
+            return self.handle_dice
+        if msg.sticker:
+            return self.handle_sticker
+        if msg.text:
+            return self.handle_speak
+        return None
+
+    async def catch_up(self) -> None:
+        # Held live messages up to here were replayed, release() drops them
+        replayed_id = 0
+        try:
+            last_id = await self.conn.get_max_msg_id()
+            if last_id is None:
+                logger.info('No forwarded message recorded, skip catch up')
+                return
+            latest = await self.app.get_history(self.target_group, limit=1)
+            if not latest or latest[0].message_id <= last_id:
+                return
+            # Anything newer than this arrives as a regular update, held until the replay is queued
+            stop_id = latest[0].message_id
+            logger.info('Catch up target group messages from %d to %d', last_id + 1, stop_id)
+            start_time = time.time()
+            scanned = forwarded = 0
+            async for msg in self.app.iter_history(self.target_group, self.catch_up_limit, offset_id=last_id + 1,
+                                                   reverse=True):
+                if msg.message_id > stop_id:
+                    break
+                scanned += 1
+                replayed_id = msg.message_id
+                handler = self.route_target_message(msg)
+                if handler is None or await self.conn.get_id(msg.message_id) is not None:
+                    continue
+                await self.dispatcher.put(self.target_group, handler, self.app, msg)
+                forwarded += 1
+                if forwarded % 100 == 0:
+                    logger.info('Catch up progress: %d/%d messages queued, at %d', forwarded, stop_id - last_id,
+                                msg.message_id)
+            logger.info('Catch up finished: %d messages scanned, %d queued in %.1fs', scanned, forwarded,
+                        time.time() - start_time)
+            if scanned >= self.catch_up_limit:
+                logger.warning('Catch up stopped at the limit of %d messages', self.catch_up_limit)
+        finally:
+            # Only what the replay could have queued, service messages are not replayed
+            self.dispatcher.release(self.target_group, lambda update: isinstance(update, Message) and (
+                not update.edit_date and update.message_id <= replayed_id and
+                self.route_target_message(update) is not None))
 
     async def stop(self) -> None:
         task_pending = []
+        if self.catch_up_task is not None and not self.catch_up_task.done():
+            self.catch_up_task.cancel()
+        await self.dispatcher.stop()
+        await self.read_acknowledger.flush_all()
+        self.partition_maintainer.request_stop()
+        await self.partition_maintainer.join(1.5)
         if self.join_group_verify_enable:
+            self.problem_set_watcher.request_stop()
+            await self.problem_set_watcher.join(1.5)
             self.revoke_tracker_coro.request_stop()
             await self.revoke_tracker_coro.join(1.5)
             if self.revoke_tracker_coro.is_alive:
@@ -228,10 +408,18 @@ class BotController:
         task_pending.append(asyncio.create_task(self.app.stop()))
         await asyncio.wait(task_pending)
         task_pending.clear()
+        logger.info('Dispatcher stats: %s', self.dispatcher.stats)
+        logger.info('Send scheduler stats: %s', self.send_scheduler.stats)
+        logger.info('Read acknowledger stats: %s', self.read_acknowledger.stats)
+        if self.join_group_verify is not None:
+            logger.info('Member status cache stats: %s', self.join_group_verify.member_status.stats)
+            logger.info('Regex worker stats: %s', self.join_group_verify.regex_worker.stats)
 
         if self.join_group_verify_enable:
             await self.join_group_verify.problems.destroy()
+            self.join_group_verify.regex_worker.close()
 
+        await self.auth_system.close()
         self._redis.close()
         await asyncio.gather(self.conn.close(), self._redis.wait_closed())
 
@@ -247,11 +435,14 @@ class BotController:
                     self.fudu_group, f'Pined \'{text}\'',
                     disable_web_page_preview=True,
                     reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                        [InlineKeyboardButton(text='UNPIN', callback_data='unpin')]
+                        [InlineKeyboardButton(text='UNPIN', callback_data=self.callbacks.encode('unpin'))]
                     ]))
                 ).message_id,
                 msg.message_id
             )
+        elif msg.left_chat_member:
+            if self.join_group_verify is not None:
+                self.join_group_verify.member_status.put(msg.left_chat_member.id, 'left')
         elif msg.new_chat_title:
             await self.conn.insert_ex(
                 (await self.botapp.send_message(self.fudu_group,
@@ -266,316 +457,338 @@ class BotController:
         return _T('You were warned.(Total: {})\nReason: <pre>{}</pre>').format(
             await self.conn.query_warn_by_user(user_id), reason)
 
-    async def process_incoming_command(self, client: Client, msg: Message) -> None:
-        r = re.match(r'^/bot (on|off)$', msg.text)
-        if r is None:
-            r = re.match(r'^/b?(on|off)$', msg.text)
-        if r:
-            if not self.auth_system.check_ex(
-                    msg.reply_to_message.from_user.id if msg.reply_to_message else msg.from_user.id): return
-            await self.auth_system.mute_or_unmute(
-                r.group(1),
-                msg.reply_to_message.from_user.id if msg.reply_to_message else msg.from_user.id
-            )
-            await msg.delete()
-
-        if msg.text == '/status':
-            user_id = msg.reply_to_message.from_user.id if msg.reply_to_message else msg.from_user.id
-            status = [str(user_id), ' summary:\n\n', 'A' if self.auth_system.check_ex(user_id) else 'Una',
-                      'uthorized user\nBot status: ',
-                      CustomServiceBot.return_bool_emoji(not self.auth_system.check_muted(user_id))]
-            WaitForDelete(client, msg.chat.id,
-                          (msg.message_id, (await msg.reply(''.join(status), True)).message_id))()
-            del status
-
-        elif msg.text.startswith('/promote'):
-            if len(msg.text.split()) == 1:
-                if msg.reply_to_message is None or not self.auth_system.check_ex(msg.reply_to_message.from_user.id):
-                    await self.botapp.send_message(msg.chat.id, 'Please reply to an Authorized user.',
-                                                   reply_to_message_id=msg.message_id)
-                    return
-                user_id = msg.reply_to_message.from_user.id
-            else:
-                user_id = int(msg.text.split()[1])
-            await self.botapp.send_message(
-                msg.chat.id,
-                'Please use bottom to make sure you want to add {} to Administrators'.format(
-                    TextParser.parse_user_markdown(user_id)),
-                parse_mode='markdown',
-                reply_to_message_id=msg.message_id,
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                    [
-                        InlineKeyboardButton(
-                            text='Yes, confirm',
-                            callback_data=f'promote {user_id}'
-                        )
-                    ],
-                    [
-                        InlineKeyboardButton(text='Cancel', callback_data='cancel d')
-                    ]
-                ]))
+    def init_commands(self) -> None:
+        add = self.commands.add
+        add('auth', self.func_auth_process, reply=True, authorized=False)
+        add(('on', 'bon'), functools.partial(self.command_switch, switch='on'))
+        add(('off', 'boff'), functools.partial(self.command_switch, switch='off'))
+        add('bot', self.command_switch, r' (on|off)')
+        add('status', self.command_status)
+        add('promote', self.command_promote, r'(?: (\d+))?')
+        add(('su', 'sudo'), self.command_sudo)
+        add('title', self.command_title, r' (.*)')
+        add('del', self.command_del, reply=True)
+        add('getid', self.command_getid, reply=True)
+        add('get', self.command_get, reply=True)
+        add('fw', self.command_fw, reply=True)
+        add('ban', self.command_ban, r'(?: ([1-9]\d*)([smhd]))?')
+        add('banf', self.command_ban, reply=True)
+        add('kick', self.command_kick, r'( confirm| -?\d+)?', reply=True)
+        add('pin', functools.partial(self.command_pin, False), reply=True)
+        add('pina', functools.partial(self.command_pin, True), reply=True)
+        add('warn', functools.partial(self.command_warn, False), r' (.*)', reply=True)
+        add('warnd', functools.partial(self.command_warn, True), r' (.*)', reply=True)
+        add('report', self.command_report, reply=False, priority=False)
+        add('dbstats', self.command_dbstats, reply=False)
+        add('sendstats', self.command_sendstats, reply=False)
+        add('grant', self.command_grant, r' (\d+)', reply=False)
+        # No handler, only kept so that they are not mirrored to the target group
+        add('join', None)
+        add('set', None, r' [a-zA-Z]')
+
+    async def command_switch(self, _client: Client, msg: Message, switch: str) -> None:
+        user_id = msg.reply_to_message.from_user.id if msg.reply_to_message else msg.from_user.id
+        if not self.auth_system.check_ex(user_id):
             return
-
-        elif msg.text.startswith('/su'):
-            if not self.auth_system.check_ex(msg.from_user.id):
-                return
-            await self.botapp.promote_chat_member(
-                self.target_group,
-                int(msg.from_user.id),
-                True,
-                can_delete_messages=True,
-                can_pin_messages=True,
-                can_promote_members=True
-            )
-            await self.botapp.send_message(
-                msg.chat.id,
-                'Access Granted',
-                disable_notification=True,
-                reply_to_message_id=msg.message_id
-            )
-
-        elif msg.text.startswith('/title'):
-            if not self.auth_system.check_ex(msg.from_user.id):
+        await self.auth_system.mute_or_unmute(switch, user_id)
+        await msg.delete()
+
+    async def command_status(self, client: Client, msg: Message) -> None:
+        user_id = msg.reply_to_message.from_user.id if msg.reply_to_message else msg.from_user.id
+        status = [str(user_id), ' summary:\n\n', 'A' if self.auth_system.check_ex(user_id) else 'Una',
+                  'uthorized user\nBot status: ',
+                  CustomServiceBot.return_bool_emoji(not self.auth_system.check_muted(user_id))]
+        WaitForDelete(client, msg.chat.id,
+                      (msg.message_id, (await msg.reply(''.join(status), True)).message_id))()
+
+    async def command_promote(self, _client: Client, msg: Message, user_id: Optional[str]) -> None:
+        if user_id is None:
+            if msg.reply_to_message is None or not self.auth_system.check_ex(msg.reply_to_message.from_user.id):
+                await self.botapp.send_message(msg.chat.id, 'Please reply to an Authorized user.',
+                                               reply_to_message_id=msg.message_id)
                 return
-            await self.botapp.set_chat_title(
-                self.target_group,
-                msg.text.split(maxsplit=2)[1]
-            )
-
-        if msg.reply_to_message:
-            if msg.text == '/del':
-                message_id = await self.conn.get_reply_id_reverse(msg)
-                if message_id is None:
-                    await self.botapp.send_message(msg.chat.id, 'MESSAGE_ID_NOT_FOUND',
-                                                   reply_to_message_id=msg.message_id)
-                    return
-                try:
-                    await client.forward_messages(msg.chat.id, self.target_group, message_id)
-                except:
-                    await client.send_message(msg.chat.id, traceback.format_exc(), disable_web_page_preview=True)
-                try:
-                    await self.botapp.delete_messages(self.target_group, message_id)
-                    await client.delete_messages(self.fudu_group, [msg.message_id, msg.reply_to_message.message_id])
-                except:
-                    pass
-
-            elif msg.text == '/getid':
-                user_id = await self.conn.get_user_id(msg)
-                await msg.reply(
-                    'user_id is `{}`'.format(
-                        user_id['user_id'] if user_id is not None and user_id['user_id'] else 'ERROR_INVALID_USER_ID'
-                    ),
-                    parse_mode='markdown'
-                )
-
-            elif msg.text == '/get' and await self.conn.get_reply_id_reverse(msg):
-                try:
-                    await client.forward_messages(self.fudu_group, self.target_group,
-                                                  await self.conn.get_reply_id_reverse(msg))
-                except:
-                    await client.send_message(msg.chat.id, traceback.format_exc().splitlines()[-1])
-
-            elif msg.text == '/fw':
-                message_id = await self.conn.get_reply_id_reverse(msg)
-                if message_id is None:
-                    await msg.reply('ERROR_INVALID_MESSAGE_ID')
-                    return
-                await self.conn.insert_ex(
-                    (await self.botapp.forward_messages(self.target_group, self.target_group, message_id)).message_id,
-                    msg.message_id)
-
-            elif msg.text.startswith('/ban'):
-                user_id = await self.conn.get_user_id(msg)
-                if len(msg.text) == 4:
-                    restrict_time = 0
-                else:
-                    r = re.match(r'^([1-9]\d*)([smhd])$', msg.text[5:])
-                    if r is not None:
-                        restrict_time = int(r.group(1)) * {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 60 * 60 * 24}.get(
-                            r.group(2))
-                    else:
-                        await self.botapp.send_message(msg.chat.id, 'Usage: `/ban` or `/ban <Duration>`',
-                                                       'markdown', reply_to_message_id=msg.message_id)
-                        return
-                if user_id is not None and user_id['user_id']:
-                    if user_id['user_id'] not in self.auth_system.whitelist:
-                        await self.botapp.send_message(
-                            msg.chat.id,
-                            'What can {} only do? Press the button below.\n'
-                            'This confirmation message will expire after 20 seconds.'.format(
-                                TextParser.parse_user_markdown(user_id['user_id'])
-                            ),
-                            reply_to_message_id=msg.message_id,
-                            parse_mode='markdown',
-                            reply_markup=InlineKeyboardMarkup(
-                                inline_keyboard=[
-                                    [
-                                        InlineKeyboardButton(
-                                            text='READ',
-                                            callback_data=f"res {restrict_time} read {user_id['user_id']}")
-                                    ],
-                                    [
-                                        InlineKeyboardButton(
-                                            text='SEND_MESSAGES',
-                                            callback_data=f"res {restrict_time} write {user_id['user_id']}"),
-                                        InlineKeyboardButton(
-                                            text='SEND_MEDIA',
-                                            callback_data=f"res {restrict_time} media {user_id['user_id']}")
-                                    ],
-                                    [
-                                        InlineKeyboardButton(
-                                            text='SEND_STICKERS',
-                                            callback_data=f"res {restrict_time} stickers {user_id['user_id']}"),
-                                        InlineKeyboardButton(
-                                            text='EMBED_LINKS',
-                                            callback_data=f"res {restrict_time} link {user_id['user_id']}")
-                                    ],
-                                    [
-                                        InlineKeyboardButton(text='Cancel', callback_data='cancel')
-                                    ]
-                                ]
-                            )
-                        )
-                    else:
-                        await self.botapp.send_message(
-                            msg.chat.id,
-                            'ERROR_WHITELIST_USER_ID',
-                            reply_to_message_id=msg.message_id
-                        )
-                else:
-                    await self.botapp.send_message(
-                        msg.chat.id,
-                        'ERROR_INVALID_USER_ID',
-                        reply_to_message_id=msg.message_id
+            user_id = msg.reply_to_message.from_user.id
+        else:
+            user_id = int(user_id)
+        await self.botapp.send_message(
+            msg.chat.id,
+            'Please use bottom to make sure you want to add {} to Administrators'.format(
+                TextParser.parse_user_markdown(user_id)),
+            parse_mode='markdown',
+            reply_to_message_id=msg.message_id,
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [
+                    InlineKeyboardButton(
+                        text='Yes, confirm',
+                        callback_data=self.callbacks.encode('promote', user_id)
                     )
+                ],
+                [
+                    InlineKeyboardButton(text='Cancel', callback_data=self.callbacks.encode('cancel_delete'))
+                ]
+            ]))
+
+    async def command_sudo(self, _client: Client, msg: Message) -> None:
+        await self.botapp.promote_chat_member(
+            self.target_group,
+            int(msg.from_user.id),
+            True,
+            can_delete_messages=True,
+            can_pin_messages=True,
+            can_promote_members=True
+        )
+        await self.botapp.send_message(
+            msg.chat.id,
+            'Access Granted',
+            disable_notification=True,
+            reply_to_message_id=msg.message_id
+        )
 
-            elif msg.text == '/kick':
-                user_id = await self.conn.get_user_id(msg)
-                if user_id is not None and user_id['user_id']:
-                    if user_id['user_id'] not in self.auth_system.whitelist:
-                        await self.botapp.send_message(
-                            msg.chat.id,
-                            'Do you really want to kick {}?\n'
-                            'If you really want to kick this user, press the button below.\n'
-                            'This confirmation message will expire after 15 seconds.'.format(
-                                TextParser.parse_user_markdown(user_id['user_id'])
-                            ),
-                            reply_to_message_id=msg.message_id,
-                            parse_mode='markdown',
-                            reply_markup=InlineKeyboardMarkup(
-                                inline_keyboard=[
-                                    [
-                                        InlineKeyboardButton(
-                                            text='Yes, kick it',
-                                            callback_data=f'kick {msg.from_user.id} '
-                                                          f'{user_id["user_id"]}'
-                                        )
-                                    ],
-                                    [
-                                        InlineKeyboardButton(
-                                            text='No',
-                                            callback_data='cancel'
-                                        )
-                                    ],
-                                ]
-                            )
-                        )
-                    else:
-                        await self.botapp.send_message(msg.chat.id, 'ERROR_WHITELIST_USER_ID',
-                                                       reply_to_message_id=msg.message_id)
-                else:
-                    await self.botapp.send_message(msg.chat.id, 'ERROR_INVALID_USER_ID',
-                                                   reply_to_message_id=msg.message_id)
+    async def command_title(self, _client: Client, msg: Message, title: str) -> None:
+        title = title.split(maxsplit=1)
+        if title:
+            await self.botapp.set_chat_title(self.target_group, title[0])
 
-            elif msg.text.startswith('/pin'):
-                target_id = await self.conn.get_reply_id_reverse(msg)
-                if target_id is None:
-                    await msg.reply('ERROR_INVALID_MESSAGE_ID')
-                    return
-                await self.botapp.pin_chat_message(self.target_group, target_id, not msg.text.endswith('a'))
+    async def command_del(self, client: Client, msg: Message) -> None:
+        message_id = await self.conn.get_reply_id_reverse(msg)
+        if message_id is None:
+            await self.botapp.send_message(msg.chat.id, 'MESSAGE_ID_NOT_FOUND',
+                                           reply_to_message_id=msg.message_id)
+            return
+        try:
+            await client.forward_messages(msg.chat.id, self.target_group, message_id)
+        except:
+            await client.send_message(msg.chat.id, traceback.format_exc(), disable_web_page_preview=True)
+        try:
+            await self.botapp.delete_messages(self.target_group, message_id)
+            await client.delete_messages(self.fudu_group, [msg.message_id, msg.reply_to_message.message_id])
+        except:
+            pass
+
+    async def command_getid(self, _client: Client, msg: Message) -> None:
+        user_id = await self.conn.get_user_id(msg)
+        await msg.reply(
+            'user_id is `{}`'.format(
+                user_id['user_id'] if user_id is not None and user_id['user_id'] else 'ERROR_INVALID_USER_ID'
+            ),
+            parse_mode='markdown'
+        )
 
-            elif msg.text.startswith('/warn'):
-                user_id = await self.conn.get_user_id(msg)
-                if user_id is None or not user_id['user_id']:
-                    return
-                user_id = user_id['user_id']
-                target_id = await self.conn.get_reply_id_reverse(msg)
-                reason = ' '.join(msg.text.split(' ')[1:])
-                dry_run = msg.text.split()[0].endswith('d')
-                fwd_msg = None
-                if self.warn_evidence_history_channel != 0:
-                    fwd_msg = (await self.app.forward_messages(
-                        self.warn_evidence_history_channel,
-                        self.target_group,
-                        target_id,
-                        True)).message_id
-                if dry_run:
-                    await self.botapp.send_message(self.fudu_group, await self.generate_warn_message(user_id, reason),
-                                                   reply_to_message_id=msg.reply_to_message.message_id)
-                else:
-                    warn_id = await self.conn.insert_new_warn(user_id, reason, fwd_msg)
-                    warn_msg = await self.botapp.send_message(self.target_group,
-                                                              await self.generate_warn_message(user_id, reason),
-                                                              reply_to_message_id=target_id)
-                    await self.botapp.send_message(
-                        self.fudu_group,
-                        _T('WARN SENT TO {}, Total warn {} time(s)').format(
-                            TextParser.parse_user_markdown(user_id),
-                            await self.conn.query_warn_by_user(user_id)
-                        ),
-                        parse_mode='markdown', reply_to_message_id=msg.message_id,
-                        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                            [
-                                InlineKeyboardButton(
-                                    text=_T('RECALL'),
-                                    callback_data=f'warndel {warn_msg.message_id} {warn_id}'
-                                )
-                            ]
-                        ]))
+    async def command_get(self, client: Client, msg: Message) -> None:
+        message_id = await self.conn.get_reply_id_reverse(msg)
+        if not message_id:
+            return
+        try:
+            await client.forward_messages(self.fudu_group, self.target_group, message_id)
+        except:
+            await client.send_message(msg.chat.id, traceback.format_exc().splitlines()[-1])
+
+    async def command_fw(self, _client: Client, msg: Message) -> None:
+        message_id = await self.conn.get_reply_id_reverse(msg)
+        if message_id is None:
+            await msg.reply('ERROR_INVALID_MESSAGE_ID')
+            return
+        await self.conn.insert_ex(
+            (await self.botapp.forward_messages(self.target_group, self.target_group, message_id)).message_id,
+            msg.message_id)
 
-        else:  # Not reply message
+    async def command_ban(self, client: Client, msg: Message, duration: Optional[str] = None,
+                          unit: Optional[str] = None) -> None:
+        if msg.reply_to_message is None:
             if msg.text == '/ban':
                 await client.send_message(
                     msg.chat.id, _T(
                         'Reply to the user you wish to restrict, '
                         'if you want to kick this user, please use the /kick command.'))
+            return
+        user_id = await self.conn.get_user_id(msg)
+        if msg.text == '/ban':
+            restrict_time = 0
+        elif duration is not None:
+            restrict_time = int(duration) * {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 60 * 60 * 24}.get(unit)
+        else:
+            await self.botapp.send_message(msg.chat.id, 'Usage: `/ban` or `/ban <Duration>`',
+                                           'markdown', reply_to_message_id=msg.message_id)
+            return
+        if user_id is not None and user_id['user_id']:
+            if user_id['user_id'] not in self.auth_system.whitelist:
+                encode = functools.partial(self.callbacks.encode, 'res', restrict_time)
+                await self.botapp.send_message(
+                    msg.chat.id,
+                    'What can {} only do? Press the button below.\n'
+                    'This confirmation message will expire after 20 seconds.'.format(
+                        TextParser.parse_user_markdown(user_id['user_id'])
+                    ),
+                    reply_to_message_id=msg.message_id,
+                    parse_mode='markdown',
+                    reply_markup=InlineKeyboardMarkup(
+                        inline_keyboard=[
+                            [
+                                InlineKeyboardButton(
+                                    text='READ',
+                                    callback_data=encode('read', user_id['user_id']))
+                            ],
+                            [
+                                InlineKeyboardButton(
+                                    text='SEND_MESSAGES',
+                                    callback_data=encode('write', user_id['user_id'])),
+                                InlineKeyboardButton(
+                                    text='SEND_MEDIA',
+                                    callback_data=encode('media', user_id['user_id']))
+                            ],
+                            [
+                                InlineKeyboardButton(
+                                    text='SEND_STICKERS',
+                                    callback_data=encode('stickers', user_id['user_id'])),
+                                InlineKeyboardButton(
+                                    text='EMBED_LINKS',
+                                    callback_data=encode('link', user_id['user_id']))
+                            ],
+                            [
+                                InlineKeyboardButton(text='Cancel', callback_data=self.callbacks.encode('cancel'))
+                            ]
+                        ]
+                    )
+                )
+            else:
+                await self.botapp.send_message(
+                    msg.chat.id,
+                    'ERROR_WHITELIST_USER_ID',
+                    reply_to_message_id=msg.message_id
+                )
+        else:
+            await self.botapp.send_message(
+                msg.chat.id,
+                'ERROR_INVALID_USER_ID',
+                reply_to_message_id=msg.message_id
+            )
 
-            elif msg.text == '/report':
-                if self.join_group_verify_enable:
-                    _problem_total_count = \
-                        (await self.conn.query1('''SELECT COUNT(*) FROM "exam_user_session"'''))['count']
-                    result = []
-                    for problem_id in range(self.join_group_verify.problem_list.length):
-                        total_count, correct_count = await asyncio.gather(self.conn.query1(
-                            '''SELECT COUNT(*) FROM "exam_user_session" WHERE "problem_id" = $1''', problem_id),
-                            self.conn.query1(
-                                '''SELECT COUNT(*) FROM "exam_user_session"
-                                 WHERE "problem_id" = $1 and "passed" = true''',
-                                problem_id))
-                        result.append(
-                            '`{}`: `{:.2f}`% / `{:.2f}`%'.format(problem_id,
-                                                                 correct_count['count'] * 100 / total_count['count'],
-                                                                 total_count['count'] * 100 / _problem_total_count))
-                    await msg.reply('Problem answer correct rate:\n{}'.format('\n'.join(result)))
-
-            elif msg.text.startswith('/grant'):
-                user_id = msg.text.split()[-1]
+    async def command_kick(self, _client: Client, msg: Message, option: Optional[str]) -> None:
+        if option is not None:
+            return
+        user_id = await self.conn.get_user_id(msg)
+        if user_id is not None and user_id['user_id']:
+            if user_id['user_id'] not in self.auth_system.whitelist:
                 await self.botapp.send_message(
                     msg.chat.id,
-                    'Do you want to grant user {}?'.format(
-                        TextParser.parse_user_markdown(user_id)),
-                    disable_notification=True,
+                    'Do you really want to kick {}?\n'
+                    'If you really want to kick this user, press the button below.\n'
+                    'This confirmation message will expire after 15 seconds.'.format(
+                        TextParser.parse_user_markdown(user_id['user_id'])
+                    ),
                     reply_to_message_id=msg.message_id,
+                    parse_mode='markdown',
                     reply_markup=InlineKeyboardMarkup(
-                        [
-                            [InlineKeyboardButton('CHANGE INFO', f'grant {user_id} info'),
-                             InlineKeyboardButton('PIN', f'grant {user_id} pin')],
-                            [InlineKeyboardButton('RESTRICT', f'grant {user_id} restrict'),
-                             InlineKeyboardButton('DELETE', f'grant {user_id} delete')],
-                            [InlineKeyboardButton('confirm', f'grant {user_id} confirm'),
-                             InlineKeyboardButton('[DEBUG]Clear', f'grant {user_id} clear')],
-                            [InlineKeyboardButton('cancel', 'cancel')]
-                        ]))
+                        inline_keyboard=[
+                            [
+                                InlineKeyboardButton(
+                                    text='Yes, kick it',
+                                    callback_data=self.callbacks.encode('kick', msg.from_user.id, user_id['user_id'])
+                                )
+                            ],
+                            [
+                                InlineKeyboardButton(
+                                    text='No',
+                                    callback_data=self.callbacks.encode('cancel')
+                                )
+                            ],
+                        ]
+                    )
+                )
+            else:
+                await self.botapp.send_message(msg.chat.id, 'ERROR_WHITELIST_USER_ID',
+                                               reply_to_message_id=msg.message_id)
+        else:
+            await self.botapp.send_message(msg.chat.id, 'ERROR_INVALID_USER_ID',
+                                           reply_to_message_id=msg.message_id)
+
+    async def command_pin(self, notify: bool, _client: Client, msg: Message) -> None:
+        target_id = await self.conn.get_reply_id_reverse(msg)
+        if target_id is None:
+            await msg.reply('ERROR_INVALID_MESSAGE_ID')
+            return
+        await self.botapp.pin_chat_message(self.target_group, target_id, not notify)
+
+    async def command_warn(self, dry_run: bool, _client: Client, msg: Message, reason: str) -> None:
+        user_id = await self.conn.get_user_id(msg)
+        if user_id is None or not user_id['user_id']:
+            return
+        user_id = user_id['user_id']
+        target_id = await self.conn.get_reply_id_reverse(msg)
+        fwd_msg = None
+        if self.warn_evidence_history_channel != 0:
+            fwd_msg = (await self.app.forward_messages(
+                self.warn_evidence_history_channel,
+                self.target_group,
+                target_id,
+                True)).message_id
+        if dry_run:
+            await self.botapp.send_message(self.fudu_group, await self.generate_warn_message(user_id, reason),
+                                           reply_to_message_id=msg.reply_to_message.message_id)
+        else:
+            warn_id = await self.conn.insert_new_warn(user_id, reason, fwd_msg)
+            warn_msg = await self.botapp.send_message(self.target_group,
+                                                      await self.generate_warn_message(user_id, reason),
+                                                      reply_to_message_id=target_id)
+            await self.botapp.send_message(
+                self.fudu_group,
+                _T('WARN SENT TO {}, Total warn {} time(s)').format(
+                    TextParser.parse_user_markdown(user_id),
+                    await self.conn.query_warn_by_user(user_id)
+                ),
+                parse_mode='markdown', reply_to_message_id=msg.message_id,
+                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                    [
+                        InlineKeyboardButton(
+                            text=_T('RECALL'),
+                            callback_data=self.callbacks.encode('warndel', warn_msg.message_id, warn_id)
+                        )
+                    ]
+                ]))
+
+    async def command_report(self, _client: Client, msg: Message) -> None:
+        if not self.join_group_verify_enable:
+            return
+        _problem_total_count = \
+            (await self.conn.query1(JoinGroupVerify._COUNT_SESSION))['count']
+        result = []
+        for problem_id in range(self.join_group_verify.problem_list.length):
+            total_count, correct_count = await asyncio.gather(
+                self.conn.query1(JoinGroupVerify._COUNT_BY_PROBLEM, problem_id),
+                self.conn.query1(JoinGroupVerify._COUNT_PASSED_BY_PROBLEM, problem_id))
+            result.append(
+                '`{}`: `{:.2f}`% / `{:.2f}`%'.format(problem_id,
+                                                     correct_count['count'] * 100 / total_count['count'],
+                                                     total_count['count'] * 100 / _problem_total_count))
+        await msg.reply('Problem answer correct rate:\n{}'.format('\n'.join(result)))
+
+    async def command_dbstats(self, _client: Client, msg: Message) -> None:
+        await msg.reply('Pool: {}\n\nTop statements by total time:\n{}'.format(
+            self.conn.pool_stats,
+            '\n'.join(self.conn.format_statement_stats(10)) or 'No statement executed'), parse_mode=None)
+
+    async def command_sendstats(self, _client: Client, msg: Message) -> None:
+        await msg.reply(f'Dispatcher: {self.dispatcher.stats}\n\nSend scheduler: {self.send_scheduler.stats}',
+                        parse_mode=None)
+
+    async def command_grant(self, _client: Client, msg: Message, user_id: str) -> None:
+        encode = functools.partial(self.callbacks.encode, 'grant', int(user_id))
+        await self.botapp.send_message(
+            msg.chat.id,
+            'Do you want to grant user {}?'.format(
+                TextParser.parse_user_markdown(user_id)),
+            disable_notification=True,
+            reply_to_message_id=msg.message_id,
+            reply_markup=InlineKeyboardMarkup(
+                [
+                    [InlineKeyboardButton('CHANGE INFO', encode('info')),
+                     InlineKeyboardButton('PIN', encode('pin'))],
+                    [InlineKeyboardButton('RESTRICT', encode('restrict')),
+                     InlineKeyboardButton('DELETE', encode('delete'))],
+                    [InlineKeyboardButton('confirm', self.callbacks.encode('grant_confirm', int(user_id))),
+                     InlineKeyboardButton('[DEBUG]Clear', self.callbacks.encode('grant_clear', int(user_id)))],
+                    [InlineKeyboardButton('cancel', self.callbacks.encode('cancel'))]
+                ]))
 
     async def func_auth_process(self, _client: Client, msg: Message) -> None:
         if not self.auth_system.check_ex(msg.from_user.id):
@@ -595,9 +808,9 @@ class BotController:
                     reply_markup=InlineKeyboardMarkup(
                         inline_keyboard=[
                             [
-                                InlineKeyboardButton(text='Yes', callback_data='auth {} add'.format(
-                                    msg.reply_to_message.from_user.id)),
-                                InlineKeyboardButton(text='No', callback_data='cancel')
+                                InlineKeyboardButton(text='Yes', callback_data=self.callbacks.encode(
+                                    'auth', msg.reply_to_message.from_user.id)),
+                                InlineKeyboardButton(text='No', callback_data=self.callbacks.encode('cancel'))
                             ]
                         ]
                     )
@@ -607,9 +820,11 @@ class BotController:
 
     async def cross_group_forward_request(self, msg: Message) -> None:
         kb = [
-            [InlineKeyboardButton(text='Yes, I know what I\'m doing.', callback_data='fwd original')],
-            [InlineKeyboardButton(text='Yes, but don\'t use forward.', callback_data='fwd text')],
-            [InlineKeyboardButton(text='No, please don\'t.', callback_data='cancel d')]
+            [InlineKeyboardButton(text='Yes, I know what I\'m doing.',
+                                  callback_data=self.callbacks.encode('fwd_original'))],
+            [InlineKeyboardButton(text='Yes, but don\'t use forward.',
+                                  callback_data=self.callbacks.encode('fwd_text'))],
+            [InlineKeyboardButton(text='No, please don\'t.', callback_data=self.callbacks.encode('cancel_delete'))]
         ]
         if msg.text is None: kb.pop(1)
         await self.botapp.send_message(
@@ -624,17 +839,19 @@ class BotController:
 
     async def handle_new_member(self, client: Client, msg: Message) -> None:
         for new_user_id in (x.id for x in msg.new_chat_members):
-            # Exam check goes here
-            try:
-                if not await self.join_group_verify.query_user_passed(new_user_id):
-                    await self.botapp.kick_chat_member(self.target_group, new_user_id)
-                    await self.botapp.send_message(self.fudu_group, 'Kicked challenge failure user {}'.format(
-                        TextParser.parse_user_markdown(new_user_id)), 'markdown')
-            except BotController.ByPassVerify:
-                pass
-            except:
-                logger.exception('Exception occurred!')
-            if await self.conn.query_user_in_banlist(new_user_id):
+            if self.join_group_verify is not None:
+                self.join_group_verify.member_status.put(new_user_id, 'member')
+                # Exam check goes here
+                try:
+                    if not self.join_group_verify.is_passed(new_user_id):
+                        await self.botapp.kick_chat_member(self.target_group, new_user_id)
+                        await self.botapp.send_message(self.fudu_group, 'Kicked challenge failure user {}'.format(
+                            TextParser.parse_user_markdown(new_user_id)), 'markdown')
+                except BotController.ByPassVerify:
+                    pass
+                except:
+                    logger.exception('Exception occurred!')
+            if self.conn.in_banlist(new_user_id):
                 await self.botapp.kick_chat_member(msg.chat.id, new_user_id)
         await self.conn.insert(
             msg,
@@ -661,19 +878,16 @@ class BotController:
     async def handle_edit(self, client: Client, msg: Message) -> None:
         if msg.via_bot and msg.via_bot.id == 166035794:
             return
-        target_id = await self.conn.get_id(msg.message_id)
+        target_id = await self.conn.wait_id(msg.message_id, self.EDIT_WAIT_TIMEOUT)
         if target_id is None:
-            logging.warning('Sleep 2 seconds for edit')
-            await asyncio.sleep(2)
-            target_id = await self.conn.get_id(msg.message_id)
-            if target_id is None:
-                return logger.error('Editing Failure: get_id return None')
+            return logger.error('Editing Failure: get_id return None')
         try:
+            text, render_kwargs = await self.render(client, 'edit', msg, caption=not msg.text)
             await (client.edit_message_text if msg.text else client.edit_message_caption)(
                 self.fudu_group,
                 target_id,
-                TextParser(msg).get_full_message(),
-                'html'
+                text,
+                **render_kwargs
             )
         except pyrogram.errors.MessageNotModified:
             logging.warning('Editing Failure: MessageNotModified')
@@ -681,71 +895,131 @@ class BotController:
             logger.exception('Exception occurred!')
 
     async def handle_sticker(self, client: Client, msg: Message) -> None:
-        await self.conn.insert(
-            msg,
-            await client.send_message(
-                self.fudu_group,
-                f'{TextParser(msg).get_full_message()} {msg.sticker.emoji} sticker',
-                parse_mode='html',
-                disable_web_page_preview=True,
-                disable_notification=True,
-                reply_to_message_id=await self.conn.get_reply_id(msg),
+        text, render_kwargs = await self.render(client, 'sticker', msg, suffix=f' {msg.sticker.emoji} sticker')
+        with self.conn.forwarding(msg.message_id):
+            await self.conn.insert(
+                msg,
+                await client.send_message(
+                    self.fudu_group,
+                    text,
+                    **render_kwargs,
+                    disable_web_page_preview=True,
+                    disable_notification=True,
+                    reply_to_message_id=await self.conn.get_reply_id(msg),
+                )
             )
-        )
 
     async def _get_reply_id(self, msg: Message, reverse: bool = False) -> Optional[int]:
         if msg.reply_to_message is None:
             return None
-        return await self.conn.get_id(msg.reply_to_message.message_id, reverse)
-
-    async def send_media(self, client: Client, msg: Message, send_to: int, caption: str, reverse: bool = False) -> None:
+        return await self.conn.get_id(msg.reply_to_message.message_id, reverse, msg.reply_to_message.date)
+
+    async def render(self, client: Client, path: str, msg: Message, full: bool = True, caption: bool = False,
+                     suffix: str = '') -> Tuple[str, Dict[str, Any]]:
+        parser = TextParser(msg)
+        if self.render_mode[path] == 'html':
+            return (parser.get_full_message() if full else parser.split_offset()) + suffix, {'parse_mode': 'html'}
+        text, entities = parser.get_full_message_entities() if full else parser.get_entities()
+        if any(_entity.type == 'text_mention' for _entity in entities):
+            # The HTML parser drops mentions of users it can not resolve, do the same
+            resolved = []
+            for _entity in entities:
+                if _entity.type == 'text_mention':
+                    try:
+                        await client.resolve_peer(_entity.user.id)
+                    except pyrogram.errors.PeerIdInvalid:
+                        continue
+                resolved.append(_entity)
+            entities = resolved
+        # parse_mode has to be None, an empty entity list makes pyrogram parse the text with the default mode
+        return text + suffix, {'parse_mode': None, 'caption_entities' if caption else 'entities': entities}
+
+    async def send_media(self, client: Client, msg: Message, send_to: int) -> None:
         msg_type = self.get_file_type(msg)
-        while True:
+        try:
+            caption, render_kwargs = await self.render(client, 'media', msg, caption=True)
+            _msg = await client.send_cached_media(
+                send_to,
+                self.get_file_id(msg, msg_type),
+                # self.get_file_ref(msg, msg_type),
+                caption=caption,
+                **render_kwargs,
+                disable_notification=True,
+                reply_to_message_id=await self._get_reply_id(msg)
+            )
+            await self.conn.insert(msg, _msg)
+        except:
+            logger.exception('Exception occurred!')
+
+    async def copy_media(self, msg: Message) -> None:
+        # File ids belong to the account which received them, so let the bot fetch the message and send it itself
+        try:
+            caption, render_kwargs = await self.render(self.botapp, 'incoming', msg, False, True)
+            _msg = await self.botapp.copy_message(
+                self.target_group,
+                msg.chat.id,
+                msg.message_id,
+                caption,
+                **render_kwargs,
+                disable_notification=True,
+                reply_to_message_id=await self.conn.get_reply_id_reverse(msg)
+            )
+            await self.conn.insert_ex(_msg.message_id, msg.message_id)
+        except:
+            logger.exception('Exception occurred!')
+
+    @classmethod
+    def get_input_media(cls, msg: Message, caption: str) -> InputMedia:
+        msg_type = cls.get_file_type(msg)
+        return cls.INPUT_MEDIA_TYPES[msg_type](cls.get_file_id(msg, msg_type), caption=caption, parse_mode='html')
+
+    async def send_media_group(self, client: Client, send_to: int, reverse: bool, messages: List[Message]) -> None:
+        with contextlib.ExitStack() as stack:
+            if not reverse:
+                for msg in messages:
+                    stack.enter_context(self.conn.forwarding(msg.message_id))
             try:
-                _msg = await client.send_cached_media(
+                media = messages
+                if reverse:
+                    media = await client.get_messages(messages[0].chat.id, [msg.message_id for msg in messages])
+                sent = await client.send_media_group(
                     send_to,
-                    self.get_file_id(msg, msg_type),
-                    # self.get_file_ref(msg, msg_type),
-                    caption=caption,
-                    parse_mode='html',
+                    [self.get_input_media(x, TextParser(msg).split_offset() if reverse else
+                                          TextParser(msg).get_full_message()) for msg, x in zip(messages, media)],
                     disable_notification=True,
-                    reply_to_message_id=await self._get_reply_id(msg, reverse)
+                    reply_to_message_id=await self._get_reply_id(messages[0], reverse)
                 )
                 if reverse:
-                    await self.conn.insert_ex(_msg.message_id, int(msg.caption.split()[1]))
+                    rows = [(_msg.message_id, msg.message_id, None) for msg, _msg in zip(messages, sent)]
                 else:
-                    await self.conn.insert(msg, _msg)
-                break
-
-            except pyrogram.errors.FloodWait as e:
-                logger.warning('Pause %d seconds because 420 flood wait', e.x)
-                await asyncio.sleep(e.x)
+                    rows = [(msg.message_id, _msg.message_id, msg.from_user.id if msg.from_user else None)
+                            for msg, _msg in zip(messages, sent)]
+                await self.conn.insert_many(rows)
             except:
                 logger.exception('Exception occurred!')
-                break
 
     async def handle_all_media(self, client: Client, msg: Message) -> None:
-        await self.send_media(client, msg, self.fudu_group, TextParser(msg).get_full_message())
+        if msg.media_group_id and self.get_file_type(msg) in self.INPUT_MEDIA_TYPES:
+            self.media_group_collector.collect(
+                msg, functools.partial(self.send_media_group, client, self.fudu_group, False))
+            return
+        with self.conn.forwarding(msg.message_id):
+            await self.send_media(client, msg, self.fudu_group)
 
     async def handle_dice(self, client: Client, msg: Message) -> None:
-        if msg.dice:
+        text, render_kwargs = await self.render(client, 'dice', msg, suffix=f' {msg.dice.emoji} dice[{msg.dice.value}]')
+        with self.conn.forwarding(msg.message_id):
             await self.conn.insert(
                 msg,
                 await client.send_message(
                     self.fudu_group,
-                    '{} {} dice[{}]'.format(
-                        TextParser(msg).get_full_message(),
-                        msg.dice.emoji,
-                        msg.dice.value
-                    ),
-                    'html',
+                    text,
+                    **render_kwargs,
                     disable_web_page_preview=True,
                     disable_notification=True,
                     reply_to_message_id=await self.conn.get_reply_id(msg)
                 )
             )
-        else:
-            raise ContinuePropagation()
 
     @staticmethod
     def get_file_id(msg: Message, _type: str) -> str:
@@ -768,43 +1042,31 @@ class BotController:
     async def handle_speak(self, client: Client, msg: Message) -> None:
         if msg.text.startswith('/') and re.match(r'^/\w+(@\w*)?$', msg.text):
             return
-        await self.conn.insert(
-            msg,
-            await client.send_message(
-                self.fudu_group,
-                TextParser(msg).get_full_message(),
-                'html',
-                disable_web_page_preview=not msg.web_page,
-                disable_notification=True,
-                reply_to_message_id=await self.conn.get_reply_id(msg)
+        text, render_kwargs = await self.render(client, 'speak', msg)
+        with self.conn.forwarding(msg.message_id):
+            await self.conn.insert(
+                msg,
+                await client.send_message(
+                    self.fudu_group,
+                    text,
+                    **render_kwargs,
+                    disable_web_page_preview=not msg.web_page,
+                    disable_notification=True,
+                    reply_to_message_id=await self.conn.get_reply_id(msg)
+                )
             )
-        )
-
-    async def handle_bot_send_media(self, client: Client, msg: Message) -> None:
-        def parse_caption(caption: str) -> str:
-            obj = caption.split(maxsplit=3)
-            return '' if len(obj) < 3 else obj[-1]
-
-        await self.send_media(client, msg, self.target_group, parse_caption(TextParser(msg).split_offset()),
-                              True)
 
     async def handle_incoming(self, client: Client, msg: Message) -> None:
         # NOTE: Remove debug code and other handle code from offical version
-        await client.send(
-            raw.functions.channels.ReadHistory(channel=await client.resolve_peer(msg.chat.id), max_id=msg.message_id))
-        if msg.reply_to_message:
-            await client.send(raw.functions.messages.ReadMentions(peer=await client.resolve_peer(msg.chat.id)))
-        if msg.text == '/auth' and msg.reply_to_message:
-            return await self.func_auth_process(client, msg)
+        self.read_acknowledger.acknowledge(msg)
+        command = self.commands.match(msg.text)
+        if command is not None and not command[0].authorized:
+            return await self.commands.invoke(*command, client, msg)
 
         if not self.auth_system.check_ex(msg.from_user.id):
             return
-        if msg.text and re.match(
-                r'^/(bot (on|off)|del|get|fw|ban( ([1-9]\d*)[smhd]|f)?|kick( confirm| -?\d+)?|status|b?o(n|ff)|join|'
-                r'promote( \d+)?|set [a-zA-Z]|pina?|su(do)?|title .*|warnd? .*|grant \d+|report)$',
-                msg.text
-        ):
-            return await self.process_incoming_command(client, msg)
+        if command is not None:
+            return await self.commands.invoke(*command, client, msg)
         if msg.text and msg.text.startswith('/') and re.match(r'^/\w+(@\w*)?$', msg.text):
             return
         if self.auth_system.check_muted(msg.from_user.id) or (msg.text and msg.text.startswith('//')) or (
@@ -820,37 +1082,34 @@ class BotController:
                 (await self.botapp.forward_messages(self.target_group, self.fudu_group, msg.message_id)).message_id,
                 msg.message_id)
 
-        elif msg.text and (
-                not msg.edit_date or (msg.edit_date and await self.conn.get_id(msg.message_id, True) is None)):
+        elif msg.text and (not msg.edit_date or (
+                msg.edit_date and await self.conn.get_id(msg.message_id, True, msg.date) is None)):
+            text, render_kwargs = await self.render(self.botapp, 'incoming', msg, False)
             await self.conn.insert_ex(
                 (await self.botapp.send_message(
                     self.target_group,
-                    TextParser(msg).split_offset(),
-                    'html',
+                    text,
+                    **render_kwargs,
                     disable_web_page_preview=not msg.web_page,
                     reply_to_message_id=await self.conn.get_reply_id_reverse(msg),
                 )).message_id, msg.message_id
             )
 
+        elif msg.media_group_id and self.get_file_type(msg) in self.INPUT_MEDIA_TYPES:
+            self.media_group_collector.collect(
+                msg, functools.partial(self.send_media_group, self.botapp, self.target_group, True))
+
         elif msg.photo or msg.video or msg.animation or msg.document:
-            _type = self.get_file_type(msg)
-            await (await client.send_cached_media(
-                msg.chat.id,
-                self.get_file_id(msg, _type),
-                # self.get_file_ref(msg, _type),
-                f'/SendMedia {msg.message_id} {TextParser(msg).split_offset()}',
-                parse_mode='html',
-                disable_notification=True,
-                reply_to_message_id=msg.reply_to_message.message_id if msg.reply_to_message else None
-            )).delete()
+            await self.copy_media(msg)
 
         elif msg.edit_date:
             try:
+                text, render_kwargs = await self.render(self.botapp, 'incoming', msg, False, not msg.text)
                 await (self.botapp.edit_message_text if msg.text else self.botapp.edit_message_caption)(
                     self.target_group,
-                    await self.conn.get_id(msg.message_id, True),
-                    TextParser(msg).split_offset(),
-                    parse_mode='html',
+                    await self.conn.get_id(msg.message_id, True, msg.date),
+                    text,
+                    **render_kwargs,
                     disable_web_page_preview=not msg.web_page
                 )
             except:
@@ -864,246 +1123,235 @@ class BotController:
                 msg.message_id
             )
 
+    def init_callbacks(self) -> None:
+        # Action ids are part of callback_data, never reuse or renumber them. JoinGroupVerify uses 64 and up
+        add = self.callbacks.add
+        add(1, 'cancel', self.callback_cancel)
+        add(2, 'cancel_delete', self.callback_cancel_delete)
+        # Sent by older versions, same as cancel
+        add(3, 'rm', self.callback_cancel)
+        add(4, 'res', self.callback_res, int, str, int, timeout=20)
+        add(5, 'unban', self.callback_unban, int)
+        add(6, 'auth', self.callback_auth, int, timeout=20)
+        add(7, 'fwd_original', functools.partial(self.callback_fwd, True), timeout=30)
+        add(8, 'fwd_text', functools.partial(self.callback_fwd, False), timeout=30)
+        add(9, 'kick', self.callback_kick, int, int, timeout=15)
+        add(10, 'kick_confirm', self.callback_kick_confirm, int, int, timeout=10)
+        add(11, 'promote', self.callback_promote, int, timeout=10)
+        add(12, 'promote_undo', self.callback_promote_undo, int)
+        add(13, 'grant', self.callback_grant, int, str, timeout=40)
+        add(14, 'grant_confirm', self.callback_grant_confirm, int)
+        add(15, 'grant_undo', self.callback_grant_undo, int)
+        add(16, 'grant_clear', self.callback_grant_clear, int)
+        add(17, 'unpin', self.callback_unpin)
+        add(18, 'warndel', self.callback_warndel, int, int)
+
     async def handle_callback(self, client: Client, msg: CallbackQuery) -> None:
         if msg.message.chat.id < 0 and msg.message.chat.id != self.fudu_group: return
-        args = msg.data.split()
         try:
-            if msg.data.startswith('cancel') or msg.data == 'rm':
-                if msg.data.endswith('d'):
-                    await msg.message.delete()
-                else:
-                    await msg.edit_message_reply_markup()
-
-            if self.join_group_verify_enable and \
-                    self.join_group_verify is not None and \
-                    await self.join_group_verify.click_to_join(client, msg):
-                return
-
-            if msg.data.startswith('res'):
-                if time.time() - msg.message.date > 20:
-                    raise OperationTimeoutError()
-                _, dur, _type, _user_id = args
-                if await client.restrict_chat_member(
-                        self.target_group,
-                        int(_user_id),
-                        {
-                            'write': ChatPermissions(can_send_messages=True),
-                            'media': ChatPermissions(can_send_media_messages=True),
-                            'stickers': ChatPermissions(can_send_stickers=True),
-                            'link': ChatPermissions(can_add_web_page_previews=True),
-                            'read': ChatPermissions()
-                        }.get(_type),
-                        int(time.time()) + int(dur)
-                ):
-                    await msg.answer('The user is restricted successfully.')
-                    await client.edit_message_text(
-                        msg.message.chat.id,
-                        msg.message.message_id,
-                        'Restrictions applied to {} Duration: {}'.format(
-                            TextParser.parse_user_markdown(_user_id),
-                            f'{dur}s' if int(dur) else 'Forever'),
-                        parse_mode='markdown',
-                        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(
-                            text='UNBAN', callback_data=f'unban {_user_id}')]])
-                    )
-
-            elif msg.data.startswith('unban'):
-                if await client.restrict_chat_member(self.target_group, int(args[-1]), ChatPermissions(
-                        can_send_messages=True,
-                        can_send_stickers=True,
-                        can_send_polls=True,
-                        can_add_web_page_previews=True,
-                        can_send_media_messages=True,
-                        can_send_animations=True,
-                        can_pin_messages=True,
-                        can_invite_users=True,
-                        can_change_info=True
-                )):
-                    await asyncio.gather(msg.answer('Unban successfully'),
-                                         client.edit_message_reply_markup(msg.message.chat.id, msg.message.message_id))
-
-            elif msg.data.startswith('auth'):
-                if time.time() - msg.message.date > 20:
-                    raise OperationTimeoutError()
-                await self.auth_system.add_user(args[1])
-                await asyncio.gather(msg.answer(f'{args[1]} added to the authorized group'),
-                                     msg.message.edit(f'{args[1]} added to the authorized group'))
-
-            elif msg.data.startswith('fwd'):
-                if time.time() - msg.message.date > 30:
-                    raise OperationTimeoutError()
-                if 'original' in msg.data:
-                    # Process original forward
-                    await self.conn.insert_ex(
-                        (await client.forward_messages(
-                            self.target_group,
-                            msg.message.chat.id,
-                            msg.message.reply_to_message.message_id)
-                         ).message_id,
-                        msg.message.reply_to_message.message_id
-                    )
-                else:
-                    await self.conn.insert_ex((await client.send_message(self.target_group, TextParser(
-                        msg.message.reply_to_message).split_offset(), 'html')).message_id,
-                                              msg.message.reply_to_message.message_id)
-                await asyncio.gather(msg.answer('Forward successfully'), msg.message.delete())
-
-            elif msg.data.startswith('kick'):
-                # _TODO: Process parallel request (deprecated)
-                if not msg.data.startswith('kickc') and msg.from_user.id != int(args[-2]):
-                    raise OperatorError()
-                if 'true' not in msg.data:
-                    if not msg.data.startswith('kickc') and time.time() - msg.message.date > 15:
-                        raise OperationTimeoutError()
-                    client_args = [
-                        msg.message.chat.id,
-                        msg.message.message_id,
-                        'Press the button again to kick {}\n'
-                        'This confirmation message will expire after 10 seconds.'.format(
-                            TextParser.parse_user_markdown(args[-1])
-                        ),
-                    ]
-                    if msg.data.startswith('kickc'):
-                        client_args.pop(1)
-                        r = list(client_args)
-                        r.insert(1, msg.from_user.id)
-                        msg.data = ' '.join(map(str, r))
-                        del r
-                    kwargs = {
-                        'parse_mode': 'markdown',
-                        'reply_markup': InlineKeyboardMarkup(inline_keyboard=[
-                            [InlineKeyboardButton(text='Yes, please.',
-                                                  callback_data=' '.join(('kick true', ' '.join(map(str, args[1:])))))],
-                            [InlineKeyboardButton(text='Cancel', callback_data='cancel')]
-                        ])
-                    }
-                    await (client.send_message if msg.data.startswith('kickc') else client.edit_message_text)(
-                        *client_args, **kwargs)
-                    await msg.answer(
-                        f'Please press again to make sure. Do you really want to kick {args[-1]} ?', True)
-                else:
-                    if msg.message.edit_date:
-                        if time.time() - msg.message.edit_date > 10:
-                            raise OperationTimeoutError()
-                    else:
-                        if time.time() - msg.message.date > 10:
-                            raise OperationTimeoutError()
-                    await client.kick_chat_member(self.target_group, int(args[-1]))
-                    await asyncio.gather(msg.answer(f'Kicked {args[-1]}'),
-                                         msg.message.edit(f'Kicked {TextParser.parse_user_markdown(args[-1])}'))
-
-            elif msg.data.startswith('promote'):
-                if not msg.data.endswith('undo'):
-                    if time.time() - msg.message.date > 10:
-                        raise OperationTimeoutError()
-                    await self.botapp.promote_chat_member(
-                        self.target_group,
-                        int(args[1]),
-                        True,
-                        can_delete_messages=True,
-                        can_restrict_members=True,
-                        can_invite_users=True,
-                        can_pin_messages=True,
-                        can_promote_members=True,
-                    )
-                    await msg.answer('Promote successfully')
-                    await msg.message.edit(
-                        f'Promoted {TextParser.parse_user_markdown(int(args[1]))}',
-                        parse_mode='markdown',
-                        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                            [InlineKeyboardButton(text='UNDO', callback_data=' '.join((msg.data, 'undo')))],
-                            [InlineKeyboardButton(text='remove button', callback_data='rm')]])
-                    )
-                else:
-                    await self.botapp.promote_chat_member(
-                        self.target_group, int(args[1]),
-                        False,
-                        can_delete_messages=False,
-                        can_invite_users=False,
-                        can_restrict_members=False
-                    )
-                    await asyncio.gather(
-                        msg.answer('Undo Promote successfully'),
-                        msg.message.edit(
-                            f'Undo promoted {TextParser.parse_user_markdown(int(args[1]))}',
-                            parse_mode='markdown')
-                    )
-
-            elif msg.data.startswith('grant'):
-                _redis_key_str = f'promote_{msg.message.chat.id}_{args[1]}'
-                if args[2] == 'confirm':
-                    select_privileges = await self._redis.get(_redis_key_str)
-                    await self._redis.delete(_redis_key_str)
-                    if select_privileges is None:
-                        raise OperationTimeoutError()
-                    grant_args = {}
-                    for x in map(lambda x: x.strip(), select_privileges.decode().split(',')):
-                        if x == 'info':
-                            grant_args.update({'can_change_info': True})
-                        elif x == 'delete':
-                            grant_args.update({'can_delete_messages': True})
-                        elif x == 'restrict':
-                            grant_args.update({'can_restrict_members': True})
-                        elif x == 'pin':
-                            grant_args.update({'can_pin_messages': True})
-                    await self.botapp.promote_chat_member(self.target_group, int(args[1]), **grant_args)
-                    await msg.message.edit('Undo grant privileges', reply_markup=InlineKeyboardMarkup(
-                        [[InlineKeyboardButton('UNDO', f'grant {args[1]} undo')]]))
-                    await msg.answer()
-                elif args[2] == 'undo':
-                    await self.botapp.promote_chat_member(self.target_group, int(args[1]), False,
-                                                          can_delete_messages=False, can_restrict_members=False)
-                    await msg.message.edit_reply_markup()
-                    await msg.answer()
-                elif args[2] == 'clear':
-                    self._redis.delete(_redis_key_str)
-                    await msg.answer()
-                else:
-                    if time.time() - msg.message.date > 40:
-                        raise OperationTimeoutError()
-                    # original_msg = msg.message.text.splitlines()[0]
-                    select_privileges = self._redis.get(_redis_key_str)
-                    if select_privileges is None:
-                        select_privileges = [args[2]]
-                        self._redis.set(_redis_key_str, select_privileges[0])
-                        self._redis.expire(_redis_key_str, 60)
-                    else:
-                        select_privileges = list(map(lambda x: x.strip(), select_privileges.decode().split(',')))
-                        if args[2] in select_privileges:
-                            if len(select_privileges) == 1:
-                                return await msg.answer('You should choose at least one privilege.', True)
-                            select_privileges.remove(args[2])
-                        else:
-                            select_privileges.append(args[2])
-                        await self._redis.set(_redis_key_str, ','.join(select_privileges))
-                    await msg.message.edit(
-                        'Do you want to grant user {}?\n\nSelect privileges:\n{}'.format(
-                            TextParser.parse_user_markdown(args[1]),
-                            '\n'.join(select_privileges)),
-                        reply_markup=msg.message.reply_markup)
-                    # return await msg.answer(f'Promoted {args[2]} permission')
-
-            elif msg.data == 'unpin':
-                await self.botapp.unpin_chat_message(self.target_group)
-                await asyncio.gather(msg.message.edit_reply_markup(),
-                                     msg.answer())
-
-            elif msg.data.startswith('warndel'):
-                await self.botapp.delete_messages(self.target_group, int(args[1]))
-                await self.conn.delete_warn_by_id(int(args[2]))
-                await asyncio.gather(msg.message.edit_reply_markup(),
-                                     msg.answer())
-
-        except OperationTimeoutError:
+            if not await self.callbacks.dispatch(client, msg):
+                await asyncio.gather(msg.answer('This button is no longer valid'), msg.edit_message_reply_markup())
+        except (OperationTimeoutError, utils.CallbackRouter.Expired):
             await asyncio.gather(msg.answer('Confirmation time out'),
                                  client.edit_message_reply_markup(msg.message.chat.id, msg.message.message_id))
-        except OperatorError:
-            await msg.answer(f'The operator should be {args[-2]}.', True)
+        except OperatorError as e:
+            await msg.answer(f'The operator should be {e.args[0]}.', True)
         except:
             await self.app.send_message(config.getint('custom_service', 'help_group'),
                                         traceback.format_exc().splitlines()[-1])
             logger.exception('Exception occurred!')
 
+    @staticmethod
+    async def callback_cancel(_client: Client, msg: CallbackQuery) -> None:
+        await msg.edit_message_reply_markup()
+
+    @staticmethod
+    async def callback_cancel_delete(_client: Client, msg: CallbackQuery) -> None:
+        await msg.message.delete()
+
+    async def callback_res(self, client: Client, msg: CallbackQuery, duration: int, _type: str, user_id: int) -> None:
+        if await client.restrict_chat_member(
+                self.target_group,
+                user_id,
+                {
+                    'write': ChatPermissions(can_send_messages=True),
+                    'media': ChatPermissions(can_send_media_messages=True),
+                    'stickers': ChatPermissions(can_send_stickers=True),
+                    'link': ChatPermissions(can_add_web_page_previews=True),
+                    'read': ChatPermissions()
+                }.get(_type),
+                int(time.time()) + duration
+        ):
+            await msg.answer('The user is restricted successfully.')
+            await client.edit_message_text(
+                msg.message.chat.id,
+                msg.message.message_id,
+                'Restrictions applied to {} Duration: {}'.format(
+                    TextParser.parse_user_markdown(user_id),
+                    f'{duration}s' if duration else 'Forever'),
+                parse_mode='markdown',
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(
+                    text='UNBAN', callback_data=self.callbacks.encode('unban', user_id))]])
+            )
+
+    async def callback_unban(self, client: Client, msg: CallbackQuery, user_id: int) -> None:
+        if await client.restrict_chat_member(self.target_group, user_id, ChatPermissions(
+                can_send_messages=True,
+                can_send_stickers=True,
+                can_send_polls=True,
+                can_add_web_page_previews=True,
+                can_send_media_messages=True,
+                can_send_animations=True,
+                can_pin_messages=True,
+                can_invite_users=True,
+                can_change_info=True
+        )):
+            await asyncio.gather(msg.answer('Unban successfully'),
+                                 client.edit_message_reply_markup(msg.message.chat.id, msg.message.message_id))
+
+    async def callback_auth(self, _client: Client, msg: CallbackQuery, user_id: int) -> None:
+        await self.auth_system.add_user(user_id)
+        await asyncio.gather(msg.answer(f'{user_id} added to the authorized group'),
+                             msg.message.edit(f'{user_id} added to the authorized group'))
+
+    async def callback_fwd(self, original: bool, client: Client, msg: CallbackQuery) -> None:
+        if original:
+            # Process original forward
+            await self.conn.insert_ex(
+                (await client.forward_messages(
+                    self.target_group,
+                    msg.message.chat.id,
+                    msg.message.reply_to_message.message_id)
+                 ).message_id,
+                msg.message.reply_to_message.message_id
+            )
+        else:
+            await self.conn.insert_ex((await client.send_message(self.target_group, TextParser(
+                msg.message.reply_to_message).split_offset(), 'html')).message_id,
+                                      msg.message.reply_to_message.message_id)
+        await asyncio.gather(msg.answer('Forward successfully'), msg.message.delete())
+
+    async def callback_kick(self, client: Client, msg: CallbackQuery, operator: int, user_id: int) -> None:
+        if msg.from_user.id != operator:
+            raise OperatorError(operator)
+        await client.edit_message_text(
+            msg.message.chat.id,
+            msg.message.message_id,
+            'Press the button again to kick {}\n'
+            'This confirmation message will expire after 10 seconds.'.format(
+                TextParser.parse_user_markdown(user_id)
+            ),
+            parse_mode='markdown',
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text='Yes, please.',
+                                      callback_data=self.callbacks.encode('kick_confirm', operator, user_id))],
+                [InlineKeyboardButton(text='Cancel', callback_data=self.callbacks.encode('cancel'))]
+            ])
+        )
+        await msg.answer(f'Please press again to make sure. Do you really want to kick {user_id} ?', True)
+
+    async def callback_kick_confirm(self, client: Client, msg: CallbackQuery, operator: int, user_id: int) -> None:
+        if msg.from_user.id != operator:
+            raise OperatorError(operator)
+        await client.kick_chat_member(self.target_group, user_id)
+        await asyncio.gather(msg.answer(f'Kicked {user_id}'),
+                             msg.message.edit(f'Kicked {TextParser.parse_user_markdown(user_id)}'))
+
+    async def callback_promote(self, _client: Client, msg: CallbackQuery, user_id: int) -> None:
+        await self.botapp.promote_chat_member(
+            self.target_group,
+            user_id,
+            True,
+            can_delete_messages=True,
+            can_restrict_members=True,
+            can_invite_users=True,
+            can_pin_messages=True,
+            can_promote_members=True,
+        )
+        await msg.answer('Promote successfully')
+        await msg.message.edit(
+            f'Promoted {TextParser.parse_user_markdown(user_id)}',
+            parse_mode='markdown',
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text='UNDO', callback_data=self.callbacks.encode('promote_undo', user_id))],
+                [InlineKeyboardButton(text='remove button', callback_data=self.callbacks.encode('cancel'))]])
+        )
+
+    async def callback_promote_undo(self, _client: Client, msg: CallbackQuery, user_id: int) -> None:
+        await self.botapp.promote_chat_member(
+            self.target_group, user_id,
+            False,
+            can_delete_messages=False,
+            can_invite_users=False,
+            can_restrict_members=False
+        )
+        await asyncio.gather(
+            msg.answer('Undo Promote successfully'),
+            msg.message.edit(
+                f'Undo promoted {TextParser.parse_user_markdown(user_id)}',
+                parse_mode='markdown')
+        )
+
+    async def callback_grant(self, _client: Client, msg: CallbackQuery, user_id: int, privilege: str) -> None:
+        if privilege not in self.GRANT_PRIVILEGES:
+            await msg.answer()
+            return
+        _redis_key_str = f'promote_{msg.message.chat.id}_{user_id}'
+        select_privileges = await self._redis.get(_redis_key_str)
+        if select_privileges is None:
+            select_privileges = [privilege]
+            await self._redis.set(_redis_key_str, select_privileges[0])
+            await self._redis.expire(_redis_key_str, 60)
+        else:
+            select_privileges = list(map(lambda x: x.strip(), select_privileges.decode().split(',')))
+            if privilege in select_privileges:
+                if len(select_privileges) == 1:
+                    return await msg.answer('You should choose at least one privilege.', True)
+                select_privileges.remove(privilege)
+            else:
+                select_privileges.append(privilege)
+            await self._redis.set(_redis_key_str, ','.join(select_privileges))
+        await msg.message.edit(
+            'Do you want to grant user {}?\n\nSelect privileges:\n{}'.format(
+                TextParser.parse_user_markdown(user_id),
+                '\n'.join(select_privileges)),
+            reply_markup=msg.message.reply_markup)
+
+    async def callback_grant_confirm(self, _client: Client, msg: CallbackQuery, user_id: int) -> None:
+        _redis_key_str = f'promote_{msg.message.chat.id}_{user_id}'
+        select_privileges = await self._redis.get(_redis_key_str)
+        await self._redis.delete(_redis_key_str)
+        if select_privileges is None:
+            raise OperationTimeoutError()
+        grant_args = {self.GRANT_PRIVILEGES[x]: True
+                      for x in map(lambda x: x.strip(), select_privileges.decode().split(','))
+                      if x in self.GRANT_PRIVILEGES}
+        await self.botapp.promote_chat_member(self.target_group, user_id, **grant_args)
+        await msg.message.edit('Undo grant privileges', reply_markup=InlineKeyboardMarkup(
+            [[InlineKeyboardButton('UNDO', self.callbacks.encode('grant_undo', user_id))]]))
+        await msg.answer()
+
+    async def callback_grant_undo(self, _client: Client, msg: CallbackQuery, user_id: int) -> None:
+        await self.botapp.promote_chat_member(self.target_group, user_id, False,
+                                              can_delete_messages=False, can_restrict_members=False)
+        await msg.message.edit_reply_markup()
+        await msg.answer()
+
+    async def callback_grant_clear(self, _client: Client, msg: CallbackQuery, user_id: int) -> None:
+        await self._redis.delete(f'promote_{msg.message.chat.id}_{user_id}')
+        await msg.answer()
+
+    async def callback_unpin(self, _client: Client, msg: CallbackQuery) -> None:
+        await self.botapp.unpin_chat_message(self.target_group)
+        await asyncio.gather(msg.message.edit_reply_markup(),
+                             msg.answer())
+
+    async def callback_warndel(self, _client: Client, msg: CallbackQuery, message_id: int, warn_id: int) -> None:
+        await self.botapp.delete_messages(self.target_group, message_id)
+        await self.conn.delete_warn_by_id(warn_id)
+        await asyncio.gather(msg.message.edit_reply_markup(),
+                             msg.answer())
+
 
 async def main():
     bot = await BotController.create()
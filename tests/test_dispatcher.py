@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# tests/test_dispatcher.py
+# Copyright (C) 2021 github.com/googlehosts Group:Z
+#
+# This module is part of googlehosts/telegram-repeater and is released under
+# the AGPL v3 License: https://www.gnu.org/licenses/agpl-3.0.txt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import unittest
+from types import SimpleNamespace
+
+from utils import OrderedDispatcher
+
+
+def make_update(chat_id: int, text: str = '') -> SimpleNamespace:
+    return SimpleNamespace(chat=SimpleNamespace(id=chat_id), text=text)
+
+
+class OrderedDispatcherTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.dispatcher = OrderedDispatcher(queue_size=2, concurrency=4)
+        self.release = asyncio.Event()
+        self.handled = []
+
+    async def asyncTearDown(self) -> None:
+        self.release.set()
+        await self.dispatcher.stop(1)
+
+    async def blocked(self, _client, update) -> None:
+        await self.release.wait()
+        self.handled.append(update)
+
+    async def record(self, _client, update) -> None:
+        self.handled.append(update)
+
+    async def test_saturated_chat_does_not_block_others(self) -> None:
+        dispatch_blocked = self.dispatcher.wrap(self.blocked)
+        dispatch = self.dispatcher.wrap(self.record)
+        # One update in the handler and a low priority lane well past its limit behind it
+        for n in range(10):
+            await asyncio.wait_for(dispatch_blocked(None, make_update(1, str(n))), 1)
+            await asyncio.sleep(0)
+        self.assertGreater(self.dispatcher.over_limit, 0)
+        other = make_update(2)
+        await asyncio.wait_for(dispatch(None, other), 1)
+        for _ in range(10):
+            await asyncio.sleep(0)
+        self.assertEqual(self.handled, [other])
+        self.release.set()
+        await self.dispatcher.stop(1)
+        self.assertEqual([update.text for update in self.handled[1:]], [str(n) for n in range(10)])
+
+    async def test_high_priority_skips_long_low_lane(self) -> None:
+        dispatch = self.dispatcher.wrap(self.blocked, lambda update: update.text.startswith('/'))
+        texts = ['0', '1', '2', '3', '4', '5', '/ban', '6']
+        for text in texts:
+            await asyncio.wait_for(dispatch(None, make_update(1, text)), 1)
+            await asyncio.sleep(0)
+        self.assertGreater(self.dispatcher.over_limit, 0)
+        self.release.set()
+        await self.dispatcher.stop(1)
+        self.assertEqual([update.text for update in self.handled], ['0', '/ban', '1', '2', '3', '4', '5', '6'])
+
+    async def test_put_waits_for_room(self) -> None:
+        for n in range(3):
+            self.dispatcher.put_nowait(1, self.blocked, None, make_update(1, str(n)))
+            await asyncio.sleep(0)
+        waiter = asyncio.create_task(self.dispatcher.put(1, self.blocked, None, make_update(1, '3')))
+        await asyncio.sleep(.05)
+        self.assertFalse(waiter.done())
+        self.release.set()
+        await asyncio.wait_for(waiter, 1)
+        await self.dispatcher.stop(1)
+        self.assertEqual([update.text for update in self.handled], ['0', '1', '2', '3'])
+        self.assertEqual(self.dispatcher.over_limit, 0)
+
+    async def test_hold_keeps_live_updates_behind_replay(self) -> None:
+        self.dispatcher.hold(1)
+        dispatch = self.dispatcher.wrap(self.record)
+        for text in ('live 1', 'replayed twice', 'live 2'):
+            await dispatch(None, make_update(1, text))
+        for n in range(4):
+            await asyncio.wait_for(self.dispatcher.put(1, self.record, None, make_update(1, f'replay {n}')), 1)
+        await asyncio.wait_for(self.dispatcher.put(1, self.record, None, make_update(1, 'replayed twice')), 1)
+        await asyncio.sleep(.05)
+        self.assertEqual([update.text for update in self.handled],
+                         ['replay 0', 'replay 1', 'replay 2', 'replay 3', 'replayed twice'])
+        self.dispatcher.release(1, lambda update: update.text == 'replayed twice')
+        await self.dispatcher.stop(1)
+        self.assertEqual([update.text for update in self.handled[5:]], ['live 1', 'live 2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# tests/test_text_parser.py
+# Copyright (C) 2021 github.com/googlehosts Group:Z
+#
+# This module is part of googlehosts/telegram-repeater and is released under
+# the AGPL v3 License: https://www.gnu.org/licenses/agpl-3.0.txt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+import random
+import unittest
+from types import SimpleNamespace
+from typing import List, Optional, Tuple
+
+from pyrogram.types import MessageEntity, User
+
+from utils import TextParser
+
+_CHARS = ('a', 'b', ' ', '<', '&', '中', 'é', '\U0001f600', '\U0001f44d', '\U0001f1fa\U0001f1f8')
+_FORMAT_TYPES = tuple(TextParser._dict)
+_USER = User(id=10001, first_name='Test')
+
+
+def legacy_parse_html_msg(text: bytes, entities: Optional[List[MessageEntity]]) -> str:
+    # parse_html_msg before it walked entity boundaries, kept as the reference output
+    result = []
+    tag_stack = []
+    if entities is None:
+        return text.decode('utf-16-le')
+    start_pos = set(_entity.offset * 2 for _entity in entities if _entity.type in TextParser.filter_keyword)
+    if not len(start_pos):
+        return text.decode('utf-16-le')
+    _close_tag_pos = -1
+    _close_tag = ''
+    _last_cut = 0
+    for _pos in range(len(text) + 1):
+        while _close_tag_pos == _pos:
+            result.append(text[_last_cut:_pos])
+            _last_cut = _pos
+            result.append(f'</{_close_tag}>'.encode('utf-16-le'))
+            if not len(tag_stack):
+                break
+            _close_tag, _close_tag_pos = tag_stack.pop()
+        if _pos in start_pos:
+            result.append(text[_last_cut:_pos])
+            _last_cut = _pos
+            for _entity in entities:
+                if _entity.offset * 2 == _pos:
+                    format_value = _entity.url
+                    if format_value is None and _entity.user:
+                        format_value = _entity.user.id
+                    result.append(f'<{TextParser._dict[_entity.type][0]}>'.format(format_value).encode('utf-16-le'))
+                    tag_stack.append((TextParser._dict[_entity.type][1], (_entity.offset + _entity.length) * 2))
+            if _close_tag_pos <= _pos:
+                _close_tag, _close_tag_pos = tag_stack.pop()
+    result.append(text[_last_cut:])
+    return b''.join(result).decode('utf-16-le')
+
+
+def parse_html_msg(text: bytes, entities: Optional[List[MessageEntity]]) -> str:
+    parser = TextParser()
+    parser._msg = SimpleNamespace(text=text, entities=entities)
+    return parser.parse_html_msg()
+
+
+class EntityBuilder:
+    def __init__(self, seed: int):
+        self.random: random.Random = random.Random(seed)
+
+    def text(self, length: int) -> Tuple[bytes, List[int]]:
+        # Entities may only start and end between characters, never inside a surrogate pair
+        chars = [self.random.choice(_CHARS) for _ in range(length)]
+        bounds = [0]
+        for char in chars:
+            bounds.append(bounds[-1] + len(char.encode('utf-16-le')) // 2)
+        return ''.join(chars).encode('utf-16-le'), bounds
+
+    def entity(self, start: int, end: int) -> MessageEntity:
+        _type = self.random.choice(_FORMAT_TYPES)
+        return MessageEntity(type=_type, offset=start, length=end - start,
+                             url=f'https://example.com/{start}' if _type == 'text_link' else None,
+                             user=_USER if _type == 'text_mention' else None)
+
+    def nested(self, bounds: List[int], start: int, end: int, depth: int) -> List[MessageEntity]:
+        if depth == 0 or end - start < 1:
+            return []
+        inner_start = self.random.randint(start, end - 1)
+        inner_end = self.random.randint(inner_start + 1, end)
+        return [self.entity(bounds[start], bounds[end])] + self.nested(bounds, inner_start, inner_end, depth - 1)
+
+    def adjacent(self, bounds: List[int]) -> List[MessageEntity]:
+        cuts = sorted(self.random.sample(range(len(bounds)), min(len(bounds), self.random.randint(2, 6))))
+        return [self.entity(bounds[a], bounds[b]) for a, b in zip(cuts, cuts[1:])]
+
+    def overlapping(self, bounds: List[int], count: int) -> List[MessageEntity]:
+        entities = []
+        for _ in range(count):
+            start = self.random.randrange(len(bounds) - 1)
+            end = self.random.randint(start + 1, len(bounds) - 1)
+            entities.append(self.entity(bounds[start], bounds[end]))
+        # Telegram sends entities ordered by offset
+        return sorted(entities, key=lambda _entity: _entity.offset)
+
+
+class ParseHtmlMsgTest(unittest.TestCase):
+    ROUNDS = 300
+
+    def assertSameAsLegacy(self, text: bytes, entities: Optional[List[MessageEntity]]) -> None:
+        self.assertEqual(parse_html_msg(text, entities), legacy_parse_html_msg(text, entities),
+                         [(_entity.type, _entity.offset, _entity.length) for _entity in entities or ()])
+
+    def test_plain(self) -> None:
+        text = 'plain \U0001f600 text'.encode('utf-16-le')
+        self.assertSameAsLegacy(text, None)
+        self.assertSameAsLegacy(text, [])
+        self.assertSameAsLegacy(text, [MessageEntity(type='mention', offset=0, length=5)])
+
+    def test_nested(self) -> None:
+        for seed in range(self.ROUNDS):
+            builder = EntityBuilder(seed)
+            text, bounds = builder.text(builder.random.randint(1, 40))
+            self.assertSameAsLegacy(text, builder.nested(bounds, 0, len(bounds) - 1, builder.random.randint(1, 5)))
+
+    def test_adjacent(self) -> None:
+        for seed in range(self.ROUNDS):
+            builder = EntityBuilder(seed)
+            text, bounds = builder.text(builder.random.randint(1, 40))
+            self.assertSameAsLegacy(text, builder.adjacent(bounds))
+
+    def test_overlapping(self) -> None:
+        for seed in range(self.ROUNDS):
+            builder = EntityBuilder(seed)
+            text, bounds = builder.text(builder.random.randint(1, 40))
+            self.assertSameAsLegacy(text, builder.overlapping(bounds, builder.random.randint(1, 6)))
+
+    def test_surrogate_pairs(self) -> None:
+        text = 'a\U0001f600b\U0001f44d\U0001f44dc'.encode('utf-16-le')
+        self.assertSameAsLegacy(text, [MessageEntity(type='bold', offset=1, length=2),
+                                       MessageEntity(type='italic', offset=1, length=7),
+                                       MessageEntity(type='code', offset=4, length=4)])
+        self.assertEqual(parse_html_msg(text, [MessageEntity(type='bold', offset=1, length=2)]),
+                         'a<b>\U0001f600</b>b\U0001f44d\U0001f44dc')
+
+    def test_non_formatting_entity_at_formatting_offset(self) -> None:
+        # Used to raise KeyError when a mention or a link started where a formatting entity did, now it is skipped
+        text = '@someone hello'.encode('utf-16-le')
+        entities = [MessageEntity(type='mention', offset=0, length=8), MessageEntity(type='bold', offset=0, length=14)]
+        with self.assertRaises(KeyError):
+            legacy_parse_html_msg(text, entities)
+        self.assertEqual(parse_html_msg(text, entities), '<b>@someone hello</b>')
+        self.assertEqual(parse_html_msg(text, entities), legacy_parse_html_msg(text, entities[1:]))
+
+
+if __name__ == '__main__':
+    unittest.main()
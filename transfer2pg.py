@@ -65,7 +65,10 @@ async def main() -> None:
                                   '''INSERT INTO "exam_user_session" VALUES ($1, 1, $2, $3, $4, $5, $6, $7, $8)''',
                                   transfer_stage_2)
             await exec_and_insert(cursor, "SELECT * FROM msg_id", pgsql_connection,
-                                  '''INSERT INTO "msg_id" VALUES ($1, $2, $3, $4)''')
+                                  '''WITH "key" AS (
+                                      INSERT INTO "msg_id_key" VALUES ($1, $3) ON CONFLICT DO NOTHING RETURNING "msg_id"
+                                  )
+                                  INSERT INTO "msg_id" SELECT $1, $2, $3, $4 FROM "key"''')
             await exec_and_insert(cursor, "SELECT * FROM reasons", pgsql_connection,
                                   '''INSERT INTO reasons VALUES ($1, $2, $3, $4, $5)''')
             await exec_and_insert(cursor, "SELECT * FROM tickets", pgsql_connection,
@@ -123,7 +126,7 @@ async def clean(pgsql_connection: asyncpg.connection) -> None:
     await pgsql_connection.execute('''TRUNCATE "auth_user"''')
     await pgsql_connection.execute('''TRUNCATE "banlist"''')
     await pgsql_connection.execute('''TRUNCATE "exam_user_session"''')
-    await pgsql_connection.execute('''TRUNCATE "msg_id"''')
+    await pgsql_connection.execute('''TRUNCATE "msg_id", "msg_id_key"''')
     await pgsql_connection.execute('''TRUNCATE "reasons"''')
     await pgsql_connection.execute('''TRUNCATE "tickets"''')
     await pgsql_connection.execute('''TRUNCATE "tickets_user"''')
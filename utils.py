@@ -20,27 +20,47 @@
 # along with this program. If not, see <https://www.gnu.org/licenses/>.
 from __future__ import annotations
 import asyncio
+import base64
+import bisect
 import concurrent.futures
+import contextlib
+import itertools
+import json
 import logging
+import multiprocessing
+import multiprocessing.connection
+import os
 import random
+import re
+import signal
 import string
+import struct
 import time
 import traceback
 import warnings
+from collections import OrderedDict, deque
 from configparser import ConfigParser
 from dataclasses import dataclass
-from typing import Dict, List, Optional, Sequence, Tuple, TypeVar, Union
+from datetime import datetime, timedelta
+from typing import (Any, AsyncIterator, Awaitable, Callable, Deque, Dict,
+                    FrozenSet, Iterable, List, Mapping, Optional, Sequence,
+                    Set, Tuple, TypeVar, Union)
 
 import asyncpg
-from pyrogram import Client
+from pyrogram import Client, ContinuePropagation, StopPropagation, raw
 from pyrogram.errors import FloodWait
-from pyrogram.types import (InlineKeyboardButton, InlineKeyboardMarkup,
-                            Message, MessageEntity, User)
+from pyrogram.raw.core import TLObject
+from pyrogram.types import (CallbackQuery, InlineKeyboardButton,
+                            InlineKeyboardMarkup, Message, MessageEntity,
+                            User)
+
+import migrate
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 _FixedDataType = TypeVar('_FixedDataType', str, bool, int)
+_T = TypeVar('_T')
 
 
 class TextParser:
@@ -89,45 +109,85 @@ class TextParser:
     }
 
     filter_keyword = tuple(key for key, _ in _dict.items())
+    _close_tags = {key: f'</{value[1]}>'.encode('utf-16-le') for key, value in _dict.items()}
+
+    # Subclasses set their own cache, parse_message() results depend on their post_process()
+    _parse_cache: Optional[ParseCache] = None
+    HEADER_CACHE_SIZE = 1024
+    _header_cache: Dict[Tuple[int, str, str, int], str] = {}
 
     def __init__(self):
         self._msg: Message = None
-        self.parsed_msg: str = ''
+        self._entry: Optional[ParseCache.Entry] = None
+
+    def parse_message(self, msg: Message) -> None:
+        # HTML and entities are rendered on first use, the entity mode never needs the HTML
+        key = (msg.chat.id, msg.message_id, msg.edit_date)
+        entry = self._parse_cache.get(key) if self._parse_cache is not None else None
+        if entry is None:
+            entry = ParseCache.Entry(self.BuildMessage(msg))
+            if self._parse_cache is not None:
+                self._parse_cache.put(key, entry)
+        self._entry = entry
+        self._msg = entry.build
+
+    @property
+    def parsed_msg(self) -> str:
+        if self._entry is None:
+            return ''
+        if self._entry.parsed_msg is None:
+            self._entry.parsed_msg = self.post_process(self.parse_main())
+        return self._entry.parsed_msg
+
+    def post_process(self, parsed_msg: str) -> str:
+        return parsed_msg
 
     def parse_html_msg(self) -> str:
+        # Only positions where a tag opens or the current tag closes matter, so walk those instead of every byte.
+        # Tags are closed exactly as before (the current one first, then whatever is on top of the stack), which
+        # keeps the output unchanged for nested and overlapping entities.
+        text = self._msg.text
+        if not self._msg.entities:
+            return text.decode('utf-16-le')
+        start_entities: Dict[int, List[MessageEntity]] = {}
+        for _entity in self._msg.entities:
+            if _entity.type in self._dict:
+                start_entities.setdefault(_entity.offset * 2, []).append(_entity)
+        if not start_entities:
+            return text.decode('utf-16-le')
+        view = memoryview(text)
         result = []
         tag_stack = []
-        # self.text = msg['text'].encode(_ENCODE)
-        if self._msg.entities is None:
-            return self._msg.text.decode('utf-16-le')
-        start_pos = set(_entity.offset * 2 for _entity in self._msg.entities if _entity.type in self.filter_keyword)
-        if not len(start_pos):
-            return self._msg.text.decode('utf-16-le')
-        # print(start_pos)
         _close_tag_pos = -1
-        _close_tag = ''
+        _close_tag = b''
         _last_cut = 0
-        for _pos in range(len(self._msg.text) + 1):
-            while _close_tag_pos == _pos:
-                result.append(self._msg.text[_last_cut:_pos])
-                _last_cut = _pos
-                result.append(f'</{_close_tag}>'.encode('utf-16-le'))
-                if not len(tag_stack):
-                    break
-                _close_tag, _close_tag_pos = tag_stack.pop()
-            if _pos in start_pos:
-                result.append(self._msg.text[_last_cut:_pos])
-                _last_cut = _pos
-                for _entity in self._msg.entities:
-                    if _entity.offset * 2 == _pos:
-                        format_value = _entity.url
-                        if format_value is None and _entity.user:
-                            format_value = _entity.user.id
-                        result.append(f'<{self._dict[_entity["type"]][0]}>'.format(format_value).encode('utf-16-le'))
-                        tag_stack.append((self._dict[_entity.type][1], (_entity.offset + _entity.length) * 2))
-                if _close_tag_pos <= _pos:
+        _done_pos = -1
+        for _pos in itertools.chain(sorted(start_entities), (None,)):
+            _limit = len(text) if _pos is None else min(_pos, len(text))
+            while _done_pos < _close_tag_pos <= _limit:
+                _at = _close_tag_pos
+                while _close_tag_pos == _at:
+                    result.append(view[_last_cut:_at])
+                    _last_cut = _at
+                    result.append(_close_tag)
+                    if not len(tag_stack):
+                        break
                     _close_tag, _close_tag_pos = tag_stack.pop()
-        result.append(self._msg.text[_last_cut:])
+                _done_pos = _at
+            if _pos is None or _pos > len(text):
+                break
+            result.append(view[_last_cut:_pos])
+            _last_cut = _pos
+            for _entity in start_entities[_pos]:
+                format_value = _entity.url
+                if format_value is None and _entity.user:
+                    format_value = _entity.user.id
+                result.append(f'<{self._dict[_entity.type][0]}>'.format(format_value).encode('utf-16-le'))
+                tag_stack.append((self._close_tags[_entity.type], (_entity.offset + _entity.length) * 2))
+            if _close_tag_pos <= _pos:
+                _close_tag, _close_tag_pos = tag_stack.pop()
+            _done_pos = _pos
+        result.append(view[_last_cut:])
         return b''.join(result).decode('utf-16-le')
 
     def parse_main(self) -> str:
@@ -137,17 +197,106 @@ class TextParser:
         return self.parsed_msg
 
     def get_full_message(self) -> str:
-        return ''.join(('<b>',
-                        self._msg.user_name[:30],
-                        ' (\u21a9 {})'.format(self._msg.forward_from[:30]) if self._msg.forward_from != '' else '',
-                        '</b>',
-                        '<a href="https://t.me/c/',
-                        str(-self._msg.chat_id - 1000000000000),
-                        '/',
-                        str(self._msg.message_id),
-                        '">:</a> ',
-                        self.parsed_msg
-                        ))
+        if self._entry is not None and self._entry.full_message is not None:
+            return self._entry.full_message
+        key = (self._msg.user_id, self._msg.user_name, self._msg.forward_from, self._msg.chat_id)
+        header = self._header_cache.get(key)
+        if header is None:
+            forward_from = self._msg.forward_from
+            header = ''.join(('<b>',
+                              self._msg.user_name[:30],
+                              ' (\u21a9 {})'.format(forward_from[:30]) if forward_from != '' else '',
+                              '</b>',
+                              '<a href="https://t.me/c/',
+                              str(-self._msg.chat_id - 1000000000000),
+                              '/'))
+            if len(self._header_cache) >= self.HEADER_CACHE_SIZE:
+                del self._header_cache[next(iter(self._header_cache))]
+            self._header_cache[key] = header
+        full_message = ''.join((header, str(self._msg.message_id), '">:</a> ', self.parsed_msg))
+        if self._entry is not None:
+            self._entry.full_message = full_message
+        return full_message
+
+    def post_process_entities(self, text: str, entities: List[MessageEntity]) -> Tuple[str, List[MessageEntity]]:
+        return text, entities
+
+    def get_entities(self) -> Tuple[str, List[MessageEntity]]:
+        # Same entities parse_html_msg renders, but handed to Telegram as they are instead of through HTML
+        if self._entry is not None and self._entry.entities is not None:
+            return self._entry.entities
+        result = self.post_process_entities(
+            self._msg.text.decode('utf-16-le'),
+            [_entity for _entity in self._msg.entities or () if _entity.type in self._dict])
+        if self._entry is not None:
+            self._entry.entities = result
+        return result
+
+    def get_full_message_entities(self) -> Tuple[str, List[MessageEntity]]:
+        if self._entry is not None and self._entry.full_entities is not None:
+            return self._entry.full_entities
+        text, entities = self.get_entities()
+        forward_from = self._msg.forward_from
+        header = ''.join((self._msg.user_name[:30],
+                          ' (\u21a9 {})'.format(forward_from[:30]) if forward_from != '' else ''))
+        header_length = self.utf16_len(header)
+        full_entities = [
+            MessageEntity(type='bold', offset=0, length=header_length),
+            MessageEntity(type='text_link', offset=header_length, length=1,
+                          url=f'https://t.me/c/{-self._msg.chat_id - 1000000000000}/{self._msg.message_id}')
+        ]
+        full_entities.extend(self.copy_entity(_entity, _entity.offset + header_length + 2, _entity.length)
+                             for _entity in entities)
+        result = ''.join((header, ': ', text)), full_entities
+        if self._entry is not None:
+            self._entry.full_entities = result
+        return result
+
+    @staticmethod
+    def utf16_len(text: str) -> int:
+        return len(text.encode('utf-16-le')) // 2
+
+    @staticmethod
+    def copy_entity(entity: MessageEntity, offset: int, length: int) -> MessageEntity:
+        return MessageEntity(type=entity.type, offset=offset, length=length, url=entity.url, user=entity.user,
+                             language=entity.language)
+
+    @classmethod
+    def splice(cls, text: str, entities: List[MessageEntity], spans: Sequence[Tuple[int, int]],
+               new: str) -> Tuple[str, List[MessageEntity]]:
+        # Replace text[start:end] of every (sorted, non overlapping) span with new and move the entities along.
+        # Entity boundaries inside a replaced span snap to its edges.
+        pieces = []
+        moved = []
+        new_length = cls.utf16_len(new)
+        last = position = delta = 0
+        for start, end in spans:
+            pieces.append(text[last:start])
+            pieces.append(new)
+            position += cls.utf16_len(text[last:start])
+            start16 = position
+            position += cls.utf16_len(text[start:end])
+            moved.append((start16, position, delta))
+            delta += new_length - (position - start16)
+            last = end
+        pieces.append(text[last:])
+        span_ends = [x[1] for x in moved]
+
+        def move(boundary: int, is_end: bool) -> int:
+            index = bisect.bisect_right(span_ends, boundary)
+            if index < len(moved) and moved[index][0] < boundary:
+                return moved[index][0] + moved[index][2] + (new_length if is_end else 0)
+            if index == 0:
+                return boundary
+            start16, end16, before = moved[index - 1]
+            return boundary + before + new_length - (end16 - start16)
+
+        result = []
+        for _entity in entities:
+            start, end = move(_entity.offset, False), move(_entity.offset + _entity.length, True)
+            if end > start:
+                result.append(cls.copy_entity(_entity, start, end - start))
+        return ''.join(pieces), result
 
     @staticmethod
     def parse_user_markdown(user_id: Union[int, str], user_name: Optional[str] = None) -> str:
@@ -168,7 +317,291 @@ class TextParser:
         return name
 
 
+class ParseCache:
+    @dataclass
+    class Entry:
+        build: TextParser.BuildMessage
+        parsed_msg: Optional[str] = None
+        full_message: Optional[str] = None
+        entities: Optional[Tuple[str, List[MessageEntity]]] = None
+        full_entities: Optional[Tuple[str, List[MessageEntity]]] = None
+
+    def __init__(self, max_size: int = 512):
+        self.max_size: int = max_size
+        self._entries: OrderedDict[Tuple[int, int, Optional[int]], ParseCache.Entry] = OrderedDict()
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def get(self, key: Tuple[int, int, Optional[int]]) -> Optional[ParseCache.Entry]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key: Tuple[int, int, Optional[int]], entry: ParseCache.Entry) -> None:
+        if self.max_size > 0:
+            self._entries[key] = entry
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
+class MsgIdCache:
+    @dataclass
+    class _Entry:
+        target_id: int
+        user_id: Optional[int]
+        timestamp: float
+
+    def __init__(self, max_size: int = 4096, ttl: float = 3600.0):
+        self.max_size: int = max_size
+        self.ttl: float = ttl
+        self._forward: OrderedDict[int, MsgIdCache._Entry] = OrderedDict()
+        self._reverse: Dict[int, int] = {}
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def put(self, msg_id: int, target_id: int, user_id: Optional[int] = None) -> None:
+        if self.max_size <= 0:
+            return
+        self._remove(msg_id)
+        self._forward[msg_id] = MsgIdCache._Entry(target_id, user_id, time.monotonic())
+        self._reverse[target_id] = msg_id
+        while len(self._forward) > self.max_size:
+            self._remove(next(iter(self._forward)))
+
+    def _remove(self, msg_id: int) -> None:
+        entry = self._forward.pop(msg_id, None)
+        if entry is not None and self._reverse.get(entry.target_id) == msg_id:
+            del self._reverse[entry.target_id]
+
+    def get(self, key: int, reverse: bool = False) -> Optional[Tuple[int, int, Optional[int]]]:
+        msg_id = self._reverse.get(key) if reverse else key
+        entry = self._forward.get(msg_id) if msg_id is not None else None
+        if entry is not None and time.monotonic() - entry.timestamp > self.ttl:
+            self._remove(msg_id)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._forward.move_to_end(msg_id)
+        self.hits += 1
+        return msg_id, entry.target_id, entry.user_id
+
+    def clear(self) -> None:
+        self._forward.clear()
+        self._reverse.clear()
+
+    def __len__(self) -> int:
+        return len(self._forward)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {'size': len(self._forward), 'hits': self.hits, 'misses': self.misses}
+
+
+class MemberStatusCache:
+    # Fed by join and leave service messages, so that join checks don't have to call get_chat_member
+    @dataclass
+    class _Entry:
+        status: str
+        timestamp: float
+
+    def __init__(self, max_size: int = 8192, ttl: float = 3600.0):
+        self.max_size: int = max_size
+        self.ttl: float = ttl
+        self._entries: OrderedDict[int, MemberStatusCache._Entry] = OrderedDict()
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def put(self, user_id: int, status: str) -> None:
+        if self.max_size <= 0:
+            return
+        self._entries.pop(user_id, None)
+        self._entries[user_id] = MemberStatusCache._Entry(status, time.monotonic())
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def get(self, user_id: int) -> Optional[str]:
+        entry = self._entries.get(user_id)
+        if entry is not None and time.monotonic() - entry.timestamp > self.ttl:
+            del self._entries[user_id]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry.status
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
+@dataclass(frozen=True)
+class Statement:
+    name: str
+    sql: str
+
+    registry = {}  # type: Dict[str, Statement]
+
+    def __post_init__(self):
+        if Statement.registry.setdefault(self.name, self) is not self:
+            raise ValueError(f'Statement {self.name} already registered')
+
+
+class StatementStats:
+    def __init__(self, max_samples: int = 1024):
+        self.calls: int = 0
+        self.total_time: float = 0.0
+        self.rows: int = 0
+        self._samples: deque = deque(maxlen=max_samples)
+
+    def record(self, elapsed: float, rows: int) -> None:
+        self.calls += 1
+        self.total_time += elapsed
+        self.rows += rows
+        self._samples.append(elapsed)
+
+    @property
+    def p99(self) -> float:
+        if not self._samples:
+            return 0.0
+        samples = sorted(self._samples)
+        return samples[min(len(samples) - 1, int(len(samples) * .99))]
+
+    def __str__(self) -> str:
+        return 'calls={} total={:.3f}s avg={:.2f}ms p99={:.2f}ms rows={}'.format(
+            self.calls, self.total_time, self.total_time * 1000 / max(self.calls, 1), self.p99 * 1000, self.rows)
+
+
+class PoolStats:
+    def __init__(self, max_size: int):
+        self.max_size: int = max_size
+        self.in_use: int = 0
+        self.peak_in_use: int = 0
+        self.timeouts: int = 0
+        self.max_wait: float = 0.0
+        self.wait: StatementStats = StatementStats()
+
+    def acquired(self, wait: float) -> None:
+        self.wait.record(wait, 0)
+        self.max_wait = max(self.max_wait, wait)
+        self.in_use += 1
+        self.peak_in_use = max(self.peak_in_use, self.in_use)
+
+    def released(self) -> None:
+        self.in_use -= 1
+
+    def __str__(self) -> str:
+        return 'in_use={}/{} free={} peak={} acquires={} wait_avg={:.2f}ms wait_p99={:.2f}ms ' \
+               'wait_max={:.2f}ms timeouts={}'.format(
+                self.in_use, self.max_size, self.max_size - self.in_use, self.peak_in_use, self.wait.calls,
+                self.wait.total_time * 1000 / max(self.wait.calls, 1), self.wait.p99 * 1000, self.max_wait * 1000,
+                self.timeouts)
+
+
+class _PreparedConnection(asyncpg.Connection):
+    async def prepare_registered(self) -> None:
+        # The public prepare() can't be used here: its PreparedStatement refuses to run once the pooled connection
+        # has been released, and it is not put in the statement cache that fetch()/execute() look up. Only the
+        # private _get_statement() fills that cache, it is the reason requirements.txt pins asyncpg to ~=0.21.0.
+        # Without it the statements are still prepared and cached on first use, only not ahead of time.
+        get_statement = getattr(self, '_get_statement', None)
+        if get_statement is None:
+            logger.warning('asyncpg %s has no Connection._get_statement, statements are not prepared ahead',
+                           asyncpg.__version__)
+            return
+        for statement in Statement.registry.values():
+            try:
+                await get_statement(statement.sql, None)
+            except asyncpg.PostgresError:
+                logger.exception('Prepare statement %s failure', statement.name)
+            except TypeError:
+                logger.warning('Connection._get_statement of asyncpg %s takes other arguments, statements are not '
+                               'prepared ahead', asyncpg.__version__)
+                return
+
+
+class MsgIdWriteBuffer:
+    def __init__(self):
+        self._rows: Dict[int, Tuple[int, int, Optional[int]]] = {}
+        self._reverse: Dict[int, int] = {}
+
+    def add(self, msg_id: int, target_id: int, user_id: Optional[int] = None) -> None:
+        self._rows[msg_id] = (msg_id, target_id, user_id)
+        self._reverse[target_id] = msg_id
+
+    def get(self, key: int, reverse: bool = False) -> Optional[Tuple[int, int, Optional[int]]]:
+        msg_id = self._reverse.get(key) if reverse else key
+        return self._rows.get(msg_id) if msg_id is not None else None
+
+    def drain(self) -> List[Tuple[int, int, Optional[int]]]:
+        rows = list(self._rows.values())
+        self._rows = {}
+        self._reverse = {}
+        return rows
+
+    def restore(self, rows: Sequence[Tuple[int, int, Optional[int]]]) -> None:
+        for row in rows:
+            if row[0] not in self._rows:
+                self.add(*row)
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+
 class PgSQLdb:
+    # msg_id_key is the unique index of msg_id across partitions, a msg_id already in there is not written again
+    _INSERT_MSG_ID = Statement(
+        'msg_id.insert',
+        '''WITH "key" AS (
+            INSERT INTO "msg_id_key" ("msg_id", "timestamp") VALUES ($1, CURRENT_TIMESTAMP) RETURNING "timestamp"
+        )
+        INSERT INTO "msg_id" SELECT $1, $2, "timestamp", $3 FROM "key"''')
+    _INSERT_MSG_ID_MANY = Statement(
+        'msg_id.insert_many',
+        '''WITH "key" AS (
+            INSERT INTO "msg_id_key" ("msg_id", "timestamp") VALUES ($1, CURRENT_TIMESTAMP) ON CONFLICT DO NOTHING
+            RETURNING "timestamp"
+        )
+        INSERT INTO "msg_id" SELECT $1, $2, "timestamp", $3 FROM "key"''')
+    # The "timestamp" bounds let the planner skip the partitions that cannot hold the row
+    _GET_ID = Statement(
+        'msg_id.get_id',
+        '''SELECT "msg_id", "target_id", "user_id" FROM "msg_id"
+        WHERE "msg_id" = $1 AND "timestamp" = (SELECT "timestamp" FROM "msg_id_key" WHERE "msg_id" = $1)''')
+    _GET_ID_REVERSE = Statement(
+        'msg_id.get_id_reverse',
+        '''SELECT "msg_id", "target_id", "user_id" FROM "msg_id" WHERE "target_id" = $1 AND "timestamp" >= $2''')
+    _MAX_MSG_ID = Statement('msg_id.max', '''SELECT MAX("msg_id") AS "msg_id" FROM "msg_id_key"''')
+    _GET_USER_ID = Statement(
+        'msg_id.get_user_id',
+        '''SELECT "msg_id", "target_id", "user_id" FROM "msg_id" WHERE "target_id" = $1 AND "timestamp" >= $2''')
+    _GET_CHANNEL_MSG_ID = Statement(
+        'username.channel_msg_id',
+        '''SELECT "channel_msg_id" FROM "username" WHERE "user_id" = (
+            SELECT "user_id" FROM "msg_id" WHERE "target_id" = $1 AND "timestamp" >= $2 LIMIT 1
+        )''')
+    # A mapping is written after both of its messages were sent, the slack covers clock and time zone differences
+    MSG_ID_DATE_SLACK = timedelta(days=1)
+    _INSERT_WARN = Statement(
+        'reasons.insert',
+        '''INSERT INTO "reasons" ("user_id", "text", "msg_id") VALUES ($1, $2, $3) RETURNING "id"''')
+    _DELETE_WARN = Statement('reasons.delete_by_user', '''DELETE FROM "reasons" WHERE "user_id" = $1''')
+    _COUNT_WARN = Statement('reasons.count_by_user', '''SELECT COUNT(*) FROM "reasons" WHERE "user_id" = $1''')
+    _WARN_REASON = Statement('reasons.text_by_id', '''SELECT "text" FROM "reasons" WHERE "id" = $1''')
+    _LOAD_BANLIST = Statement('banlist.load', '''SELECT "id" FROM "banlist"''')
+    _INSERT_BANLIST = Statement('banlist.insert', '''INSERT INTO "banlist" ("id") VALUES ($1)''')
 
     def __init__(
             self,
@@ -177,6 +610,17 @@ class PgSQLdb:
             user: str,
             password: str,
             db: str,
+            cache_size: int = 4096,
+            cache_ttl: float = 3600.0,
+            write_buffer_size: int = 64,
+            write_flush_interval: float = 1.0,
+            auto_migrate: bool = True,
+            pool_min_size: int = 10,
+            pool_max_size: int = 10,
+            acquire_timeout: float = 10.0,
+            statement_cache_size: int = 100,
+            max_inactive_connection_lifetime: float = 300.0,
+            max_queries: int = 50000,
     ):
         self.logger: logging.Logger = logging.getLogger(__name__)
         self.logger.setLevel(logging.DEBUG)
@@ -188,15 +632,66 @@ class PgSQLdb:
         self.execute_lock: asyncio.Lock = asyncio.Lock()
         self.pgsql_connection: asyncpg.pool.Pool = None
         self.last_execute_time: float = 0.0
+        self.msg_id_cache: MsgIdCache = MsgIdCache(cache_size, cache_ttl)
+        # Only written through insert_user_to_banlist, loaded once at startup
+        self.banlist: Set[int] = set()
+        self.write_buffer_size: int = write_buffer_size
+        self.write_flush_interval: float = write_flush_interval
+        self._write_buffer: MsgIdWriteBuffer = MsgIdWriteBuffer()
+        self._flush_event: asyncio.Event = asyncio.Event()
+        self._flush_task: Optional[asyncio.Task] = None
+        self._inflight: Dict[int, asyncio.Future] = {}
+        self.auto_migrate: bool = auto_migrate
+        self.statement_stats: Dict[str, StatementStats] = {}
+        self.pool_min_size: int = pool_min_size
+        self.pool_max_size: int = pool_max_size
+        self.acquire_timeout: Optional[float] = acquire_timeout if acquire_timeout > 0 else None
+        self.statement_cache_size: int = statement_cache_size
+        self.max_inactive_connection_lifetime: float = max_inactive_connection_lifetime
+        self.max_queries: int = max_queries
+        self.pool_stats: PoolStats = PoolStats(pool_max_size)
+
+    async def connect(self) -> asyncpg.Connection:
+        # A connection outside of the pool, for work that must not hold a pooled one
+        return await asyncpg.connect(
+            host=self.host,
+            port=self.port,
+            user=self.user,
+            password=self.password,
+            database=self.db
+        )
+
+    async def apply_migrations(self) -> List[migrate.Migration]:
+        conn = await self.connect()
+        try:
+            return await migrate.MigrationRunner(conn).upgrade()
+        finally:
+            await conn.close()
 
     async def create_connect(self) -> None:
+        if self.auto_migrate:
+            for migration in await self.apply_migrations():
+                self.logger.info('Applied schema migration %04d_%s', migration.version, migration.name)
+        if self.statement_cache_size < len(Statement.registry):
+            self.logger.warning('statement_cache_size (%d) is smaller than the number of registered statements (%d)',
+                                self.statement_cache_size, len(Statement.registry))
         self.pgsql_connection = await asyncpg.create_pool(
             host=self.host,
             port=self.port,
             user=self.user,
             password=self.password,
-            database=self.db
+            database=self.db,
+            min_size=self.pool_min_size,
+            max_size=self.pool_max_size,
+            max_queries=self.max_queries,
+            max_inactive_connection_lifetime=self.max_inactive_connection_lifetime,
+            statement_cache_size=self.statement_cache_size,
+            connection_class=_PreparedConnection,
+            init=_PreparedConnection.prepare_registered
         )
+        await self.load_banlist()
+        if self.write_buffer_size > 0:
+            self._flush_task = asyncio.create_task(self._flush_loop())
 
     @classmethod
     async def create(cls,
@@ -205,34 +700,179 @@ class PgSQLdb:
                      user: str,
                      password: str,
                      db: str,
+                     **kwargs,
                      ) -> 'PgSQLdb':
-        self = cls(host, port, user, password, db)
+        self = cls(host, port, user, password, db, **kwargs)
         await self.create_connect()
         return self
 
-    async def query(self, sql: str, *args: Optional[_FixedDataType]) -> List[asyncpg.Record]:
-        async with self.pgsql_connection.acquire() as conn:
-            return await conn.fetch(sql, *args)
-
-    async def query1(self, sql: str, *args: Optional[_FixedDataType]) -> Optional[asyncpg.Record]:
-        async with self.pgsql_connection.acquire() as conn:
-            return await conn.fetchrow(sql, *args)
-
-    async def execute(self, sql: str, *args: Union[Sequence[Tuple[_FixedDataType, ...]],
-                                                   Optional[_FixedDataType]], many: bool = False) -> None:
-        async with self.pgsql_connection.acquire() as conn:
+    @staticmethod
+    def _status_rows(status: Optional[str]) -> int:
+        try:
+            return int(status.rsplit(maxsplit=1)[-1]) if status else 0
+        except ValueError:
+            return 0
+
+    def _record(self, sql: Union[str, Statement], start: float, rows: int) -> None:
+        name = sql.name if isinstance(sql, Statement) else ' '.join(sql.split())[:60]
+        stats = self.statement_stats.get(name)
+        if stats is None:
+            stats = self.statement_stats[name] = StatementStats()
+        stats.record(time.perf_counter() - start, rows)
+
+    @contextlib.asynccontextmanager
+    async def acquire(self) -> AsyncIterator[asyncpg.Connection]:
+        start = time.perf_counter()
+        try:
+            conn = await self.pgsql_connection.acquire(timeout=self.acquire_timeout)
+        except asyncio.TimeoutError:
+            self.pool_stats.timeouts += 1
+            self.logger.warning('Acquire connection timeout after %.1fs, pool %s', time.perf_counter() - start,
+                                self.pool_stats)
+            raise
+        self.pool_stats.acquired(time.perf_counter() - start)
+        try:
+            yield conn
+        finally:
+            self.pool_stats.released()
+            await self.pgsql_connection.release(conn)
+
+    async def query(self, sql: Union[str, Statement], *args: Optional[_FixedDataType]) -> List[asyncpg.Record]:
+        start = time.perf_counter()
+        async with self.acquire() as conn:
+            result = await conn.fetch(sql.sql if isinstance(sql, Statement) else sql, *args)
+        self._record(sql, start, len(result))
+        return result
+
+    async def query1(self, sql: Union[str, Statement], *args: Optional[_FixedDataType]) -> Optional[asyncpg.Record]:
+        start = time.perf_counter()
+        async with self.acquire() as conn:
+            result = await conn.fetchrow(sql.sql if isinstance(sql, Statement) else sql, *args)
+        self._record(sql, start, result is not None)
+        return result
+
+    async def execute(self, sql: Union[str, Statement], *args: Union[Sequence[Tuple[_FixedDataType, ...]],
+                                                                     Optional[_FixedDataType]],
+                      many: bool = False) -> None:
+        start = time.perf_counter()
+        async with self.acquire() as conn:
             if many:
-                await conn.executemany(sql, *args)
+                await conn.executemany(sql.sql if isinstance(sql, Statement) else sql, *args)
+                rows = len(args[0])
             else:
-                await conn.execute(sql, *args)
+                rows = self._status_rows(await conn.execute(sql.sql if isinstance(sql, Statement) else sql, *args))
+        self._record(sql, start, rows)
+
+    def format_statement_stats(self, limit: int = 0) -> List[str]:
+        items = sorted(self.statement_stats.items(), key=lambda x: x[1].total_time, reverse=True)
+        if limit > 0:
+            items = items[:limit]
+        return [f'{name}: {stats}' for name, stats in items]
 
     async def close(self) -> None:
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+        self.logger.info('msg_id cache stats: %s', self.msg_id_cache.stats)
+        for line in self.format_statement_stats():
+            self.logger.info('Statement %s', line)
+        self.logger.info('Pool stats: %s', self.pool_stats)
         await self.pgsql_connection.close()
 
+    async def _flush_loop(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_event.wait(), self.write_flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_event.clear()
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except:
+                self.logger.exception('Flush msg_id buffer failure, %d row(s) kept for retry', len(self._write_buffer))
+
+    async def flush(self) -> None:
+        async with self.execute_lock:
+            rows = self._write_buffer.drain()
+            if not rows:
+                return
+            try:
+                await self.execute(self._INSERT_MSG_ID_MANY, rows, many=True)
+            except:
+                self._write_buffer.restore(rows)
+                raise
+            self.last_execute_time = time.time()
+
     async def insert_ex(self, id1: int, id2: int, user_id: Optional[int] = None) -> None:
-        await self.execute(
-            '''INSERT INTO "msg_id" VALUES ($1, $2, CURRENT_TIMESTAMP, $3)''',
-            id1, id2, user_id)
+        if self.write_buffer_size <= 0:
+            await self.execute(self._INSERT_MSG_ID, id1, id2, user_id)
+        else:
+            self._write_buffer.add(id1, id2, user_id)
+            if len(self._write_buffer) >= self.write_buffer_size:
+                self._flush_event.set()
+        self._remember(id1, id2, user_id)
+
+    async def insert_many(self, rows: Sequence[Tuple[int, int, Optional[int]]]) -> None:
+        if self.write_buffer_size <= 0:
+            await self.execute(self._INSERT_MSG_ID_MANY, rows, many=True)
+        else:
+            for row in rows:
+                self._write_buffer.add(*row)
+            if len(self._write_buffer) >= self.write_buffer_size:
+                self._flush_event.set()
+        for row in rows:
+            self._remember(*row)
+
+    def _remember(self, id1: int, id2: int, user_id: Optional[int]) -> None:
+        self.msg_id_cache.put(id1, id2, user_id)
+        future = self._inflight.pop(id1, None)
+        if future is not None and not future.done():
+            future.set_result(id2)
+
+    def _pending_future(self, msg_id: int) -> asyncio.Future:
+        future = self._inflight.get(msg_id)
+        if future is None or future.done():
+            future = self._inflight[msg_id] = asyncio.get_event_loop().create_future()
+        return future
+
+    @contextlib.contextmanager
+    def forwarding(self, msg_id: int):
+        future = self._pending_future(msg_id)
+        try:
+            yield future
+        finally:
+            if not future.done():
+                future.set_result(None)
+            if self._inflight.get(msg_id) is future:
+                del self._inflight[msg_id]
+
+    async def wait_id(self, msg_id: int, timeout: float) -> Optional[int]:
+        # Registered before the lookup, so a forward finishing while the database is asked still resolves it
+        future = self._pending_future(msg_id)
+        try:
+            target_id = await self.get_id(msg_id)
+            if target_id is None:
+                target_id = await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            target_id = None
+        finally:
+            if self._inflight.get(msg_id) is future:
+                del self._inflight[msg_id]
+        if target_id is None:
+            # The mapping may only be in the write buffer, which the database query does not see
+            cached = self._lookup_msg_id(msg_id)
+            if cached is not None:
+                return cached[1]
+        return target_id
+
+    def _lookup_msg_id(self, key: int, reverse: bool = False) -> Optional[Tuple[int, int, Optional[int]]]:
+        cached = self.msg_id_cache.get(key, reverse)
+        if cached is None:
+            cached = self._write_buffer.get(key, reverse)
+        return cached
 
     async def insert(self, msg: Message, msg_2: Message) -> None:
         try:
@@ -241,51 +881,746 @@ class PgSQLdb:
             traceback.print_exc()
             await self.insert_ex(msg.message_id, msg_2.message_id)
 
-    async def get_user_id(self, msg: Union[Message, int]) -> Optional[asyncpg.Record]:
-        return await self.query1(
-            '''SELECT "user_id" FROM "msg_id" WHERE "msg_id" = (
-                   SELECT "msg_id" FROM "msg_id" WHERE "target_id" = $1
-            )''',
-            (msg if isinstance(msg, int) else msg.reply_to_message.message_id))
+    @classmethod
+    def _written_since(cls, date: Optional[int]) -> datetime:
+        # Without the date of the message every partition has to be searched
+        if not date:
+            return datetime.min
+        return datetime.fromtimestamp(date) - cls.MSG_ID_DATE_SLACK
+
+    async def get_user_id(self, msg: Union[Message, int],
+                          date: Optional[int] = None) -> Optional[Mapping[str, Optional[int]]]:
+        if isinstance(msg, int):
+            target_id = msg
+        else:
+            target_id, date = msg.reply_to_message.message_id, msg.reply_to_message.date
+        cached = self._lookup_msg_id(target_id, True)
+        if cached is not None:
+            return {'user_id': cached[2]}
+        r = await self.query1(self._GET_USER_ID, target_id, self._written_since(date))
+        if r is not None:
+            self.msg_id_cache.put(r['msg_id'], r['target_id'], r['user_id'])
+        return r
+
+    async def get_id(self, msg_id: int, reverse: bool = False, date: Optional[int] = None) -> Optional[int]:
+        cached = self._lookup_msg_id(msg_id, reverse)
+        if cached is not None:
+            return cached[0 if reverse else 1]
+        if reverse:
+            r = await self.query1(self._GET_ID_REVERSE, msg_id, self._written_since(date))
+        else:
+            r = await self.query1(self._GET_ID, msg_id)
+        if r is None:
+            return None
+        self.msg_id_cache.put(r['msg_id'], r['target_id'], r['user_id'])
+        return r['target_id' if not reverse else 'msg_id']
 
-    async def get_id(self, msg_id: int, reverse: bool = False) -> Optional[int]:
-        r = await self.query1('{} = $1'.format('''SELECT "{}" FROM "msg_id" WHERE "{}"'''.format(
-            *(('target_id', 'msg_id') if not reverse else ('msg_id', 'target_id')))), msg_id)
-        return r['target_id' if not reverse else 'msg_id'] if r else None
+    async def get_max_msg_id(self) -> Optional[int]:
+        await self.flush()
+        return (await self.query1(self._MAX_MSG_ID))['msg_id']
 
     async def get_reply_id(self, msg: Message) -> Optional[int]:
         return await self.get_id(msg.reply_to_message.message_id) if msg.reply_to_message else None
 
     async def get_reply_id_reverse(self, msg: Message) -> Optional[int]:
-        return await self.get_id(msg.reply_to_message.message_id, True) if msg.reply_to_message else None
+        if msg.reply_to_message is None:
+            return None
+        return await self.get_id(msg.reply_to_message.message_id, True, msg.reply_to_message.date)
 
     async def get_msg_name_history_channel_msg_id(self, msg: Message) -> int:
-        return (await self.query1(
-            '''SELECT "channel_msg_id" FROM "username" WHERE "user_id" = (
-                    SELECT "user_id" FROM "msg_id" WHERE "target_id" = $1
-            )''',
-            msg.reply_to_message.message_id))['channel_msg_id']
+        return (await self.query1(self._GET_CHANNEL_MSG_ID, msg.reply_to_message.message_id,
+                                  self._written_since(msg.reply_to_message.date)))['channel_msg_id']
 
     async def insert_new_warn(self, user_id: int, msg: str, msg_id: Optional[int]) -> int:
-        await self.execute('''INSERT INTO "reasons" ("user_id", "text", "msg_id") VALUES ($1, $2, $3)''',
-                           user_id, msg, msg_id)
-        # FIXME:
-        return (await self.query1("SELECT LAST_INSERT_ID()"))['LAST_INSERT_ID()']
+        return (await self.query1(self._INSERT_WARN, user_id, msg, msg_id))['id']
 
     async def delete_warn_by_id(self, warn_id: int) -> None:
-        await self.execute('''DELETE FROM "reasons" WHERE "user_id" = $1''', warn_id)
+        await self.execute(self._DELETE_WARN, warn_id)
 
     async def query_warn_by_user(self, user_id: int) -> int:
-        return (await self.query1('''SELECT COUNT(*) FROM "reasons" WHERE "user_id" = $1''', user_id))['count']
+        return (await self.query1(self._COUNT_WARN, user_id))['count']
 
     async def query_warn_reason_by_id(self, reason_id: int) -> str:
-        return (await self.query1('''SELECT "text" FROM "reasons" WHERE "id" = $1''', reason_id))['text']
+        return (await self.query1(self._WARN_REASON, reason_id))['text']
 
-    async def query_user_in_banlist(self, user_id: int) -> bool:
-        return await self.query1('''SELECT * FROM "banlist" WHERE "id" = $1''', user_id) is not None
+    async def load_banlist(self) -> None:
+        self.banlist = {row['id'] for row in await self.query(self._LOAD_BANLIST)}
+
+    def in_banlist(self, user_id: int) -> bool:
+        return user_id in self.banlist
 
     async def insert_user_to_banlist(self, user_id: int) -> None:
-        await self.execute('''INSERT INTO "banlist" ("id") VALUES ($1)''', user_id)
+        if user_id in self.banlist:
+            return
+        await self.execute(self._INSERT_BANLIST, user_id)
+        self.banlist.add(user_id)
+
+
+class TokenBucket:
+    # A rate of 0 or less doesn't limit anything, only the FloodWait penalties are waited out
+    def __init__(self, rate: float, capacity: float):
+        self.rate: float = rate
+        self.capacity: float = capacity
+        self.tokens: float = capacity
+        self.updated: float = time.monotonic()
+        self.blocked_until: float = 0.0
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, now: float) -> float:
+        if self.rate <= 0:
+            return max(0.0, self.blocked_until - now)
+        # Tokens may go negative, every caller gets its own turn and waits for the deficit to refill
+        self._refill(now)
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def penalize(self, seconds: float, now: float) -> None:
+        if self.rate <= 0:
+            self.blocked_until = max(self.blocked_until, now + seconds)
+            return
+        self._refill(now)
+        self.tokens = min(self.tokens, 0.0) - seconds * self.rate
+
+    def is_full(self, now: float) -> bool:
+        if self.rate <= 0:
+            return self.blocked_until <= now
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class SendScheduler:
+    THROTTLED_FUNCTIONS = frozenset((
+        'functions.messages.SendMessage',
+        'functions.messages.SendMedia',
+        'functions.messages.SendMultiMedia',
+        'functions.messages.ForwardMessages',
+        'functions.messages.EditMessage',
+        'functions.messages.ExportChatInvite',
+    ))
+
+    @dataclass(frozen=True)
+    class Profile:
+        # Defaults are the Bot API limits, a rate of 0 leaves that limit to FloodWait alone
+        global_rate: float = 30.0
+        global_burst: float = 30.0
+        private_rate: float = 1.0
+        private_burst: float = 3.0
+        group_rate: float = 20 / 60
+        group_burst: float = 20.0
+
+    def __init__(self,
+                 global_rate: float = 30.0,
+                 global_burst: float = 30.0,
+                 private_rate: float = 1.0,
+                 private_burst: float = 3.0,
+                 group_rate: float = 20 / 60,
+                 group_burst: float = 20.0,
+                 max_flood_wait: float = 300.0,
+                 max_chat_buckets: int = 4096,
+                 profiles: Optional[Mapping[str, SendScheduler.Profile]] = None):
+        # The arguments are the profile of every session that has none of its own in profiles
+        self.default_profile: SendScheduler.Profile = SendScheduler.Profile(
+            global_rate, global_burst, private_rate, private_burst, group_rate, group_burst)
+        self.profiles: Dict[str, SendScheduler.Profile] = dict(profiles or {})
+        self.max_flood_wait: float = max_flood_wait
+        self.max_chat_buckets: int = max_chat_buckets
+        self._global: Dict[str, TokenBucket] = {}
+        self._chats: OrderedDict[Tuple[str, int], TokenBucket] = OrderedDict()
+        self.queued: int = 0
+        self.peak_queued: int = 0
+        self.sent: int = 0
+        self.delayed: int = 0
+        self.total_delay: float = 0.0
+        self.flood_waits: int = 0
+
+    @staticmethod
+    def get_peer(data: TLObject) -> Optional[Tuple[int, bool]]:
+        peer = getattr(data, 'peer', None) or getattr(data, 'to_peer', None)
+        if peer is None:
+            return None
+        if hasattr(peer, 'user_id'):
+            return peer.user_id, True
+        if hasattr(peer, 'channel_id'):
+            return -peer.channel_id, False
+        if hasattr(peer, 'chat_id'):
+            return -peer.chat_id, False
+        return 0, True
+
+    def get_profile(self, owner: str) -> SendScheduler.Profile:
+        return self.profiles.get(owner, self.default_profile)
+
+    def _global_bucket(self, owner: str) -> TokenBucket:
+        bucket = self._global.get(owner)
+        if bucket is None:
+            profile = self.get_profile(owner)
+            bucket = self._global[owner] = TokenBucket(profile.global_rate, profile.global_burst)
+        return bucket
+
+    def _chat_bucket(self, owner: str, peer: Tuple[int, bool], now: float) -> TokenBucket:
+        key = (owner, peer[0])
+        bucket = self._chats.get(key)
+        if bucket is not None:
+            self._chats.move_to_end(key)
+            return bucket
+        profile = self.get_profile(owner)
+        bucket = self._chats[key] = TokenBucket(*((profile.private_rate, profile.private_burst) if peer[1] else
+                                                  (profile.group_rate, profile.group_burst)))
+        if len(self._chats) > self.max_chat_buckets:
+            oldest_key, oldest = next(iter(self._chats.items()))
+            if oldest.is_full(now):
+                del self._chats[oldest_key]
+        return bucket
+
+    async def _wait(self, owner: str, peer: Optional[Tuple[int, bool]]) -> None:
+        start = time.monotonic()
+        self.queued += 1
+        self.peak_queued = max(self.peak_queued, self.queued)
+        try:
+            if peer is not None:
+                delay = self._chat_bucket(owner, peer, start).reserve(start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            now = time.monotonic()
+            delay = self._global_bucket(owner).reserve(now)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        finally:
+            self.queued -= 1
+        waited = time.monotonic() - start
+        if waited > 0.001:
+            self.delayed += 1
+            self.total_delay += waited
+
+    async def run(self, owner: str, data: TLObject, func: Callable[..., Awaitable[_T]], *args: Any,
+                  **kwargs: Any) -> _T:
+        peer = self.get_peer(data)
+        while True:
+            await self._wait(owner, peer)
+            try:
+                result = await func(*args, **kwargs)
+            except FloodWait as e:
+                self.flood_waits += 1
+                logger.warning('%s got FloodWait of %d seconds on %s (peer %s)', owner, e.x, data.QUALNAME,
+                               peer[0] if peer else None)
+                if e.x > self.max_flood_wait:
+                    raise
+                now = time.monotonic()
+                (self._global_bucket(owner) if peer is None else self._chat_bucket(owner, peer, now)).penalize(
+                    e.x, now)
+                continue
+            self.sent += 1
+            return result
+
+    @property
+    def stats(self) -> str:
+        return 'sent={} queued={} peak_queued={} delayed={} avg_delay={:.2f}s flood_waits={}'.format(
+            self.sent, self.queued, self.peak_queued, self.delayed, self.total_delay / max(self.delayed, 1),
+            self.flood_waits)
+
+
+class ScheduledClient(Client):
+    def __init__(self, *args, scheduler: Optional[SendScheduler] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.scheduler: Optional[SendScheduler] = scheduler
+
+    async def send(self, data: TLObject, *args, **kwargs):
+        if self.scheduler is None or data.QUALNAME not in SendScheduler.THROTTLED_FUNCTIONS:
+            return await super().send(data, *args, **kwargs)
+        # Let FloodWait reach the scheduler instead of sleeping inside the session
+        kwargs['sleep_threshold'] = 0
+        return await self.scheduler.run(self.session_name, data, super().send, data, *args, **kwargs)
+
+
+class MediaGroupCollector:
+    # Telegram does not allow more than 10 items in one album
+    MAX_SIZE = 10
+
+    @dataclass
+    class _Group:
+        messages: List[Message]
+        last_seen: float
+        callback: Callable[[List[Message]], Awaitable[None]]
+
+    def __init__(self, window: float = 1.0):
+        self.window: float = window
+        self._groups: Dict[Tuple[int, str], MediaGroupCollector._Group] = {}
+
+    def collect(self, msg: Message, callback: Callable[[List[Message]], Awaitable[None]]) -> None:
+        key = (msg.chat.id, msg.media_group_id)
+        group = self._groups.get(key)
+        if group is None:
+            self._groups[key] = self._Group([msg], time.monotonic(), callback)
+            asyncio.create_task(self._flush_later(key))
+        else:
+            group.messages.append(msg)
+            group.last_seen = time.monotonic()
+
+    async def _flush_later(self, key: Tuple[int, str]) -> None:
+        group = self._groups[key]
+        while len(group.messages) < self.MAX_SIZE:
+            delay = group.last_seen + self.window - time.monotonic()
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+        del self._groups[key]
+        group.messages.sort(key=lambda x: x.message_id)
+        try:
+            await group.callback(group.messages)
+        except:
+            logger.exception('Process media group %s failure', key)
+
+    def __len__(self) -> int:
+        return len(self._groups)
+
+
+class ReadAcknowledger:
+    @dataclass
+    class _Pending:
+        max_id: int
+        mentioned: bool
+
+    def __init__(self, client: Client, window: float = 1.0):
+        self.client: Client = client
+        self.window: float = window
+        self._peers: Dict[int, Any] = {}
+        self._pending: Dict[int, ReadAcknowledger._Pending] = {}
+        self.acknowledged: int = 0
+        self.read_history: int = 0
+        self.read_mentions: int = 0
+
+    def acknowledge(self, msg: Message) -> None:
+        self.acknowledged += 1
+        pending = self._pending.get(msg.chat.id)
+        if pending is None:
+            self._pending[msg.chat.id] = self._Pending(msg.message_id, bool(msg.mentioned))
+            asyncio.create_task(self._flush_later(msg.chat.id))
+        else:
+            pending.max_id = max(pending.max_id, msg.message_id)
+            pending.mentioned = pending.mentioned or bool(msg.mentioned)
+
+    async def _resolve(self, chat_id: int) -> Any:
+        peer = self._peers.get(chat_id)
+        if peer is None:
+            peer = self._peers[chat_id] = await self.client.resolve_peer(chat_id)
+        return peer
+
+    async def _flush_later(self, chat_id: int) -> None:
+        await asyncio.sleep(self.window)
+        await self.flush(chat_id)
+
+    async def flush(self, chat_id: int) -> None:
+        pending = self._pending.pop(chat_id, None)
+        if pending is None:
+            return
+        try:
+            peer = await self._resolve(chat_id)
+            if isinstance(peer, raw.types.InputPeerChannel):
+                await self.client.send(raw.functions.channels.ReadHistory(
+                    channel=raw.types.InputChannel(channel_id=peer.channel_id, access_hash=peer.access_hash),
+                    max_id=pending.max_id))
+            else:
+                await self.client.send(raw.functions.messages.ReadHistory(peer=peer, max_id=pending.max_id))
+            self.read_history += 1
+            if pending.mentioned:
+                await self.client.send(raw.functions.messages.ReadMentions(peer=peer))
+                self.read_mentions += 1
+        except:
+            logger.exception('Acknowledge messages in %d failure', chat_id)
+
+    async def flush_all(self) -> None:
+        await asyncio.gather(*(self.flush(chat_id) for chat_id in list(self._pending)))
+
+    @property
+    def stats(self) -> str:
+        return 'acknowledged={} read_history={} read_mentions={}'.format(
+            self.acknowledged, self.read_history, self.read_mentions)
+
+
+class PriorityGate:
+    def __init__(self, capacity: int = 8, high_burst: int = 4):
+        self.capacity: int = capacity
+        self.high_burst: int = high_burst
+        self.active: int = 0
+        self._high_streak: int = 0
+        self._waiters: Dict[bool, Deque[asyncio.Future]] = {True: deque(), False: deque()}
+
+    def _grant(self, high: bool) -> None:
+        self.active += 1
+        self._high_streak = self._high_streak + 1 if high else 0
+
+    def _next_lane(self) -> Optional[bool]:
+        high, low = self._waiters[True], self._waiters[False]
+        # Low priority work gets at least one slot after every high_burst high priority grants
+        if high and (not low or self._high_streak < self.high_burst):
+            return True
+        if low:
+            return False
+        return None
+
+    def _wakeup(self) -> None:
+        while self.active < self.capacity:
+            lane = self._next_lane()
+            if lane is None:
+                return
+            future = self._waiters[lane].popleft()
+            if future.done():
+                continue
+            self._grant(lane)
+            future.set_result(None)
+
+    async def acquire(self, high: bool) -> None:
+        if self.active < self.capacity and not self._waiters[True] and not self._waiters[False]:
+            self._grant(high)
+            return
+        future = asyncio.get_event_loop().create_future()
+        self._waiters[high].append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self) -> None:
+        self.active -= 1
+        # Defer the choice, so a worker which still has high priority work queues up before it is made
+        asyncio.get_event_loop().call_soon(self._wakeup)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, high: bool) -> AsyncIterator[None]:
+        await self.acquire(high)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def waiting(self, high: bool) -> int:
+        return len(self._waiters[high])
+
+
+class OrderedDispatcher:
+    @dataclass
+    class _Item:
+        handler: Callable[[Client, Union[Message, CallbackQuery]], Awaitable[None]]
+        client: Client
+        update: Union[Message, CallbackQuery]
+        high: bool
+        enqueued: float
+
+    class _Chat:
+        def __init__(self):
+            self.high: Deque[OrderedDispatcher._Item] = deque()
+            self.low: Deque[OrderedDispatcher._Item] = deque()
+            # Set whenever an item leaves the low priority lane
+            self.low_room: asyncio.Event = asyncio.Event()
+            self.wakeup: asyncio.Event = asyncio.Event()
+            self.high_streak: int = 0
+            self.overflowing: bool = False
+            # Low priority updates put while the chat is held, see hold()
+            self.held: Optional[Deque[OrderedDispatcher._Item]] = None
+
+        def __len__(self) -> int:
+            return len(self.high) + len(self.low)
+
+    def __init__(self, queue_size: int = 64, idle_timeout: float = 60.0, concurrency: int = 8, high_burst: int = 4):
+        self.queue_size: int = queue_size
+        self.idle_timeout: float = idle_timeout
+        self.high_burst: int = high_burst
+        self.gate: PriorityGate = PriorityGate(concurrency, high_burst)
+        self._chats: Dict[int, OrderedDispatcher._Chat] = {}
+        self._workers: Dict[int, asyncio.Task] = {}
+        self.processed: int = 0
+        # Updates put while their chat's low priority lane was already at queue_size
+        self.over_limit: int = 0
+        self.peak_depth: int = 0
+        self.wait: Dict[bool, StatementStats] = {True: StatementStats(), False: StatementStats()}
+
+    @staticmethod
+    def get_chat_id(update: Union[Message, CallbackQuery]) -> int:
+        if isinstance(update, CallbackQuery):
+            return update.message.chat.id if update.message else update.from_user.id
+        return update.chat.id
+
+    def wrap(self, handler: Callable[[Client, Union[Message, CallbackQuery]], Awaitable[None]],
+             priority: Union[bool, Callable[[Union[Message, CallbackQuery]], bool]] = False
+             ) -> Callable[[Client, Union[Message, CallbackQuery]], Awaitable[None]]:
+        # Runs in the only pyrogram worker of the client, so it must never wait: one full chat would hold back the
+        # updates of every other chat, high priority ones included. The lane is picked here, before anything can wait,
+        # and a long low priority lane never delays an update bound for the high priority one
+        async def dispatch(client: Client, update: Union[Message, CallbackQuery]) -> None:
+            self.put_nowait(self.get_chat_id(update), handler, client, update,
+                            priority(update) if callable(priority) else priority)
+        return dispatch
+
+    def _get_chat(self, chat_id: int) -> OrderedDispatcher._Chat:
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = self._Chat()
+            self._workers[chat_id] = asyncio.create_task(self._worker(chat_id, chat))
+        return chat
+
+    def _append(self, chat_id: int, chat: OrderedDispatcher._Chat, item: OrderedDispatcher._Item) -> None:
+        if item.high:
+            chat.high.append(item)
+        else:
+            # queue_size is a soft limit here, the lane grows past it rather than lose updates or hold up the others
+            if len(chat.low) >= self.queue_size:
+                self.over_limit += 1
+                if not chat.overflowing:
+                    chat.overflowing = True
+                    logger.warning('Dispatch queue of chat %d is over its limit of %d', chat_id, self.queue_size)
+            chat.low.append(item)
+        chat.wakeup.set()
+        self.peak_depth = max(self.peak_depth, len(chat))
+
+    def put_nowait(self, chat_id: int, handler: Callable[[Client, Union[Message, CallbackQuery]], Awaitable[None]],
+                   client: Client, update: Union[Message, CallbackQuery], high: bool = False) -> None:
+        chat = self._get_chat(chat_id)
+        item = self._Item(handler, client, update, high, time.monotonic())
+        if not high and chat.held is not None:
+            chat.held.append(item)
+            return
+        self._append(chat_id, chat, item)
+
+    async def put(self, chat_id: int, handler: Callable[[Client, Union[Message, CallbackQuery]], Awaitable[None]],
+                  client: Client, update: Union[Message, CallbackQuery], high: bool = False) -> None:
+        # Waits for room in the low priority lane instead, for producers with a task of their own such as catch up.
+        # Goes past a hold, so the producer holding the chat gets its updates in ahead of the held ones
+        chat = self._get_chat(chat_id)
+        while not high and len(chat.low) >= self.queue_size:
+            chat.low_room.clear()
+            await chat.low_room.wait()
+        self._append(chat_id, chat, self._Item(handler, client, update, high, time.monotonic()))
+
+    def hold(self, chat_id: int) -> None:
+        # Low priority updates put_nowait() in the chat are kept aside until release(), in their order
+        chat = self._get_chat(chat_id)
+        if chat.held is None:
+            chat.held = deque()
+
+    def release(self, chat_id: int, skip: Optional[Callable[[Union[Message, CallbackQuery]], bool]] = None) -> None:
+        chat = self._chats.get(chat_id)
+        if chat is None or chat.held is None:
+            return
+        held, chat.held = chat.held, None
+        for item in held:
+            if skip is None or not skip(item.update):
+                self._append(chat_id, chat, item)
+
+    def _pop(self, chat: OrderedDispatcher._Chat) -> OrderedDispatcher._Item:
+        if chat.high and (not chat.low or chat.high_streak < self.high_burst):
+            chat.high_streak += 1
+            return chat.high.popleft()
+        chat.high_streak = 0
+        chat.low_room.set()
+        if len(chat.low) <= self.queue_size // 2:
+            chat.overflowing = False
+        return chat.low.popleft()
+
+    async def _worker(self, chat_id: int, chat: OrderedDispatcher._Chat) -> None:
+        while True:
+            if not chat:
+                chat.wakeup.clear()
+                try:
+                    await asyncio.wait_for(chat.wakeup.wait(), self.idle_timeout)
+                except asyncio.TimeoutError:
+                    if not chat and chat.held is None:
+                        del self._chats[chat_id], self._workers[chat_id]
+                        return
+                continue
+            item = self._pop(chat)
+            async with self.gate.slot(item.high):
+                self.wait[item.high].record(time.monotonic() - item.enqueued, 0)
+                try:
+                    await item.handler(item.client, item.update)
+                except (ContinuePropagation, StopPropagation):
+                    pass
+                except asyncio.CancelledError:
+                    raise
+                except:
+                    logger.exception('Unhandled exception in %s (chat %d)', item.handler.__name__, chat_id)
+                finally:
+                    self.processed += 1
+
+    @property
+    def depth(self) -> int:
+        return sum(len(chat) for chat in self._chats.values())
+
+    async def stop(self, timeout: float = 5.0) -> None:
+        deadline = time.monotonic() + timeout
+        while self.depth and time.monotonic() < deadline:
+            await asyncio.sleep(.1)
+        for task in self._workers.values():
+            task.cancel()
+
+    @property
+    def stats(self) -> str:
+        return 'chats={} depth={} peak_depth={} processed={} over_limit={} running={} ' \
+               'high_wait_avg={:.2f}ms high_wait_p99={:.2f}ms low_wait_avg={:.2f}ms low_wait_p99={:.2f}ms'.format(
+                len(self._chats), self.depth, self.peak_depth, self.processed, self.over_limit, self.gate.active,
+                *(x for high in (True, False) for x in (
+                    self.wait[high].total_time * 1000 / max(self.wait[high].calls, 1), self.wait[high].p99 * 1000)))
+
+
+class CommandRouter:
+    @dataclass
+    class Command:
+        handler: Optional[Callable[..., Awaitable[None]]]
+        # Matched against everything after the command name, groups are passed to the handler
+        args: re.Pattern
+        # True: has to reply to a message, False: must not, None: either
+        reply: Optional[bool] = None
+        authorized: bool = True
+        priority: bool = True
+
+    def __init__(self):
+        self._commands: Dict[str, CommandRouter.Command] = {}
+
+    def add(self, names: Union[str, Sequence[str]], handler: Optional[Callable[..., Awaitable[None]]],
+            args: str = '', *, reply: Optional[bool] = None, authorized: bool = True, priority: bool = True) -> None:
+        command = self.Command(handler, re.compile(args), reply, authorized, priority)
+        for name in (names,) if isinstance(names, str) else names:
+            if name in self._commands:
+                raise ValueError(f'Duplicate command /{name}')
+            self._commands[name] = command
+
+    def match(self, text: Optional[str]) -> Optional[Tuple[CommandRouter.Command, Tuple[Optional[str], ...]]]:
+        if not text or not text.startswith('/'):
+            return None
+        name, sep, rest = text[1:].partition(' ')
+        command = self._commands.get(name)
+        if command is None:
+            return None
+        r = command.args.fullmatch(sep + rest)
+        return None if r is None else (command, r.groups())
+
+    @staticmethod
+    async def invoke(command: CommandRouter.Command, args: Tuple[Optional[str], ...], client: Client,
+                     msg: Message) -> None:
+        if command.handler is None:
+            return
+        if command.reply is not None and command.reply != (msg.reply_to_message is not None):
+            return
+        await command.handler(client, msg, *args)
+
+    def __len__(self) -> int:
+        return len(self._commands)
+
+
+class CallbackRouter:
+    # callback_data is '.' + base85(version, action id, issue time, arguments), Telegram allows up to 64 bytes.
+    # '.' is not in the base85 alphabet, so anything else is a button sent before the codec existed
+    VERSION = 1
+    PREFIX = '.'
+    MAX_LENGTH = 64
+    _HEADER = struct.Struct('>BBI')
+    _INT = struct.Struct('>q')
+    _LENGTH = struct.Struct('>B')
+
+    @dataclass
+    class Action:
+        action_id: int
+        name: str
+        handler: Callable[..., Awaitable[None]]
+        arg_types: Tuple[type, ...]
+        # Seconds after the button was issued
+        timeout: Optional[float] = None
+
+    class Expired(TimeoutError):
+        pass
+
+    def __init__(self):
+        self._actions: Dict[str, CallbackRouter.Action] = {}
+        self._actions_by_id: Dict[int, CallbackRouter.Action] = {}
+
+    def add(self, action_id: int, name: str, handler: Callable[..., Awaitable[None]], *arg_types: type,
+            timeout: Optional[float] = None) -> None:
+        if not 0 < action_id < 256:
+            raise ValueError(f'Action id of {name} should be in 1..255')
+        if name in self._actions or action_id in self._actions_by_id:
+            raise ValueError(f'Duplicate callback action {name} ({action_id})')
+        for arg_type in arg_types:
+            if arg_type not in (int, str):
+                raise TypeError(f'Unsupported argument type {arg_type!r} of {name}')
+        self._actions[name] = self._actions_by_id[action_id] = self.Action(action_id, name, handler, arg_types,
+                                                                           timeout)
+
+    def encode(self, name: str, *args: Union[int, str]) -> str:
+        action = self._actions[name]
+        if len(args) != len(action.arg_types):
+            raise TypeError(f'{name} takes {len(action.arg_types)} arguments, got {len(args)}')
+        payload = [self._HEADER.pack(self.VERSION, action.action_id, int(time.time()))]
+        for arg_type, arg in zip(action.arg_types, args):
+            if arg_type is int:
+                payload.append(self._INT.pack(int(arg)))
+            else:
+                b = str(arg).encode()
+                payload.append(self._LENGTH.pack(len(b)))
+                payload.append(b)
+        data = self.PREFIX + base64.b85encode(b''.join(payload)).decode()
+        if len(data) > self.MAX_LENGTH:
+            raise ValueError(f'callback_data of {name} is {len(data)} bytes long')
+        return data
+
+    def decode(self, data: str) -> Optional[Tuple[CallbackRouter.Action, Tuple[Union[int, str], ...], Optional[int]]]:
+        """Return the action, its arguments and the issue time, which is None for buttons without the codec"""
+        if not data.startswith(self.PREFIX):
+            words = data.split()
+            action = self._actions.get(words[0]) if words else None
+            if action is None or len(words) - 1 != len(action.arg_types):
+                return None
+            try:
+                return action, tuple(arg_type(word) for arg_type, word in zip(action.arg_types, words[1:])), None
+            except ValueError:
+                return None
+        try:
+            payload = base64.b85decode(data[1:])
+            version, action_id, issued_at = self._HEADER.unpack_from(payload)
+            action = self._actions_by_id.get(action_id)
+            if version != self.VERSION or action is None:
+                return None
+            args = []
+            offset = self._HEADER.size
+            for arg_type in action.arg_types:
+                if arg_type is int:
+                    args.append(self._INT.unpack_from(payload, offset)[0])
+                    offset += self._INT.size
+                else:
+                    length, = self._LENGTH.unpack_from(payload, offset)
+                    offset += self._LENGTH.size
+                    args.append(payload[offset:offset + length].decode())
+                    offset += length
+        except (ValueError, struct.error):
+            return None
+        if offset != len(payload):
+            return None
+        return action, tuple(args), issued_at
+
+    @staticmethod
+    def get_issue_time(msg: CallbackQuery, issued_at: Optional[int]) -> float:
+        # callback_data comes back from the client and can be forged, Telegram's time of the last change to the message
+        # carrying the button is the authority. issued_at can only make a button expire sooner
+        if msg.message is None:
+            # Nothing to check the button against, so it is expired
+            return float('-inf')
+        message_time = msg.message.edit_date or msg.message.date
+        return message_time if issued_at is None else min(issued_at, message_time)
+
+    async def dispatch(self, client: Client, msg: CallbackQuery) -> bool:
+        decoded = self.decode(msg.data) if isinstance(msg.data, str) else None
+        if decoded is None:
+            return False
+        action, args, issued_at = decoded
+        if action.timeout is not None and self.get_issue_time(msg, issued_at) < time.time() - action.timeout:
+            raise CallbackRouter.Expired(action.name)
+        await action.handler(client, msg, *args)
+        return True
+
+    def __len__(self) -> int:
+        return len(self._actions)
 
 
 class InviteLinkTracker:
@@ -313,13 +1648,7 @@ class InviteLinkTracker:
         return self.future
 
     async def do_revoke(self) -> None:
-        while True:
-            try:
-                self.current_link = await self.client.export_chat_invite_link(self.chat_id)
-                break
-            except FloodWait as e:
-                logger.warning('Got Floodwait, wait for %d seconds', e.x)
-                await asyncio.sleep(e.x)
+        self.current_link = await self.client.export_chat_invite_link(self.chat_id)
         await self.revoke_users()
         self.last_revoke_time = time.time()
 
@@ -404,87 +1733,485 @@ class InviteLinkTracker:
                     await asyncio.sleep(1)
 
 
+class MsgIdPartitionMaintainer:
+    _PARTITION_NAME = re.compile(r'^msg_id_(\d{4})(\d{2})$')
+
+    def __init__(self, conn: PgSQLdb, retention_days: int, archive: bool = True, months_ahead: int = 2,
+                 interval: float = 3600.0):
+        self.conn: PgSQLdb = conn
+        self.retention_days: int = retention_days
+        self.archive: bool = archive
+        self.months_ahead: int = months_ahead
+        self.interval: float = interval
+        self.stop_event: asyncio.Event = asyncio.Event()
+        self.future: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _add_months(month_start: datetime, months: int) -> datetime:
+        month = month_start.month - 1 + months
+        return month_start.replace(year=month_start.year + month // 12, month=month % 12 + 1)
+
+    async def is_partitioned(self) -> bool:
+        r = await self.conn.query1(
+            '''SELECT "relkind" = 'p' AS "partitioned" FROM "pg_class" WHERE "oid" = 'public.msg_id'::regclass''')
+        return r is not None and r['partitioned']
+
+    async def list_partitions(self) -> List[str]:
+        return [row['relname'] for row in await self.conn.query(
+            '''SELECT "c"."relname" FROM "pg_inherits" "i" JOIN "pg_class" "c" ON "c"."oid" = "i"."inhrelid"
+            WHERE "i"."inhparent" = 'public.msg_id'::regclass''')]
+
+    async def create_partitions(self, now: datetime) -> None:
+        month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        for offset in range(self.months_ahead + 1):
+            start = self._add_months(month_start, offset)
+            stop = self._add_months(start, 1)
+            try:
+                await self.conn.execute(
+                    '''CREATE TABLE IF NOT EXISTS public."msg_id_{}" PARTITION OF public.msg_id
+                    FOR VALUES FROM ('{}') TO ('{}')'''.format(start.strftime('%Y%m'), start.isoformat(' '),
+                                                               stop.isoformat(' ')))
+            except asyncpg.PostgresError:
+                logger.exception('Create msg_id partition for %s failure', start.strftime('%Y-%m'))
+
+    async def expire_partitions(self, now: datetime) -> List[str]:
+        if self.retention_days <= 0:
+            return []
+        cutoff = now - timedelta(days=self.retention_days)
+        expired = []
+        for name in await self.list_partitions():
+            r = self._PARTITION_NAME.match(name)
+            if r is None:
+                continue
+            if self._add_months(datetime(int(r.group(1)), int(r.group(2)), 1), 1) > cutoff:
+                continue
+            await self.conn.execute(f'''ALTER TABLE public.msg_id DETACH PARTITION public."{name}"''')
+            await self.conn.execute('''DELETE FROM "msg_id_key" WHERE "timestamp" < $1''',
+                                    self._add_months(datetime(int(r.group(1)), int(r.group(2)), 1), 1))
+            if self.archive:
+                await self.conn.execute(f'''ALTER TABLE public."{name}" RENAME TO "msg_id_archive_{name[7:]}"''')
+            else:
+                await self.conn.execute(f'''DROP TABLE public."{name}"''')
+            logger.info('%s msg_id partition %s', 'Archived' if self.archive else 'Dropped', name)
+            expired.append(name)
+        return expired
+
+    async def run_once(self) -> None:
+        now = (await self.conn.query1('''SELECT LOCALTIMESTAMP AS "now"'''))['now']
+        await self.create_partitions(now)
+        await self.expire_partitions(now)
+
+    def start(self) -> asyncio.Task:
+        if self.future is None:
+            self.future = asyncio.create_task(self._boost_run())
+        return self.future
+
+    def request_stop(self) -> None:
+        self.stop_event.set()
+
+    async def join(self, timeout: float = 0) -> None:
+        if self.future is None:
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(self.future), timeout)
+        except asyncio.TimeoutError:
+            self.future.cancel()
+
+    async def _boost_run(self) -> None:
+        if not await self.is_partitioned():
+            logger.warning('msg_id table is not partitioned, partition maintainer exited')
+            return
+        while not self.stop_event.is_set():
+            try:
+                await self.run_once()
+            except:
+                logger.exception('Maintain msg_id partitions failure')
+            try:
+                await asyncio.wait_for(self.stop_event.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+
+class FileWatcher:
+    def __init__(self, path: str, callback: Callable[[], Awaitable[Any]], interval: float = 5.0):
+        self.path: str = path
+        self.callback: Callable[[], Awaitable[Any]] = callback
+        self.interval: float = interval
+        self.mtime: Optional[int] = self._stat()
+        # Set by SIGHUP to reload without waiting for the file to change
+        self.reload_event: asyncio.Event = asyncio.Event()
+        self.stop_event: asyncio.Event = asyncio.Event()
+        self.future: Optional[asyncio.Task] = None
+
+    def _stat(self) -> Optional[int]:
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def start(self) -> asyncio.Task:
+        if self.future is None:
+            with contextlib.suppress(NotImplementedError, AttributeError):
+                asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, self.reload_event.set)
+            self.future = asyncio.create_task(self._boost_run())
+        return self.future
+
+    def request_stop(self) -> None:
+        self.stop_event.set()
+        self.reload_event.set()
+        with contextlib.suppress(NotImplementedError, AttributeError, RuntimeError):
+            asyncio.get_running_loop().remove_signal_handler(signal.SIGHUP)
+
+    async def join(self, timeout: float = 0) -> None:
+        if self.future is None:
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(self.future), timeout)
+        except asyncio.TimeoutError:
+            self.future.cancel()
+
+    async def _boost_run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self.reload_event.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            if self.stop_event.is_set():
+                break
+            mtime = self._stat()
+            if not self.reload_event.is_set() and mtime == self.mtime:
+                continue
+            self.reload_event.clear()
+            self.mtime = mtime
+            logger.info('Reloading %s', self.path)
+            try:
+                await self.callback()
+            except:
+                logger.exception('Reload %s failure', self.path)
+
+
+def _regex_worker(conn: multiprocessing.connection.Connection, max_patterns: int = 1024) -> None:
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Problem sets hold a handful of patterns, each one is compiled once for the life of the worker
+    patterns: Dict[Tuple[str, int], Optional[re.Pattern]] = {}
+    while True:
+        try:
+            batch = conn.recv()
+        except EOFError:
+            return
+        for pattern, flags, text in batch:
+            compiled = patterns.get((pattern, flags), False)
+            if compiled is False:
+                if len(patterns) >= max_patterns:
+                    patterns.clear()
+                try:
+                    compiled = re.compile(pattern, flags)
+                except re.error:
+                    compiled = None
+                patterns[(pattern, flags)] = compiled
+            conn.send(compiled is not None and compiled.match(text) is not None)
+
+
+class RegexWorker:
+    # re holds the GIL until a match returns, so a pattern that backtracks on hostile input can only be stopped by
+    # running it in another process and killing that process. A small pool of them keeps a hostile answer from
+    # delaying the answers of other users, which go to another process meanwhile
+    @dataclass
+    class _Slot:
+        process: Optional[multiprocessing.process.BaseProcess] = None
+        conn: Optional[multiprocessing.connection.Connection] = None
+
+    def __init__(self, timeout: float = 0.5, max_batch: int = 256, processes: int = 2):
+        self.timeout: float = timeout
+        self.max_batch: int = max_batch
+        self.slots: List[RegexWorker._Slot] = [self._Slot() for _ in range(max(processes, 1))]
+        self._idle: Deque[RegexWorker._Slot] = deque(self.slots)
+        self._available: asyncio.Semaphore = asyncio.Semaphore(len(self.slots))
+        self.matched: int = 0
+        self.timeouts: int = 0
+        self.starts: int = 0
+
+    @staticmethod
+    def _get_context() -> multiprocessing.context.BaseContext:
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('forkserver')
+            # Keep the restart after a kill cheap, children are forked from a server which imported the main module
+            # and this one already
+            context.set_forkserver_preload(['__main__', __name__])
+            return context
+        return multiprocessing.get_context('spawn')
+
+    def _start_process(self, slot: RegexWorker._Slot) -> None:
+        if slot.process is not None and slot.process.is_alive():
+            return
+        self._kill(slot)
+        slot.conn, child_conn = multiprocessing.Pipe()
+        slot.process = self._get_context().Process(target=_regex_worker, args=(child_conn,), daemon=True,
+                                                   name='regex-worker')
+        slot.process.start()
+        child_conn.close()
+        self.starts += 1
+
+    def start(self) -> None:
+        # Starting the first worker also starts the fork server, better done before the first answer arrives
+        for slot in self.slots:
+            self._start_process(slot)
+
+    @staticmethod
+    def _kill(slot: RegexWorker._Slot) -> None:
+        if slot.process is not None:
+            slot.process.kill()
+            slot.process.join()
+            slot.process = None
+        if slot.conn is not None:
+            slot.conn.close()
+            slot.conn = None
+
+    async def _recv(self, slot: RegexWorker._Slot) -> Optional[bool]:
+        if not slot.conn.poll() and not await asyncio.get_running_loop().run_in_executor(
+                None, slot.conn.poll, self.timeout):
+            return None
+        return slot.conn.recv()
+
+    async def match_many(self, items: Sequence[Tuple[re.Pattern, str]]) -> List[bool]:
+        results = []
+        async with self._available:
+            slot = self._idle.popleft()
+            try:
+                while len(results) < len(items):
+                    self._start_process(slot)
+                    pending = items[len(results):len(results) + self.max_batch]
+                    try:
+                        slot.conn.send([(pattern.pattern, pattern.flags, text) for pattern, text in pending])
+                        for pattern, text in pending:
+                            r = await self._recv(slot)
+                            if r is None:
+                                self.timeouts += 1
+                                logger.warning('Regex %r exceeded %.2fs on %d characters, worker killed',
+                                               pattern.pattern, self.timeout, len(text))
+                                self._kill(slot)
+                                results.append(False)
+                                break
+                            results.append(r)
+                    except (EOFError, OSError):
+                        logger.exception('Regex worker exited unexpectedly')
+                        self._kill(slot)
+                        results.append(False)
+            except asyncio.CancelledError:
+                # Answers still in the pipe would be read by the next batch
+                self._kill(slot)
+                raise
+            finally:
+                self._idle.append(slot)
+        self.matched += len(items)
+        return results
+
+    async def match(self, pattern: re.Pattern, text: str) -> bool:
+        return (await self.match_many([(pattern, text)]))[0]
+
+    def close(self) -> None:
+        for slot in self.slots:
+            self._kill(slot)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {'matched': self.matched, 'timeouts': self.timeouts, 'starts': self.starts}
+
+
 def get_random_string(length: int = 8) -> str:
     return ''.join(random.choices(string.ascii_lowercase, k=length))
 
 
 class AuthSystem:
     class_self = None
+    CHANNEL = 'auth_user'
+    _LOAD_USERS = Statement('auth_user.load', '''SELECT "uid", "authorized", "muted", "whitelist" FROM "auth_user"''')
+    _UPSERT_USERS = Statement(
+        'auth_user.upsert_authorized',
+        '''INSERT INTO "auth_user" ("uid", "authorized") SELECT UNNEST($1::bigint[]), true
+        ON CONFLICT ("uid") DO UPDATE SET "authorized" = true''')
+    _QUERY_USER = Statement('auth_user.query', '''SELECT * FROM "auth_user" WHERE "uid" = $1''')
+    _UPDATE_USERS = {
+        column: Statement(f'auth_user.update_{column}',
+                          f'''UPDATE "auth_user" SET "{column}" = $1 WHERE "uid" = ANY($2::bigint[])''')
+        for column in ('authorized', 'muted', 'whitelist')
+    }
 
-    def __init__(self, conn: PgSQLdb):
+    @dataclass(frozen=True)
+    class Snapshot:
+        # Replaced as a whole, so a check never sees half of an update
+        authorized: FrozenSet[int] = frozenset()
+        unmuted: FrozenSet[int] = frozenset()
+        whitelist: FrozenSet[int] = frozenset()
+
+        def apply(self, user_ids: FrozenSet[int], authorized: Optional[bool] = None, muted: Optional[bool] = None,
+                  whitelist: Optional[bool] = None) -> AuthSystem.Snapshot:
+            def merge(current: FrozenSet[int], value: Optional[bool]) -> FrozenSet[int]:
+                if value is None:
+                    return current
+                return current | user_ids if value else current - user_ids
+
+            return AuthSystem.Snapshot(merge(self.authorized, authorized),
+                                       merge(self.unmuted, None if muted is None else not muted),
+                                       merge(self.whitelist, whitelist))
+
+    def __init__(self, conn: PgSQLdb, owner: Optional[int] = None, reconnect_interval: float = 5.0,
+                 ping_interval: float = 60.0):
         self.conn = conn
-        self.authed_user: List[int] = []
-        self.non_ignore_user: List[int] = []
-        self.whitelist: List[int] = []
+        self.owner: Optional[int] = owner
+        self.snapshot: AuthSystem.Snapshot = self.Snapshot()
+        self.reconnect_interval: float = reconnect_interval
+        self.ping_interval: float = ping_interval
+        self.notifications: int = 0
+        self.future: Optional[asyncio.Task] = None
+
+    @property
+    def authed_user(self) -> FrozenSet[int]:
+        return self.snapshot.authorized
+
+    @property
+    def non_ignore_user(self) -> FrozenSet[int]:
+        return self.snapshot.unmuted
+
+    @property
+    def whitelist(self) -> FrozenSet[int]:
+        return self.snapshot.whitelist
+
+    def _pin_owner(self, snapshot: AuthSystem.Snapshot) -> AuthSystem.Snapshot:
+        if self.owner is None or self.owner in snapshot.authorized:
+            return snapshot
+        return snapshot.apply(frozenset((self.owner,)), authorized=True)
 
     async def init(self, owner: Optional[int] = None) -> None:
-        sql_obj = await self.conn.query('''SELECT "uid", "authorized", "muted", "whitelist" FROM "auth_user"''')
-        self.authed_user = [row['uid'] for row in sql_obj if row['authorized']]
-        self.non_ignore_user = [row['uid'] for row in sql_obj if not row['muted']]
-        self.whitelist = [row['uid'] for row in sql_obj if row['whitelist']]
-        if owner is not None and owner not in self.authed_user:
-            self.authed_user.append(owner)
+        if owner is not None:
+            self.owner = owner
+        sql_obj = await self.conn.query(self._LOAD_USERS)
+        self.snapshot = self._pin_owner(self.Snapshot(
+            frozenset(row['uid'] for row in sql_obj if row['authorized']),
+            frozenset(row['uid'] for row in sql_obj if not row['muted']),
+            frozenset(row['uid'] for row in sql_obj if row['whitelist'])
+        ))
 
     @classmethod
     async def create(cls, conn: PgSQLdb, owner: Optional[int] = None) -> AuthSystem:
-        self = cls(conn)
+        self = cls(conn, owner)
         try:
-            await self.init(owner)
+            await self.init()
         except KeyError:
             logger.critical('Got key error', exc_info=True)
         return self
 
     def check_ex(self, user_id: int) -> bool:
-        return user_id in self.authed_user
+        return user_id in self.snapshot.authorized
 
     async def add_user(self, user_id: Union[str, int]) -> None:
-        user_id = int(user_id)
-        self.authed_user.append(user_id)
-        self.authed_user = list(set(self.authed_user))
-        if await self.query_user(user_id) is not None:
-            await self.update_user(user_id, 'authorized', True)
-        else:
-            await self.conn.execute('''INSERT INTO "auth_user" ("uid", "authorized") VALUES ($1, true)''', user_id)
+        await self.add_users((int(user_id),))
+
+    async def add_users(self, user_ids: Iterable[int]) -> None:
+        user_ids = frozenset(user_ids)
+        self.snapshot = self.snapshot.apply(user_ids, authorized=True)
+        await self.conn.execute(self._UPSERT_USERS, list(user_ids))
 
     async def update_user(self, user_id: int, column_name: str, value: Union[str, bool]) -> None:
         if isinstance(value, str):
             warnings.warn('value should passed by bool instead', DeprecationWarning, 2)
             value = value == 'Y'
-        await self.conn.execute('''UPDATE "auth_user" SET "{}" = $1 WHERE "uid" = $2'''.format(column_name),
-                                value, user_id)
+        await self.update_users((user_id,), column_name, value)
+
+    async def update_users(self, user_ids: Iterable[int], column_name: str, value: bool) -> None:
+        user_ids = frozenset(user_ids)
+        # Applied here right away, the notification of this update only confirms it
+        self.snapshot = self._pin_owner(self.snapshot.apply(user_ids, **{column_name: value}))
+        await self.conn.execute(self._UPDATE_USERS[column_name], value, list(user_ids))
 
     async def query_user(self, user_id: int) -> Optional[asyncpg.Record]:
-        return await self.conn.query1('''SELECT * FROM "auth_user" WHERE "uid" = $1''', user_id)
+        return await self.conn.query1(self._QUERY_USER, user_id)
 
     async def del_user(self, user_id: int) -> None:
-        self.authed_user.remove(user_id)
         await self.update_user(user_id, 'authorized', False)
 
     def check_muted(self, user_id: int) -> bool:
-        return user_id not in self.non_ignore_user
+        return user_id not in self.snapshot.unmuted
 
     async def unmute_user(self, user_id: int):
-        self.non_ignore_user.append(user_id)
-        self.non_ignore_user = list(set(self.non_ignore_user))
         await self.update_user(user_id, 'muted', False)
 
     async def mute_user(self, user_id: int) -> None:
-        self.non_ignore_user.remove(user_id)
         await self.update_user(user_id, 'muted', True)
 
     def check(self, user_id: int) -> bool:
         return self.check_ex(user_id) and not self.check_muted(user_id)
 
     def check_full(self, user_id: int) -> bool:
-        return self.check_ex(user_id) or user_id in self.whitelist
+        return self.check_ex(user_id) or user_id in self.snapshot.whitelist
 
     async def mute_or_unmute(self, r: str, chat_id: int) -> None:
         if not self.check_ex(chat_id):
             return
+        await (self.mute_user if r == 'off' else self.unmute_user)(chat_id)
+
+    def handle_notification(self, payload: str) -> None:
+        self.notifications += 1
+        row = json.loads(payload)
+        if row.get('reload'):
+            asyncio.create_task(self._reload())
+            return
+        user_ids = frozenset((row['uid'],))
+        if row.get('deleted'):
+            self.snapshot = self._pin_owner(self.snapshot.apply(user_ids, False, True, False))
+        else:
+            self.snapshot = self._pin_owner(self.snapshot.apply(user_ids, row['authorized'], row['muted'],
+                                                                row['whitelist']))
+
+    def _on_notify(self, _conn: asyncpg.Connection, _pid: int, _channel: str, payload: str) -> None:
         try:
-            await (self.mute_user if r == 'off' else self.unmute_user)(chat_id)
-        except ValueError:
-            pass
+            self.handle_notification(payload)
+        except (ValueError, KeyError):
+            logger.exception('Unexpected %s notification: %s', self.CHANNEL, payload)
+
+    async def _reload(self) -> None:
+        try:
+            await self.init()
+        except:
+            logger.exception('Reload authorized users failure')
+
+    def start(self) -> asyncio.Task:
+        if self.future is None:
+            self.future = asyncio.create_task(self._listen())
+        return self.future
+
+    async def close(self) -> None:
+        if self.future is not None:
+            self.future.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.future
+            self.future = None
+        logger.info('Received %d %s notification(s)', self.notifications, self.CHANNEL)
+
+    async def _listen(self) -> None:
+        while True:
+            try:
+                conn = await self.conn.connect()
+                try:
+                    closed = asyncio.Event()
+                    conn.add_termination_listener(lambda _conn: closed.set())
+                    await conn.add_listener(self.CHANNEL, self._on_notify)
+                    # Changes made while nobody was listening are only in the table
+                    await self.init()
+                    while not closed.is_set():
+                        try:
+                            await asyncio.wait_for(closed.wait(), self.ping_interval)
+                        except asyncio.TimeoutError:
+                            # A half-open socket is only noticed on write
+                            await conn.execute('SELECT 1')
+                    logger.warning('Connection listening on %s closed', self.CHANNEL)
+                finally:
+                    await conn.close()
+            except asyncio.CancelledError:
+                raise
+            except:
+                logger.exception('Listen on %s failure, retry after %.1fs', self.CHANNEL, self.reconnect_interval)
+            await asyncio.sleep(self.reconnect_interval)
 
     @staticmethod
     def get_instance() -> AuthSystem: